@@ -3,13 +3,59 @@
 Self contained stats consumer.
 """
 
+import asynchat
+import asyncore
+import atexit
+import bisect
+import calendar
 import datetime
+import errno
+import gzip
+import heapq
+import httplib
 import os
+import Queue
+import random
 import re
+import select
+import signal
 import socket
+import SocketServer
+import stat
+import struct
+import sys
+import tempfile
 import threading
 import time
 
+try:
+    from hashlib import md5
+except ImportError:
+    # Fallback for 2.4
+    from md5 import new as md5
+
+try:
+    import fcntl
+except ImportError:
+    # No lock files on platforms without fcntl
+    fcntl = None
+
+try:
+    import cProfile
+    import pstats
+except ImportError:
+    # No profiling on 2.4
+    cProfile = None
+
+try:
+    import ctypes
+    import ctypes.util
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'))
+    # Only Linux has inotify
+    _libc.inotify_init
+except (ImportError, OSError, AttributeError):
+    _libc = None
+
 try:
     import json
 except ImportError:
@@ -19,45 +65,713 @@ except ImportError:
 import urllib
 import urllib2
 
+from cStringIO import StringIO
+
+try:
+    from urlparse import parse_qs
+except ImportError:
+    # Fallback for 2.4 and 2.5
+    from cgi import parse_qs
+
+try:
+    from email.utils import formatdate, parsedate
+except ImportError:
+    # Fallback for 2.4
+    from email.Utils import formatdate, parsedate
+
 import logging
 import logging.handlers
 
 
+class LogWriter(object):
+    """
+    Writes log records on a background thread so request threads never
+    wait on the disk. Records are written in batches of up to batch_size,
+    gathered for at most flush_interval seconds, with one flush per batch.
+    When max_queued records are waiting further records are dropped.
+    Records which fail to be written are counted and skipped.
+    """
+
+    def __init__(self, max_queued=10000, batch_size=500, flush_interval=0.5):
+        """
+        Creates a LogWriter. The thread is started by the first record.
+        """
+        self.max_queued = max_queued
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+        self._queue = None
+        self._thread = None
+
+    def put(self, handler, record):
+        """
+        Queues record to be written by the BatchedFileHandler handler.
+        """
+        queue = self._queue
+        if queue is None:
+            queue = self._start()
+        try:
+            queue.put_nowait((handler, record))
+        except Queue.Full:
+            self.dropped += 1
+
+    def _start(self):
+        """
+        Starts the writer thread unless it is running. Returns its queue.
+        """
+        self._lock.acquire()
+        try:
+            if self._queue is None:
+                self._queue = Queue.Queue(self.max_queued)
+                self._thread = threading.Thread(
+                    target=self._run, args=(self._queue,))
+                self._thread.setDaemon(True)
+                self._thread.start()
+            return self._queue
+        finally:
+            self._lock.release()
+
+    def _run(self, queue):
+        """
+        Writer thread loop. A None in the queue stops it.
+        """
+        while True:
+            batch = [queue.get()]
+            end = time.time() + self.flush_interval
+            while batch[-1] is not None and len(batch) < self.batch_size:
+                try:
+                    batch.append(queue.get(True, max(0, end - time.time())))
+                except Queue.Empty:
+                    break
+
+            handlers = []
+            for item in batch:
+                if item is None:
+                    continue
+                handler, record = item
+                # One bad record or a full disk must not stop the only
+                # thread writing the log
+                try:
+                    handler.write(record)
+                except Exception:
+                    self.failed += 1
+                if handler not in handlers:
+                    handlers.append(handler)
+            for handler in handlers:
+                try:
+                    handler.flush()
+                except Exception:
+                    self.failed += 1
+            if batch[-1] is None:
+                return
+
+    def close(self, timeout=5):
+        """
+        Writes out every queued record and stops the writer thread, waiting
+        at most timeout seconds.
+        """
+        self._lock.acquire()
+        try:
+            queue, thread = self._queue, self._thread
+            self._queue = self._thread = None
+        finally:
+            self._lock.release()
+        if queue is not None:
+            queue.put(None)
+            thread.join(timeout)
+
+    def after_fork(self):
+        """
+        Forgets the parent's writer thread in a forked child. Records the
+        parent queued are left for the parent to write.
+        """
+        self._lock = threading.Lock()
+        self._queue = self._thread = None
+
+
+#: Writes every log record of the process
+log_writer = LogWriter()
+atexit.register(log_writer.close)
+
+
+class BatchedFileHandler(logging.handlers.TimedRotatingFileHandler):
+    """
+    Daily rotating log file written to by log_writer, which flushes it once
+    per batch of records rather than after every record.
+    """
+
+    _batching = False
+
+    def write(self, record):
+        """
+        Writes record, a LogRecord or an already formatted line, without
+        flushing the file. Unicode lines are written UTF-8 encoded.
+        """
+        if isinstance(record, basestring):
+            if isinstance(record, unicode):
+                record = record.encode('utf-8')
+            self.acquire()
+            try:
+                if self.shouldRollover(None):
+                    self.doRollover()
+                if self.stream is None:
+                    self.stream = self._open()
+                self.stream.write(record + '\n')
+            finally:
+                self.release()
+            return
+        self._batching = True
+        try:
+            self.handle(record)
+        finally:
+            self._batching = False
+
+    def flush(self):
+        if not self._batching:
+            logging.handlers.TimedRotatingFileHandler.flush(self)
+
+
+class QueueLogHandler(logging.Handler):
+    """
+    Hands records over to log_writer to be written to target.
+    """
+
+    def __init__(self, target):
+        """
+        Creates a QueueLogHandler writing to the BatchedFileHandler target.
+        """
+        logging.Handler.__init__(self)
+        self.target = target
+
+    def emit(self, record):
+        try:
+            # Render the message now as its arguments may change later
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.exc_text = self.formatter.formatException(
+                    record.exc_info)
+                record.exc_info = None
+            log_writer.put(self.target, record)
+        except Exception:
+            self.handleError(record)
+
+
 def create_logger(name, filename,
                   format='%(asctime)s - %(levelname)s - %(message)s'):
     """
-    Creates a logger instance.
+    Creates a logger instance. Records are written by log_writer.
     """
     logger = logging.getLogger(name)
     if len(logger.handlers) == 0:
         logger.setLevel(logging.INFO)
-        logfile = os.path.sep.join([os.path.realpath(
-            json.load(open(os.environ['TALOOK_CONFIG_FILE'], 'r'))['logdir']),
-            filename])
+        logfile = os.path.sep.join([get_config().logdir, filename])
 
         if not os.path.exists(os.path.dirname(logfile)):
             os.makedirs(os.path.dirname(logfile))
-        handler = logging.handlers.TimedRotatingFileHandler(
-            logfile, 'd')
+        handler = BatchedFileHandler(logfile, 'd')
         handler.setLevel(logging.INFO)
         handler.setFormatter(logging.Formatter(format))
-        logger.addHandler(handler)
+        queue_handler = QueueLogHandler(handler)
+        queue_handler.setFormatter(logging.Formatter())
+        logger.addHandler(queue_handler)
     return logger
 
 
+#: Format of access log lines
+access_log_format = '%(asctime)s %(message)s'
+
+
+class AccessLog(object):
+    """
+    Writes access log lines straight to log_writer, formatted like
+    access_log_format, without building logging records.
+    """
+
+    def __init__(self, logger):
+        """
+        Creates an AccessLog writing to the file of the logger made by
+        create_logger.
+        """
+        self.target = logger.handlers[0].target
+        self._stamp = (None, '')
+
+    def write(self, line):
+        """
+        Queues line to be written with the current time.
+        """
+        now = time.time()
+        second = int(now)
+        stamp = self._stamp
+        if stamp[0] != second:
+            stamp = (second, time.strftime(
+                '%Y-%m-%d %H:%M:%S', time.localtime(second)))
+            self._stamp = stamp
+        log_writer.put(self.target, '%s,%03d %s' % (
+            stamp[1], (now - second) * 1000, line))
+
+
+#: Details of the request being handled by the current thread
+_request = threading.local()
+
+
+class Metrics(object):
+    """
+    Process wide counters, gauges and histograms exposed in the Prometheus
+    text format. Every thread records into its own shard so recording
+    takes no lock; shards are summed when collected. Labels are tuples of
+    (name, value) pairs.
+    """
+
+    #: Upper bounds in seconds of histogram buckets
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        """
+        Creates an empty Metrics instance.
+        """
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # [(thread, (values, histograms))] of threads which recorded
+        self._shards = []
+        # Shard of threads which have exited
+        self._retired = ({}, {})
+        self._descriptions = []
+
+    def describe(self, name, kind, help):
+        """
+        Declares metric name of kind counter, gauge or histogram.
+        """
+        self._descriptions.append((name, kind, help))
+
+    def _shard(self):
+        """
+        Returns the (values, histograms) shard of the current thread.
+        """
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = ({}, {})
+            self._lock.acquire()
+            try:
+                if len(self._shards) % 64 == 63:
+                    self._retire()
+                self._shards.append((threading.currentThread(), shard))
+            finally:
+                self._lock.release()
+            self._local.shard = shard
+            return shard
+
+    def _retire(self):
+        """
+        Folds the shards of exited threads into the retired shard. Caller
+        must hold the lock.
+        """
+        alive = []
+        for thread, shard in self._shards:
+            if thread.isAlive():
+                alive.append((thread, shard))
+            else:
+                self._merge(self._retired, shard)
+        self._shards = alive
+
+    def _merge(self, into, shard):
+        """
+        Adds the values of shard to into.
+        """
+        for key, value in shard[0].items():
+            into[0][key] = into[0].get(key, 0) + value
+        for key, counts in shard[1].items():
+            total = into[1].setdefault(key, [0] * len(counts))
+            for position in range(len(counts)):
+                total[position] += counts[position]
+
+    def inc(self, name, labels=(), value=1):
+        """
+        Adds value to the counter or gauge name.
+        """
+        values = self._shard()[0]
+        key = (name, labels)
+        values[key] = values.get(key, 0) + value
+
+    def dec(self, name, labels=(), value=1):
+        """
+        Subtracts value from the gauge name.
+        """
+        self.inc(name, labels, -value)
+
+    def observe(self, name, labels, value):
+        """
+        Records value in the histogram name.
+        """
+        histograms = self._shard()[1]
+        key = (name, labels)
+        counts = histograms.get(key)
+        if counts is None:
+            # A count per bucket, +Inf, then the sum and count
+            counts = histograms[key] = [0] * (len(self.buckets) + 3)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-2] += value
+        counts[-1] += 1
+
+    def collect(self):
+        """
+        Returns the (values, histograms) totals of every shard.
+        """
+        totals = ({}, {})
+        self._lock.acquire()
+        try:
+            self._retire()
+            self._merge(totals, self._retired)
+            for thread, shard in self._shards:
+                # Copied first as the owning thread may be recording
+                self._merge(totals, (dict(shard[0]), dict(shard[1])))
+        finally:
+            self._lock.release()
+        return totals
+
+    def _format_labels(self, labels):
+        """
+        Returns labels in the text format.
+        """
+        if not labels:
+            return ''
+        return '{%s}' % ','.join([
+            '%s="%s"' % (name, str(value).replace('\\', '\\\\').replace(
+                '"', '\\"').replace('\n', '\\n'))
+            for name, value in labels])
+
+    def render(self):
+        """
+        Returns every metric in the Prometheus text format.
+        """
+        values, histograms = self.collect()
+        lines = []
+        for name, kind, help in self._descriptions:
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            if kind != 'histogram':
+                for key in sorted(values.keys()):
+                    if key[0] == name:
+                        lines.append('%s%s %s' % (
+                            name, self._format_labels(key[1]),
+                            values[key]))
+                continue
+            for key in sorted(histograms.keys()):
+                if key[0] != name:
+                    continue
+                counts = histograms[key]
+                cumulative = 0
+                for bound, count in zip(
+                        self.buckets + ('+Inf',), counts[:-2]):
+                    cumulative += count
+                    lines.append('%s_bucket%s %s' % (
+                        name, self._format_labels(
+                            key[1] + (('le', bound),)), cumulative))
+                lines.append('%s_sum%s %r' % (
+                    name, self._format_labels(key[1]), float(counts[-2])))
+                lines.append('%s_count%s %s' % (
+                    name, self._format_labels(key[1]), counts[-1]))
+        return '\n'.join(lines) + '\n'
+
+
+#: Metrics of the process
+metrics = Metrics()
+metrics.describe(
+    'talook_requests_total', 'counter',
+    'Requests handled by route and status.')
+metrics.describe(
+    'talook_request_duration_seconds', 'histogram',
+    'Time spent handling requests by route.')
+metrics.describe(
+    'talook_requests_in_flight', 'gauge', 'Requests being handled by route.')
+metrics.describe(
+    'talook_upstream_duration_seconds', 'histogram',
+    'Time spent on requests to jsonstats agents by host.')
+metrics.describe(
+    'talook_upstream_errors_total', 'counter',
+    'Failed requests to jsonstats agents by host.')
+metrics.describe(
+    'talook_cache_requests_total', 'counter',
+    'Lookups of host stats by how the cache served them.')
+metrics.describe(
+    'talook_cache_expired_total', 'counter',
+    'Entries found in the cache directory past their expiration.')
+metrics.describe(
+    'talook_cache_writes_total', 'counter',
+    'Entries written to the cache directory.')
+metrics.describe(
+    'talook_crawl_refreshes_total', 'counter',
+    'Entries refreshed ahead of expiration by the crawler.')
+
+
+def set_cache_outcome(outcome):
+    """
+    Records how the cache served the current request for the access log
+    and metrics.
+    """
+    _request.cache = outcome
+    metrics.inc('talook_cache_requests_total', (('outcome', outcome),))
+
+
+class ConnectionPool(object):
+    """
+    Thread safe pool of idle keep-alive HTTP connections keyed by
+    (host, port).
+    """
+
+    def __init__(self, max_per_host=2, max_size=100, idle_time=30):
+        """
+        Creates an empty ConnectionPool. At most max_per_host idle
+        connections are kept per (host, port) and max_size in total.
+        Connections idle for idle_time seconds are closed.
+        """
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._size = 0
+        self.max_per_host = max_per_host
+        self.max_size = max_size
+        self.idle_time = idle_time
+
+    def configure(self, max_per_host, max_size, idle_time):
+        """
+        Changes the limits of the pool. Idle connections are dropped.
+        """
+        self.close_all()
+        self.max_per_host = max_per_host
+        self.max_size = max_size
+        self.idle_time = idle_time
+
+    def get(self, host, port):
+        """
+        Returns a tuple of (connection, reused) for (host, port), reusing
+        the most recently used idle connection if there is one.
+        """
+        expired = []
+        conn = None
+        now = time.time()
+        self._lock.acquire()
+        try:
+            idle = self._idle.get((host, port), [])
+            while idle:
+                candidate, last_used = idle.pop()
+                self._size -= 1
+                if now - last_used < self.idle_time:
+                    conn = candidate
+                    break
+                expired.append(candidate)
+        finally:
+            self._lock.release()
+
+        for candidate in expired:
+            candidate.close()
+        if conn is not None:
+            return (conn, True)
+        return (httplib.HTTPConnection(host, port), False)
+
+    def put(self, host, port, conn):
+        """
+        Returns a connection to the pool, closing it if the pool is full.
+        """
+        self._lock.acquire()
+        try:
+            idle = self._idle.setdefault((host, port), [])
+            if len(idle) < self.max_per_host and self._size < self.max_size:
+                idle.append((conn, time.time()))
+                self._size += 1
+                return
+        finally:
+            self._lock.release()
+        conn.close()
+
+    def close_all(self):
+        """
+        Closes every idle connection.
+        """
+        self._lock.acquire()
+        try:
+            idle = self._idle
+            self._idle = {}
+            self._size = 0
+        finally:
+            self._lock.release()
+        for conns in idle.values():
+            for conn, last_used in conns:
+                conn.close()
+
+
+class PooledHTTPHandler(urllib2.HTTPHandler):
+    """
+    urllib2 handler which sends http requests over pooled keep-alive
+    connections.
+    """
+
+    def __init__(self, pool):
+        """
+        Creates a handler using pool for connections.
+        """
+        urllib2.HTTPHandler.__init__(self)
+        self._pool = pool
+
+    def http_open(self, req):
+        """
+        Sends req over a pooled connection. A reused connection which
+        turns out to have been closed by the server is retried once on a
+        new connection.
+        """
+        host, port = urllib.splitport(req.get_host())
+        port = int(port or httplib.HTTP_PORT)
+        headers = dict(req.headers)
+        headers.update(req.unredirected_hdrs)
+        headers['Connection'] = 'keep-alive'
+
+        while True:
+            conn, reused = self._pool.get(host, port)
+            try:
+                conn.request(
+                    req.get_method(), req.get_selector(), req.data, headers)
+                response = conn.getresponse()
+                body = response.read()
+                break
+            except (httplib.HTTPException, socket.error), ex:
+                conn.close()
+                if reused and not isinstance(ex, socket.timeout):
+                    continue
+                raise urllib2.URLError(ex)
+
+        if response.will_close:
+            conn.close()
+        else:
+            self._pool.put(host, port, conn)
+
+        result = urllib.addinfourl(
+            StringIO(body), response.msg, req.get_full_url())
+        result.code = response.status
+        result.msg = response.reason
+        return result
+
+
+#: Keep-alive connections to upstream jsonstats agents
+connection_pool = ConnectionPool()
+
+#: Opener used for all upstream requests
+opener = urllib2.build_opener(PooledHTTPHandler(connection_pool))
+
+
+def decode_error_result(endpoint):
+    """
+    Returns the make_get_request result for a non-json response.
+    """
+    msg = "Could not decode json from remote service: %s" % endpoint
+    return (-1, {'error': {'Error': msg}})
+
+
+def http_error_result(endpoint, code, reason):
+    """
+    Returns the make_get_request result for a non 2xx response.
+    """
+    error = "Error %d while contacting endpoint: %s." % (code, endpoint)
+    suggestion = (
+        "Ensure that the host is listening for "
+        "requests and that you're not blocked by network ACLs")
+    return (code, {'error': {
+        'Error': error,
+        'Reason': str(reason),
+        'Code': code,
+        'Suggestion': suggestion}})
+
+
+def connection_error_result(endpoint, reason):
+    """
+    Returns the make_get_request result for a failed connection.
+    """
+    msg = 'Could not connect to remote service: %s' % endpoint
+    suggestion = (
+        "Ensure that the host is listening for "
+        "requests and that you're not blocked by network ACLs")
+    return (-1, {'error': {
+        'Error': msg,
+        'Reason': str(reason),
+        'Suggestion': suggestion}})
+
+
+class RawJSON(str):
+    """
+    A JSON document kept as the bytes it was received as. Sources may
+    return one in place of data to have it stored without being encoded
+    again. index and document hold its section index and decoded form
+    when they are known.
+    """
+
+    index = None
+    document = None
+
+
+def parse_raw_json(body):
+    """
+    Returns body as RawJSON with its section index and decoded document,
+    checking it is valid JSON in the same pass. Raises ValueError if it
+    is not.
+    """
+    document = {}
+    index = build_section_index(body, document)
+    if not index:
+        # Not an object, or an empty one
+        document = json.loads(body)
+    raw = RawJSON(body)
+    raw.index = index
+    raw.document = document
+    return raw
+
+
 def make_get_request(endpoint):
     """
     Shortcut for making get requests.
     """
+    status_code, data = make_raw_get_request(endpoint)
+    if isinstance(data, RawJSON):
+        data = data.document
+    return (status_code, data)
+
+
+def record_upstream(endpoint, started, status_code):
+    """
+    Records the latency of a request to endpoint started at started and
+    whether it failed in metrics.
+    """
+    labels = (('host', urllib.splitport(
+        urllib.splithost(urllib.splittype(endpoint)[1])[0])[0]),)
+    metrics.observe(
+        'talook_upstream_duration_seconds', labels, time.time() - started)
+    if status_code != 200:
+        metrics.inc('talook_upstream_errors_total', labels)
+
+
+def make_raw_get_request(endpoint):
+    """
+    Same as make_get_request but a successful response is returned as
+    RawJSON made by parse_raw_json.
+    """
+    started = time.time()
+    result = _make_raw_get_request(endpoint)
+    record_upstream(endpoint, started, result[0])
+    return result
+
+
+def _make_raw_get_request(endpoint):
+    """
+    Makes the request for make_raw_get_request.
+    """
     result = None
     try:
-        result = urllib2.urlopen(endpoint)
+        result = opener.open(endpoint)
+        body = result.read()
         try:
-            data = json.load(result)
-            return (200, data)
+            return (200, parse_raw_json(body))
         except ValueError, e:
-            msg = "Could not decode json from remote service: %s" % endpoint
-            return (-1, {'error': {'Error': msg}})
+            return decode_error_result(endpoint)
 
     except urllib2.HTTPError, e:
         # Though being an exception (a subclass of URLError), an
@@ -73,16 +787,7 @@ def make_get_request(endpoint):
         #
         # reason >The reason for this error. It can be a message
         # string or another exception instance.
-        error = "Error %d while contacting endpoint: %s." % (
-            e.code, endpoint)
-        suggestion = (
-            "Ensure that the host is listening for "
-            "requests and that you're not blocked by network ACLs")
-        return (e.code, {'error': {
-            'Error': error,
-            'Reason': str(e.msg),
-            'Code': e.code,
-            'Suggestion': suggestion}})
+        return http_error_result(endpoint, e.code, e.msg)
     except urllib2.URLError, e:
         # The reason for this error. It can be a message string or
         # another exception instance (socket.error for remote URLs,
@@ -91,273 +796,3403 @@ def make_get_request(endpoint):
         # reason >The reason for this error. It can be a message
         # string or another exception instance (socket.error for
         # remote URLs, OSError for local URLs).
-        msg = 'Could not connect to remote service: %s' % endpoint
-        suggestion = (
-            "Ensure that the host is listening for "
-            "requests and that you're not blocked by network ACLs")
-        return (-1, {'error': {
-            'Error': msg,
-            'Reason': str(e.reason),
-            'Suggestion': suggestion}})
+        return connection_error_result(endpoint, e.reason)
 
 
-class Router(object):
+def endpoint_address(endpoint):
     """
-    URL Router.
+    Returns the (host, port) an http endpoint connects to.
     """
+    host_port = urllib.splithost(urllib.splittype(endpoint)[1])[0]
+    host, port = urllib.splitport(host_port)
+    return (host, int(port or httplib.HTTP_PORT))
 
-    def __init__(self, rules):
-        """
-        Creates an application URI router.
 
-        rules is a dictionary defining uri: WSGIApplication
-        """
-        self._rules = {}
-        self.logger = create_logger('talook', 'talook_app.log')
-        for uri, app in rules.items():
-            self._rules[uri] = {'app': app, 'regex': re.compile(uri)}
+class AsyncGetRequest(asyncore.dispatcher):
+    """
+    Non-blocking HTTP GET of one endpoint driven by an asyncore loop. Once
+    done result holds the same (code, data) tuple make_raw_get_request
+    returns.
+    """
 
-    def reload(self):
+    def __init__(self, endpoint, socket_map, address=None):
         """
-        Reruns init for all mounted WSGI apps.
+        Creates the request and starts connecting to address, the
+        (ip, port) of the endpoint. Without an address the host name is
+        looked up here, which blocks.
         """
-        self.logger.info('Reloading config')
-        for key, value in self._rules.items():
-            value['app'].__init__()
+        asyncore.dispatcher.__init__(self, map=socket_map)
+        self.endpoint = endpoint
+        self.result = None
+        self.started = time.time()
+        self._received = []
+        scheme, rest = urllib.splittype(endpoint)
+        host_port, path = urllib.splithost(rest)
+        self._outgoing = (
+            'GET %s HTTP/1.0\r\nHost: %s\r\nAccept: application/json\r\n'
+            'Connection: close\r\n\r\n' % (path or '/', host_port))
+        try:
+            self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.connect(address or endpoint_address(endpoint))
+        except socket.error, ex:
+            self.fail(ex)
 
-    def __call__(self, environ, start_response):
+    def fail(self, reason):
         """
-        Callable which handles the actual routing in a WSGI structured way.
+        Finishes the request as a connection error.
         """
-        # If the path exists then pass control to the wsgi application
-        if environ['PATH_INFO'] in self._rules.keys():
-            return self._rules[environ['PATH_INFO']]['app'].__call__(
-                environ, start_response)
+        self.close()
+        if self.result is None:
+            self.result = connection_error_result(self.endpoint, reason)
 
-        # If the path matches the regex then pass control to the wsgi app
-        for uri, data in self._rules.items():
-            # skip '' because it would always match
-            if uri == '':
-                continue
-            if data['regex'].match(environ['PATH_INFO']):
-                kwargs = data['regex'].match(environ['PATH_INFO']).groupdict()
-                return data['app'].__call__(environ, start_response, **kwargs)
+    def handle_connect(self):
+        pass
 
-        # Otherwise 404
-        start_response("404 File Not Found", [("Content-Type", "text/html")])
-        return "404 File Not Found."
+    def writable(self):
+        return not self.connected or bool(self._outgoing)
 
+    def handle_write(self):
+        sent = self.send(self._outgoing)
+        self._outgoing = self._outgoing[sent:]
 
-class BaseHandler(object):
+    def handle_read(self):
+        self._received.append(self.recv(65536))
+
+    def handle_error(self):
+        self.fail(sys.exc_info()[1])
+
+    def handle_close(self):
+        """
+        Parses the complete response once the agent closes the connection.
+        """
+        if self.result is not None:
+            return
+        if not self._received:
+            error = self.socket.getsockopt(
+                socket.SOL_SOCKET, socket.SO_ERROR)
+            self.fail(error and os.strerror(error) or 'Connection closed')
+            return
+        self.close()
+        response = ''.join(self._received)
+        if '\r\n\r\n' not in response:
+            self.result = connection_error_result(
+                self.endpoint, 'Incomplete response')
+            return
+        head, body = response.split('\r\n\r\n', 1)
+        status = head.split('\r\n', 1)[0].split(' ', 2)
+        try:
+            code = int(status[1])
+        except (IndexError, ValueError):
+            self.result = connection_error_result(
+                self.endpoint, 'Invalid response')
+            return
+        if code < 200 or code >= 300:
+            self.result = http_error_result(
+                self.endpoint, code, ' '.join(status[2:]))
+            return
+        try:
+            self.result = (200, parse_raw_json(body))
+        except ValueError:
+            self.result = decode_error_result(self.endpoint)
+
+
+class NameResolver(object):
     """
-    Base handler to be used for app endpoints.
+    Looks up the IPv4 addresses of host names on up to concurrency
+    threads, so lookups never block the thread waiting for them.
     """
 
-    def __init__(self):
+    def __init__(self, names, concurrency):
         """
-        Creates a BaseHandler instance.
+        Starts looking up every name in names. Addresses are passed
+        through as they are.
         """
-        self._conf = json.load(open(os.environ['TALOOK_CONFIG_FILE'], 'r'))
-        self.logger = create_logger('talook', 'talook_app.log')
+        self._names = Queue.Queue()
+        self._resolved = Queue.Queue()
+        self._stopped = threading.Event()
+        lookups = 0
+        for name in names:
+            try:
+                socket.inet_aton(name)
+                self._resolved.put((name, name))
+            except socket.error:
+                self._names.put(name)
+                lookups += 1
+        for count in range(min(concurrency, lookups)):
+            thread = threading.Thread(target=self._run)
+            thread.setDaemon(True)
+            thread.start()
 
-        template_path = os.path.realpath(self._conf['templatedir'])
-        if os.path.isdir(os.path.sep.join([template_path, 'templates'])):
-            self._template_path = os.path.sep.join([os.path.realpath(
-                self._conf['templatedir']), 'templates'])
-            self.logger.warn(
-                'Old style template directory has been deprecated and will be '
-                'rmeoved in a future release. Please define the full path '
-                'including the directory name. Using ' + self._template_path)
+    def _run(self):
+        """
+        Lookup thread loop.
+        """
+        while not self._stopped.isSet():
+            try:
+                name = self._names.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                address = socket.gethostbyname(name)
+            except Exception, ex:
+                address = ex
+            self._resolved.put((name, address))
+
+    def get(self, timeout=0):
+        """
+        Returns (name, address) for a finished lookup, waiting up to
+        timeout seconds for one, or None. address is the exception the
+        lookup failed with if it did.
+        """
+        try:
+            if timeout > 0:
+                return self._resolved.get(True, timeout)
+            return self._resolved.get_nowait()
+        except Queue.Empty:
+            return None
+
+    def stop(self):
+        """
+        Skips the lookups which have not started yet.
+        """
+        self._stopped.set()
+
+
+def make_get_requests(endpoints, concurrency, timeout, deadline,
+                      lookups=16):
+    """
+    Makes get requests to every endpoint in the endpoints dictionary
+    (key: endpoint) from one thread, keeping at most concurrency of them
+    in flight. Requests taking longer than timeout seconds fail. Returns
+    a dictionary of key: make_raw_get_request style result for every
+    request which finished within deadline seconds. Host names are looked
+    up by a NameResolver with up to lookups threads, since a lookup
+    within the loop would stall every request in flight.
+    """
+    socket_map = {}
+    running = {}
+    results = {}
+    end = time.time() + deadline
+    waiting = {}
+    for key, endpoint in endpoints.items():
+        host, port = endpoint_address(endpoint)
+        waiting.setdefault(host, []).append((key, endpoint, port))
+    resolver = NameResolver(waiting.keys(), lookups)
+    pending = []
+    while (waiting or pending or running) and time.time() < end:
+        # Without sockets to wait on wait for a lookup instead
+        wait = 0
+        if waiting and not socket_map and not pending:
+            wait = end - time.time()
+        resolved = resolver.get(wait)
+        while resolved is not None:
+            host, address = resolved
+            for key, endpoint, port in waiting.pop(host):
+                if isinstance(address, Exception):
+                    results[key] = connection_error_result(endpoint, address)
+                    record_upstream(endpoint, time.time(), results[key][0])
+                else:
+                    pending.append((key, endpoint, (address, port)))
+            resolved = resolver.get()
+
+        while pending and len(running) < concurrency:
+            key, endpoint, address = pending.pop(0)
+            running[key] = AsyncGetRequest(endpoint, socket_map, address)
+
+        if socket_map:
+            # Poll often enough to start requests as their names resolve
+            asyncore.loop(
+                timeout=max(0, min(waiting and 0.05 or 0.5,
+                                   end - time.time())),
+                use_poll=True, map=socket_map, count=1)
+
+        now = time.time()
+        for key, request in running.items():
+            if request.result is None and now - request.started > timeout:
+                request.fail('timed out')
+            if request.result is not None:
+                record_upstream(
+                    request.endpoint, request.started, request.result[0])
+                results[key] = request.result
+                del running[key]
+
+    resolver.stop()
+    for request in running.values():
+        request.close()
+    return results
+
+
+def make_etag(data):
+    """
+    Returns a strong entity tag for data.
+    """
+    return '"%s"' % md5(data).hexdigest()
+
+
+def variant_etag(etag, sections=(), gzipped=False):
+    """
+    Returns the entity tag of the representation of the entity tagged etag
+    holding only sections (all if empty), gzip compressed if gzipped.
+    """
+    tag = etag[:-1]
+    if sections:
+        tag += '-' + md5(','.join(sorted(set(sections)))).hexdigest()[:8]
+    if gzipped:
+        tag += '-gzip'
+    return tag + '"'
+
+
+#: Whitespace allowed between JSON tokens
+_json_whitespace = re.compile(r'[ \t\n\r]*')
+
+
+def build_section_index(body, members=None):
+    """
+    Returns a dictionary of name: (start, end) locating the value of every
+    top level member of the serialized JSON object body, so single members
+    can be sliced out without decoding the rest. Returns an empty
+    dictionary if body is not an object. Raises ValueError if body is not
+    valid JSON. If members is a dictionary the decoded value of every
+    member is stored in it.
+    """
+    decoder = json.JSONDecoder()
+    skip = lambda position: _json_whitespace.match(body, position).end()
+    index = {}
+    position = skip(0)
+    if body[position:position + 1] != '{':
+        return index
+    position = skip(position + 1)
+    if body[position:position + 1] == '}':
+        if skip(position + 1) != len(body):
+            raise ValueError('Extra data at %d' % (position + 1))
+        return index
+    while True:
+        name, position = decoder.raw_decode(body, position)
+        if not isinstance(name, basestring):
+            raise ValueError('Expecting property name at %d' % position)
+        position = skip(position)
+        if body[position:position + 1] != ':':
+            raise ValueError('Expecting : delimiter at %d' % position)
+        start = skip(position + 1)
+        value, end = decoder.raw_decode(body, start)
+        index[name] = (start, end)
+        if members is not None:
+            members[name] = value
+        position = skip(end)
+        if body[position:position + 1] == '}':
+            if skip(position + 1) != len(body):
+                raise ValueError('Extra data at %d' % (position + 1))
+            return index
+        if body[position:position + 1] != ',':
+            raise ValueError('Expecting , delimiter at %d' % position)
+        position = skip(position + 1)
+
+
+def select_sections(body, index, paths):
+    """
+    Returns the serialized JSON object holding only the parts of body
+    named by paths. A path is a top level member name, optionally followed
+    by dotted names of members within it. Whole members are copied from
+    body as is using its section index, only members selected by a longer
+    path are decoded. Missing parts are left out.
+    """
+    selected = {}
+    for path in paths:
+        parts = path.split('.')
+        if parts[0] not in index:
+            continue
+        if len(parts) == 1:
+            selected[parts[0]] = None
+        elif selected.get(parts[0], {}) is not None:
+            selected.setdefault(parts[0], {})[tuple(parts[1:])] = None
+
+    chunks = []
+    for name in sorted(selected.keys()):
+        start, end = index[name]
+        if selected[name] is None:
+            value = body[start:end]
+        else:
+            section = json.loads(body[start:end])
+            value = {}
+            for parts in selected[name].keys():
+                found = section
+                for part in parts:
+                    if not isinstance(found, dict) or part not in found:
+                        break
+                    found = found[part]
+                else:
+                    target = value
+                    for part in parts[:-1]:
+                        target = target.setdefault(part, {})
+                    target[parts[-1]] = found
+            value = json.dumps(value)
+        chunks.append('%s: %s' % (json.dumps(name), value))
+    return '{' + ', '.join(chunks) + '}'
+
+
+def diff_documents(old, new, path=()):
+    """
+    Returns (set, delete) turning the decoded JSON document old into new.
+    set is a list of [path, value] pairs and delete a list of paths, where
+    a path is the list of object member names leading to a value, both
+    sorted by path. Objects are compared member by member, anything else
+    is replaced whole. Members which compare equal are not looked into,
+    so a change between values Python holds equal, such as 1 and true,
+    is only seen where it is the member itself.
+    """
+    if not isinstance(old, dict) or not isinstance(new, dict):
+        if old != new or isinstance(old, bool) != isinstance(new, bool):
+            return ([[list(path), new]], [])
+        return ([], [])
+    changed, deleted = [], []
+    for key, value in new.items():
+        if key not in old:
+            changed.append([list(path + (key,)), value])
+        elif old[key] != value or \
+                isinstance(old[key], bool) != isinstance(value, bool):
+            more = diff_documents(old[key], value, path + (key,))
+            changed.extend(more[0])
+            deleted.extend(more[1])
+    for key in old:
+        if key not in new:
+            deleted.append(list(path + (key,)))
+    if not path:
+        changed.sort(key=lambda change: change[0])
+        deleted.sort()
+    return (changed, deleted)
+
+
+def apply_changes(document, changed, deleted):
+    """
+    Returns document with the changes from diff_documents applied. Objects
+    in document are modified in place.
+    """
+    for path in deleted:
+        target = document
+        for part in path[:-1]:
+            target = target[part]
+        del target[path[-1]]
+    for path, value in changed:
+        if not path:
+            document = value
+            continue
+        target = document
+        for part in path[:-1]:
+            target = target.setdefault(part, {})
+        target[path[-1]] = value
+    return document
+
+
+def same_token(given, expected):
+    """
+    Returns True if the token given equals expected, taking the same time
+    wherever they differ.
+    """
+    if len(given) != len(expected):
+        return False
+    difference = 0
+    for x, y in zip(given, expected):
+        difference |= ord(x) ^ ord(y)
+    return difference == 0
+
+
+def gzip_compress(data, level=6):
+    """
+    Returns data gzip compressed at level.
+    """
+    buffer = StringIO()
+    f = gzip.GzipFile(mode='wb', compresslevel=level, fileobj=buffer)
+    f.write(data)
+    f.close()
+    return buffer.getvalue()
+
+
+def accepts_gzip(environ):
+    """
+    Returns True if the request's Accept-Encoding allows gzip.
+    """
+    for coding in environ.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        params = coding.split(';')
+        if params[0].strip().lower() not in ('gzip', '*'):
+            continue
+        for param in params[1:]:
+            name, value = (param.split('=', 1) + [''])[:2]
+            if name.strip() == 'q':
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+
+def run_concurrently(jobs, concurrency, deadline):
+    """
+    Runs the callables in the jobs dictionary (key: callable) using at most
+    concurrency threads. Returns a dictionary of key: result for every job
+    which finished within deadline seconds. Jobs which raise have the
+    exception instance as their result.
+    """
+    pending = Queue.Queue()
+    for key, job in jobs.items():
+        pending.put((key, job))
+
+    results = {}
+    finished = threading.Condition()
+    expired = threading.Event()
+
+    def worker():
+        while not expired.isSet():
+            try:
+                key, job = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                result = job()
+            except Exception, ex:
+                result = ex
+            finished.acquire()
+            try:
+                results[key] = result
+                finished.notify()
+            finally:
+                finished.release()
+
+    for count in range(min(concurrency, len(jobs))):
+        thread = threading.Thread(target=worker)
+        thread.setDaemon(True)
+        thread.start()
+
+    end = time.time() + deadline
+    finished.acquire()
+    try:
+        while len(results) < len(jobs):
+            remaining = end - time.time()
+            if remaining <= 0:
+                break
+            finished.wait(remaining)
+        # Anything still queued is not worth starting any longer
+        expired.set()
+        return results.copy()
+    finally:
+        finished.release()
+
+
+class CacheEntry(object):
+    """
+    A cached, already serialized, JSON document.
+    """
+
+    def __init__(self, body, created, expires, gzipped=None, etag=None,
+                 index=None):
+        """
+        Creates a CacheEntry. created and expires are epoch seconds.
+        gzipped is the gzip compressed body if there is one, etag the
+        entity tag of body and index its build_section_index result.
+        """
+        self.body = body
+        self.created = created
+        self.expires = expires
+        self.gzipped = gzipped
+        self.etag = etag
+        self.index = index
+        self.size = len(body) + len(gzipped or '')
+        #: True when served past its expiration time
+        self.stale = False
+
+    def is_expired(self, now=None, max_stale=0):
+        """
+        Returns True if the entry has passed its expiration time plus
+        max_stale seconds.
+        """
+        if now is None:
+            now = time.time()
+        return now >= self.expires + max_stale
+
+    def as_stale(self):
+        """
+        Returns a copy of the entry flagged as stale.
+        """
+        entry = CacheEntry(
+            self.body, self.created, self.expires, self.gzipped, self.etag,
+            self.index)
+        entry.stale = True
+        return entry
+
+
+class MemoryCache(object):
+    """
+    Thread safe in memory LRU cache of CacheEntry instances bounded by
+    both the number of entries and their total size in bytes.
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=67108864):
+        """
+        Creates an empty MemoryCache.
+        """
+        self._lock = threading.Lock()
+        # Doubly linked list of [previous, next, key, entry] nodes with the
+        # most recently used node right after the root.
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None]
+        self._nodes = {}
+        self._bytes = 0
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def configure(self, max_entries, max_bytes):
+        """
+        Changes the limits of the cache, evicting entries if needed.
+        """
+        self._lock.acquire()
+        try:
+            self.max_entries = max_entries
+            self.max_bytes = max_bytes
+            self._evict()
+        finally:
+            self._lock.release()
+
+    def _unlink(self, node):
+        """
+        Removes a node from the linked list. Caller must hold the lock.
+        """
+        node[0][1] = node[1]
+        node[1][0] = node[0]
+
+    def _link(self, node):
+        """
+        Inserts a node as the most recently used. Caller must hold the lock.
+        """
+        node[0] = self._root
+        node[1] = self._root[1]
+        self._root[1][0] = node
+        self._root[1] = node
+
+    def _remove(self, node):
+        """
+        Drops a node from the cache. Caller must hold the lock.
+        """
+        self._unlink(node)
+        del self._nodes[node[2]]
+        self._bytes -= node[3].size
+
+    def _evict(self):
+        """
+        Drops least recently used entries until the cache is within its
+        limits. Caller must hold the lock.
+        """
+        while self._nodes and (len(self._nodes) > self.max_entries or
+                               self._bytes > self.max_bytes):
+            self._remove(self._root[0])
+            self.evictions += 1
+
+    def get(self, key, max_stale=0):
+        """
+        Returns the entry for key or None if it is missing or has been
+        expired for more than max_stale seconds.
+        """
+        self._lock.acquire()
+        try:
+            node = self._nodes.get(key)
+            if node is None or node[3].is_expired(max_stale=max_stale):
+                self.misses += 1
+                return None
+            self._unlink(node)
+            self._link(node)
+            self.hits += 1
+            return node[3]
+        finally:
+            self._lock.release()
+
+    def has(self, key):
+        """
+        Returns True if an unexpired entry for key is held, without
+        counting it as a lookup.
+        """
+        node = self._nodes.get(key)
+        return node is not None and not node[3].is_expired()
+
+    def set(self, key, entry):
+        """
+        Stores entry under key as the most recently used entry. Entries
+        larger than the cache itself are not stored.
+        """
+        self._lock.acquire()
+        try:
+            node = self._nodes.get(key)
+            if node is not None:
+                self._remove(node)
+            if entry.size > self.max_bytes or self.max_entries < 1:
+                return
+            node = [None, None, key, entry]
+            self._link(node)
+            self._nodes[key] = node
+            self._bytes += entry.size
+            self._evict()
+        finally:
+            self._lock.release()
+
+    def delete(self, key):
+        """
+        Removes key from the cache if it is present.
+        """
+        self._lock.acquire()
+        try:
+            node = self._nodes.get(key)
+            if node is not None:
+                self._remove(node)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """
+        Removes every entry from the cache.
+        """
+        self._lock.acquire()
+        try:
+            self._root[:] = [self._root, self._root, None, None]
+            self._nodes = {}
+            self._bytes = 0
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        """
+        Returns a dictionary of cache statistics.
+        """
+        self._lock.acquire()
+        try:
+            return {
+                'entries': len(self._nodes),
+                'bytes': self._bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+        finally:
+            self._lock.release()
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls for the same key so only one of them runs
+    and the rest wait for and share its result.
+    """
+
+    def __init__(self):
+        """
+        Creates a SingleFlight instance.
+        """
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func):
+        """
+        Runs func unless a call for key is already running, in which case
+        that call's result is returned (or its exception raised) instead.
+        """
+        self._lock.acquire()
+        try:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = {'done': threading.Event()}
+                self._calls[key] = call
+        finally:
+            self._lock.release()
+
+        if not leader:
+            call['done'].wait()
+            if 'error' in call:
+                raise call['error']
+            return call['result']
+
+        try:
+            try:
+                call['result'] = func()
+                return call['result']
+            except Exception, ex:
+                call['error'] = ex
+                raise
+        finally:
+            self._lock.acquire()
+            try:
+                del self._calls[key]
+            finally:
+                self._lock.release()
+            call['done'].set()
+
+
+class BackgroundRefresher(object):
+    """
+    Runs refreshes of cache keys on a fixed pool of threads threads. A key
+    is refreshed at most once at a time, and when max_queued refreshes are
+    waiting further ones are dropped.
+    """
+
+    def __init__(self, threads=4, max_queued=1000):
+        """
+        Creates a BackgroundRefresher. The threads are started by the first
+        refresh.
+        """
+        self.threads = threads
+        self.max_queued = max_queued
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._keys = set()
+        self._queue = None
+
+    def submit(self, key, func):
+        """
+        Queues func to refresh key unless a refresh of key is already
+        queued or running. Returns True if it was queued.
+        """
+        self._lock.acquire()
+        try:
+            if key in self._keys:
+                return False
+            if self._queue is None:
+                self._queue = Queue.Queue(self.max_queued)
+                for count in range(self.threads):
+                    thread = threading.Thread(
+                        target=self._run, args=(self._queue,))
+                    thread.setDaemon(True)
+                    thread.start()
+            try:
+                self._queue.put_nowait((key, func))
+            except Queue.Full:
+                self.dropped += 1
+                return False
+            self._keys.add(key)
+            return True
+        finally:
+            self._lock.release()
+
+    def _run(self, queue):
+        """
+        Refresh thread loop.
+        """
+        while True:
+            key, func = queue.get()
+            try:
+                try:
+                    func()
+                except Exception, ex:
+                    create_logger('talook', 'talook_app.log').error(
+                        'Refreshing "%s" failed: %s' % (key, ex))
+            finally:
+                self._lock.acquire()
+                try:
+                    self._keys.discard(key)
+                finally:
+                    self._lock.release()
+
+    def after_fork(self):
+        """
+        Forgets the parent's refresh threads in a forked child.
+        """
+        self._lock = threading.Lock()
+        self._keys = set()
+        self._queue = None
+
+
+class CircuitBreaker(object):
+    """
+    Thread safe per key circuit breaker for upstream calls. After failures
+    consecutive failures a key's circuit opens and calls are refused for
+    backoff seconds, doubling after every failed probe up to max_backoff.
+    Once the backoff has passed a single call is let through as a probe
+    and a success closes the circuit again.
+    """
+
+    def __init__(self, failures=3, backoff=10, max_backoff=300):
+        """
+        Creates a CircuitBreaker with every circuit closed. failures of 0
+        never opens a circuit.
+        """
+        self._lock = threading.Lock()
+        # key: [consecutive failures, times opened, retry at]
+        self._circuits = {}
+        self.failures = failures
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def configure(self, failures, backoff, max_backoff):
+        """
+        Changes the thresholds of the breaker. Open circuits stay open.
+        """
+        self._lock.acquire()
+        try:
+            self.failures = failures
+            self.backoff = backoff
+            self.max_backoff = max_backoff
+        finally:
+            self._lock.release()
+
+    def _backoff(self, opened):
+        """
+        Returns the backoff after a circuit opened opened times. Caller
+        must hold the lock.
+        """
+        return min(self.max_backoff, self.backoff * 2 ** min(opened - 1, 30))
+
+    def allow(self, key, now=None):
+        """
+        Returns True if a call for key may be made. When the circuit is
+        open only the first caller after the backoff is allowed, as the
+        probe.
+        """
+        if now is None:
+            now = time.time()
+        self._lock.acquire()
+        try:
+            circuit = self._circuits.get(key)
+            if circuit is None or not circuit[1]:
+                return True
+            if now < circuit[2]:
+                return False
+            # Refuse everyone else while the probe runs. If the probe
+            # never reports back another is let through after the backoff.
+            circuit[2] = now + self._backoff(circuit[1])
+            return True
+        finally:
+            self._lock.release()
+
+    def success(self, key):
+        """
+        Records a successful call for key, closing its circuit.
+        """
+        self._lock.acquire()
+        try:
+            self._circuits.pop(key, None)
+        finally:
+            self._lock.release()
+
+    def failure(self, key, now=None):
+        """
+        Records a failed call for key, opening its circuit once there have
+        been enough consecutive failures.
+        """
+        if now is None:
+            now = time.time()
+        self._lock.acquire()
+        try:
+            circuit = self._circuits.setdefault(key, [0, 0, 0])
+            circuit[0] += 1
+            if circuit[1] or (self.failures and circuit[0] >= self.failures):
+                circuit[1] += 1
+                circuit[2] = now + self._backoff(circuit[1])
+        finally:
+            self._lock.release()
+
+    def reset(self, key):
+        """
+        Forgets everything recorded for key.
+        """
+        self.success(key)
+
+    def open_keys(self):
+        """
+        Returns a sorted list of keys whose circuits are open.
+        """
+        self._lock.acquire()
+        try:
+            keys = [key for key, circuit in self._circuits.items()
+                    if circuit[1]]
+        finally:
+            self._lock.release()
+        keys.sort()
+        return keys
+
+
+class Popularity(object):
+    """
+    Counts requests per key with exponential decay so recent requests
+    weigh more than old ones.
+    """
+
+    def __init__(self, half_life=600):
+        """
+        Creates a Popularity instance in which a request counts half as
+        much after half_life seconds.
+        """
+        self.half_life = float(half_life)
+        self._lock = threading.Lock()
+        self._scores = {}
+
+    def _decay(self, score, since, now):
+        return score * 0.5 ** (max(now - since, 0) / self.half_life)
+
+    def hit(self, key, now=None):
+        """
+        Counts a request for key.
+        """
+        if now is None:
+            now = time.time()
+        self._lock.acquire()
+        try:
+            score, since = self._scores.get(key, (0, now))
+            self._scores[key] = (self._decay(score, since, now) + 1, now)
+        finally:
+            self._lock.release()
+
+    def score(self, key, now=None):
+        """
+        Returns the decayed request count of key.
+        """
+        if now is None:
+            now = time.time()
+        counted = self._scores.get(key)
+        if counted is None:
+            return 0
+        return self._decay(counted[0], counted[1], now)
+
+    def forget(self, keys):
+        """
+        Drops the counts of keys.
+        """
+        self._lock.acquire()
+        try:
+            for key in keys:
+                self._scores.pop(key, None)
+        finally:
+            self._lock.release()
+
+
+class HistoryStore(object):
+    """
+    Append only history of the JSON documents saved for each key, kept in
+    a directory per key. Every segment file starts with a keyframe holding
+    the whole document, followed by what changed in each later version,
+    one JSON record per line. A new segment is started after deltas
+    changes. Only the newest segments segments are kept, and segments
+    which ended more than keep seconds ago are dropped (0 keeps them all).
+    """
+
+    #: Keys whose newest version is kept in memory to diff against
+    max_remembered = 1000
+
+    def __init__(self, directory=None, deltas=100, segments=10, keep=0):
+        """
+        Creates a HistoryStore writing below directory. With no directory
+        nothing is recorded.
+        """
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._last = {}
+        self.configure(directory, deltas, segments, keep)
+
+    def configure(self, directory, deltas, segments, keep):
+        """
+        Changes where and how much history is kept.
+        """
+        if directory != getattr(self, 'directory', None):
+            self._last = {}
+        self.directory = directory
+        self.deltas = deltas
+        self.segments = segments
+        self.keep = keep
+
+    def _key_dir(self, key):
+        return os.path.sep.join([self.directory, key])
+
+    def _segment_name(self, key, start):
+        return os.path.sep.join([self._key_dir(key), '%013d.jsonl' % start])
+
+    def list_segments(self, key):
+        """
+        Returns the start times of the segments of key in milliseconds,
+        oldest first.
+        """
+        try:
+            names = os.listdir(self._key_dir(key))
+        except OSError:
+            return []
+        starts = []
+        for name in names:
+            if name.endswith('.jsonl'):
+                try:
+                    starts.append(int(name[:-len('.jsonl')]))
+                except ValueError:
+                    pass
+        starts.sort()
+        return starts
+
+    def _records(self, key, start):
+        """
+        Yields the records of a segment one line at a time.
+        """
+        try:
+            f = open(self._segment_name(key, start), 'rb')
+        except IOError:
+            return
+        try:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # A write cut short
+                    continue
+        finally:
+            f.close()
+
+    def _replay(self, key, start, until=None):
+        """
+        Rebuilds the newest version in a segment no newer than epoch
+        seconds until. Returns (time, document, count) where count is the
+        number of versions read, or time and document are None if there
+        is none.
+        """
+        found, document, count = None, None, 0
+        for record in self._records(key, start):
+            if until is not None and record['t'] > until:
+                break
+            if 'doc' in record:
+                document = record['doc']
+            elif document is None:
+                continue
+            else:
+                document = apply_changes(
+                    document, record['set'], record['del'])
+            found = record['t']
+            count += 1
+        return (found, document, count)
+
+    def record(self, key, document, now=None):
+        """
+        Adds the decoded JSON document as the newest version of key if it
+        differs from the last one.
+        """
+        if self.directory is None:
+            return
+        if now is None:
+            now = time.time()
+        self._lock.acquire()
+        try:
+            key_lock = self._key_locks.get(key)
+            if key_lock is None:
+                key_lock = self._key_locks[key] = threading.Lock()
+        finally:
+            self._lock.release()
+
+        key_lock.acquire()
+        try:
+            key_dir = self._key_dir(key)
+            if not os.path.isdir(key_dir):
+                os.makedirs(key_dir)
+            lock_file = open(os.path.sep.join([key_dir, '.lock']), 'a')
+            try:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                self._append(key, document, now)
+            finally:
+                lock_file.close()
+        finally:
+            key_lock.release()
+
+    def _get_last(self, key):
+        """
+        Returns (starts, document, count) for the newest segment of key:
+        the start times of every segment, the newest version and the number
+        of versions in the newest segment. The version remembered from the
+        last write is used unless another process has appended to the
+        newest segment or started a newer one since.
+        """
+        starts = self.list_segments(key)
+        if not starts:
+            return (starts, None, 0)
+        remembered = self._last.get(key)
+        if remembered is not None:
+            start, size, document, count = remembered
+            try:
+                if start == starts[-1] and os.path.getsize(
+                        self._segment_name(key, start)) == size:
+                    return (starts, document, count)
+            except OSError:
+                pass
+        return (starts,) + self._replay(key, starts[-1])[1:]
+
+    def _append(self, key, document, now):
+        starts, last, count = self._get_last(key)
+        if last is None:
+            changed, deleted = diff_documents({}, document)
+        else:
+            changed, deleted = diff_documents(last, document)
+            if not changed and not deleted:
+                return
+        # Times are whole milliseconds, which segments are named after
+        stamp = int(now * 1000)
+        record = {'set': changed, 'del': deleted}
+        if last is None or count > self.deltas:
+            if starts and stamp <= starts[-1]:
+                stamp = starts[-1] + 1
+            record['doc'] = document
+            starts.append(stamp)
+            self._prune(key, starts, now)
+            count = 1
+        else:
+            count += 1
+        record['t'] = stamp / 1000.0
+        segment_name = self._segment_name(key, starts[-1])
+        f = open(segment_name, 'ab')
+        try:
+            f.write(json.dumps(record) + '\n')
+        finally:
+            f.close()
+
+        self._lock.acquire()
+        try:
+            if key not in self._last and \
+                    len(self._last) >= self.max_remembered:
+                self._last.popitem()
+            self._last[key] = (
+                starts[-1], os.path.getsize(segment_name), document, count)
+        finally:
+            self._lock.release()
+
+    def _prune(self, key, starts, now):
+        """
+        Removes the oldest segments beyond the retention limits from starts
+        and the key's directory. The newest segment is always kept.
+        """
+        drop = max(len(starts) - max(self.segments, 1), 0)
+        if self.keep:
+            while drop < len(starts) - 1 and \
+                    starts[drop + 1] <= (now - self.keep) * 1000:
+                drop += 1
+        for start in starts[:drop]:
+            try:
+                os.unlink(self._segment_name(key, start))
+            except OSError:
+                pass
+        del starts[:drop]
+
+    def snapshot(self, key, at):
+        """
+        Returns (time, document) of the version of key current at epoch
+        seconds at, or None if there was none. Only the segment holding it
+        is read.
+        """
+        starts = self.list_segments(key)
+        position = bisect.bisect_right(starts, at * 1000) - 1
+        if position < 0:
+            return None
+        found, document = self._replay(key, starts[position], at)[:2]
+        if found is None:
+            return None
+        return (found, document)
+
+    def changes(self, key, since):
+        """
+        Yields a dictionary with the time and set and delete changes of
+        every version of key newer than epoch seconds since. Segments
+        which ended before since are not read.
+        """
+        starts = self.list_segments(key)
+        for position in range(len(starts)):
+            if position + 1 < len(starts) and \
+                    starts[position + 1] <= since * 1000:
+                continue
+            for record in self._records(key, starts[position]):
+                if record['t'] > since:
+                    yield {
+                        'time': record['t'], 'set': record['set'],
+                        'delete': record['del']}
+
+    def remove(self, key):
+        """
+        Drops the whole history of key.
+        """
+        if self.directory is None:
+            return
+        self._last.pop(key, None)
+        key_dir = self._key_dir(key)
+        try:
+            names = os.listdir(key_dir)
+        except OSError:
+            return
+        for name in names:
+            try:
+                os.unlink(os.path.sep.join([key_dir, name]))
+            except OSError:
+                pass
+        try:
+            os.rmdir(key_dir)
+        except OSError:
+            pass
+
+
+class FactIndex(object):
+    """
+    Inverted index of the facts in the JSON documents saved for each key,
+    mapping a fact's dotted path and value to the keys having it. Values
+    are indexed as strings, JSON encoded unless they are strings, and each
+    item of a list is indexed under the path of the list.
+    """
+
+    def __init__(self, enabled=False, sections=()):
+        """
+        Creates a FactIndex. Only the top level sections named in sections
+        are indexed, or every one if it is empty.
+        """
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self.enabled = False
+        self.sections = ()
+        self._postings = {}
+        self._facts = {}
+        self._mtimes = {}
+        self._synced = None
+        self._sync_args = None
+        self._sync_pid = None
+        self._wake = threading.Event()
+        self.configure(enabled, sections)
+
+    def configure(self, enabled, sections):
+        """
+        Changes whether and which sections are indexed. The index is
+        emptied when that changes.
+        """
+        sections = tuple(sections or ())
+        if (enabled, sections) == (self.enabled, self.sections):
+            return
+        self._lock.acquire()
+        try:
+            self.enabled = enabled
+            self.sections = sections
+            self._postings, self._facts, self._mtimes = {}, {}, {}
+            self._synced = None
+        finally:
+            self._lock.release()
+        self._wake.set()
+
+    def _flatten(self, value, path, facts):
+        if isinstance(value, dict):
+            for name, item in value.items():
+                self._flatten(item, path + '.' + name, facts)
+        elif isinstance(value, list):
+            for item in value:
+                self._flatten(item, path, facts)
+        else:
+            if not isinstance(value, basestring):
+                value = json.dumps(value)
+            facts.setdefault(path, set()).add(value)
+
+    def update(self, key, document, mtime=None):
+        """
+        Indexes document as the current version of key, replacing what was
+        indexed for key before. mtime is when the document was saved.
+        """
+        if not self.enabled:
+            return
+        facts = {}
+        if isinstance(document, dict):
+            for name, value in document.items():
+                if not self.sections or name in self.sections:
+                    self._flatten(value, name, facts)
+        self._lock.acquire()
+        try:
+            self._remove(key)
+            for path, values in facts.items():
+                postings = self._postings.setdefault(path, {})
+                for value in values:
+                    postings.setdefault(value, set()).add(key)
+            self._facts[key] = facts
+            self._mtimes[key] = mtime
+        finally:
+            self._lock.release()
+
+    def remove(self, key):
+        """
+        Drops key from the index.
+        """
+        self._lock.acquire()
+        try:
+            self._remove(key)
+        finally:
+            self._lock.release()
+
+    def _remove(self, key):
+        facts = self._facts.pop(key, {})
+        self._mtimes.pop(key, None)
+        for path, values in facts.items():
+            postings = self._postings[path]
+            for value in values:
+                postings[value].discard(key)
+                if not postings[value]:
+                    del postings[value]
+            if not postings:
+                del self._postings[path]
+
+    def search(self, path, value=None, keys=None):
+        """
+        Returns a dictionary of value: sorted keys for the keys having the
+        fact path, only for value if given and only for keys in keys if
+        given.
+        """
+        self._lock.acquire()
+        try:
+            postings = self._postings.get(path, {})
+            if value is not None:
+                postings = {value: postings.get(value, ())}
+            found = {}
+            for value, having in postings.items():
+                if keys is not None:
+                    having = [key for key in having if key in keys]
+                if having:
+                    found[value] = sorted(having)
+            return found
+        finally:
+            self._lock.release()
+
+    def sync(self, directory, keys):
+        """
+        Brings the index in line with the cache entries of keys in
+        directory, which other processes may have written. Entries are
+        only read when they changed since they were indexed.
+        """
+        if not self.enabled:
+            return
+        started = time.time()
+        for key in set(self._facts.keys()) - set(keys):
+            self.remove(key)
+        for key in keys:
+            cache_name = os.path.sep.join([directory, key + '.json'])
+            try:
+                mtime = os.stat(cache_name).st_mtime
+            except OSError:
+                if key in self._facts:
+                    self.remove(key)
+                continue
+            if self._mtimes.get(key) == mtime:
+                continue
+            try:
+                f = open(cache_name, 'rb')
+                try:
+                    document = json.load(f)
+                finally:
+                    f.close()
+            except (IOError, ValueError):
+                continue
+            self.update(key, document, mtime)
+        self._synced = started
+
+    def synced(self):
+        """
+        Returns True once the index has been synced with the cache
+        directory since it was last emptied.
+        """
+        return self._synced is not None
+
+    def start_sync(self, directory, keys, interval):
+        """
+        Syncs the index with the cache entries of keys in directory from a
+        background thread of this process every interval seconds, starting
+        now. Calling it again only changes what is synced.
+        """
+        self._sync_args = (directory, keys, interval)
+        if self._sync_pid == os.getpid():
+            return
+        self._sync_lock.acquire()
+        try:
+            if self._sync_pid == os.getpid():
+                return
+            self._sync_pid = os.getpid()
+            thread = threading.Thread(target=self._sync_forever)
+            thread.setDaemon(True)
+            thread.start()
+        finally:
+            self._sync_lock.release()
+
+    def _sync_forever(self):
+        """
+        Sync thread loop. Emptying the index wakes it up early.
+        """
+        while True:
+            self._wake.clear()
+            directory, keys, interval = self._sync_args
+            try:
+                self.sync(directory, keys)
+            except Exception, ex:
+                create_logger('talook', 'talook_app.log').error(
+                    'Syncing the fact index failed: %s' % ex)
+            self._wake.wait(max(interval, 1))
+
+
+class TemplateCache(object):
+    """
+    Thread safe cache of parsed templates and their rendered output.
+    Templates are parsed once into literal and placeholder segments and
+    reparsed when their mtime changes.
+    """
+
+    _placeholder = re.compile('{{- (.+?) -}}')
+
+    def __init__(self, max_rendered=100):
+        """
+        Creates an empty TemplateCache remembering up to max_rendered
+        rendered outputs.
+        """
+        self._lock = threading.Lock()
+        self._templates = {}
+        self._rendered = {}
+        self.max_rendered = max_rendered
+
+    def render(self, path, kwargs):
+        """
+        Renders the template at path replacing {{- key -}} placeholders
+        with the values in kwargs. Unknown placeholders are left alone.
+        """
+        mtime = os.stat(path).st_mtime
+        items = kwargs.items()
+        items.sort()
+        key = (path, mtime, tuple(items))
+        rendered = self._rendered.get(key)
+        if rendered is not None:
+            return rendered
+
+        template = self._templates.get(path)
+        if template is None or template[0] != mtime:
+            # Odd indexes hold placeholder names, even ones literal text
+            template = (mtime, self._placeholder.split(
+                open(path, 'r').read()))
+        segments = list(template[1])
+        for index in range(1, len(segments), 2):
+            name = segments[index]
+            if name in kwargs:
+                segments[index] = kwargs[name]
+            else:
+                segments[index] = '{{- ' + name + ' -}}'
+        rendered = ''.join(segments)
+
+        self._lock.acquire()
+        try:
+            self._templates[path] = template
+            if len(self._rendered) >= self.max_rendered:
+                self._rendered.clear()
+            self._rendered[key] = rendered
+        finally:
+            self._lock.release()
+        return rendered
+
+    def clear(self):
+        """
+        Forgets every template and rendered output.
+        """
+        self._lock.acquire()
+        try:
+            self._templates = {}
+            self._rendered = {}
+        finally:
+            self._lock.release()
+
+
+#: Parsed templates shared by all handlers in the process
+template_cache = TemplateCache()
+
+#: Memory cache shared by all handlers in the process
+memory_cache = MemoryCache()
+
+#: Recent upstream failures, kept apart so they never displace good data
+negative_cache = MemoryCache()
+
+#: Upstream circuits of every key within the process
+circuit_breaker = CircuitBreaker()
+
+#: Coalesces upstream fetches for the same key within the process
+single_flight = SingleFlight()
+
+#: Recent requests per host, used to warm the cache for busy hosts first
+host_popularity = Popularity()
+
+#: Past versions of the stats of every host
+history_store = HistoryStore()
+
+#: Hosts by the facts in their stats
+fact_index = FactIndex()
+
+#: Refreshes stale entries in the background
+background_refresher = BackgroundRefresher()
+
+
+def timedelta_seconds(delta):
+    """
+    Returns the total number of seconds in a datetime.timedelta.
+    """
+    return (delta.days * 86400 + delta.seconds +
+            delta.microseconds / 1000000.0)
+
+
+class Config(object):
+    """
+    Immutable snapshot of a parsed configuration file along with values
+    derived from it. Snapshots are shared by every handler so conf must
+    never be modified.
+    """
+
+    def __init__(self, path):
+        """
+        Parses the configuration file at path. Raises ValueError if it is
+        not valid JSON.
+        """
+        f = open(path, 'r')
+        try:
+            conf = json.load(f)
+        finally:
+            f.close()
+        assign = lambda name, value: object.__setattr__(self, name, value)
+
+        assign('path', path)
+        assign('mtime', os.stat(path).st_mtime)
+        assign('conf', conf)
+        assign('logdir', os.path.realpath(conf['logdir']))
+
+        template_path = os.path.realpath(conf['templatedir'])
+        assign('old_template_path', os.path.isdir(
+            os.path.sep.join([template_path, 'templates'])))
+        if self.old_template_path:
+            template_path = os.path.sep.join([template_path, 'templates'])
+        assign('template_path', template_path)
+
+        try:
+            assign('cache_dir', os.path.realpath(conf['cachedir']))
+            assign('cache_time', datetime.timedelta(**conf['cachetime']))
+            assign('cache', True)
+        except KeyError:
+            assign('cache', False)
+        cache_time = datetime.timedelta(**conf.get('cachetime', {}))
+        assign('cache_seconds', timedelta_seconds(cache_time))
+        assign('cache_stale_seconds', timedelta_seconds(
+            datetime.timedelta(**conf.get('cachestale', {}))))
+        assign('static_seconds', int(timedelta_seconds(
+            datetime.timedelta(**conf.get('statictime', {'hours': 1})))))
+        assign('error_seconds', timedelta_seconds(
+            datetime.timedelta(**conf.get('errortime', {'seconds': 10}))))
+
+        assign('extranotes', str(conf.get('extranotes', '')))
+        assign('timeout', int(conf.get('timeout', 5)))
+
+        memcache = conf.get('memcache', {})
+        assign('memcache_entries', int(memcache.get('entries', 1000)))
+        assign('memcache_bytes', int(memcache.get('bytes', 67108864)))
+
+        keepalive = conf.get('keepalive', {})
+        assign('keepalive_per_host', int(keepalive.get('perhost', 2)))
+        assign('keepalive_size', int(keepalive.get('size', 100)))
+        assign('keepalive_idle', float(keepalive.get('idle', 30)))
+
+        breaker = conf.get('breaker', {})
+        assign('breaker_failures', int(breaker.get('failures', 3)))
+        assign('breaker_backoff', float(breaker.get('backoff', 10)))
+        assign('breaker_max_backoff', float(breaker.get('maxbackoff', 300)))
+
+        compression = conf.get('compression', {})
+        assign('compress_level', int(compression.get('level', 6)))
+        assign('compress_min_size', int(compression.get('minsize', 1024)))
+
+        profile = conf.get('profile', {})
+        assign('profile_rate', float(profile.get('rate', 0)))
+        assign('profile_match', profile.get('match'))
+        assign('profile_interval', float(profile.get('interval', 300)))
+        assign('profile_keep', int(profile.get('keep', 20)))
+        assign('profile_token', profile.get('token'))
+
+        history = conf.get('history')
+        assign('history', history is not None and self.cache)
+        history = history or {}
+        assign('history_deltas', int(history.get('deltas', 100)))
+        assign('history_segments', int(history.get('segments', 10)))
+        assign('history_keep_seconds', timedelta_seconds(
+            datetime.timedelta(**history.get('keep', {}))))
+
+        search = conf.get('search')
+        assign('search', search is not None and self.cache)
+        search = search or {}
+        assign('search_sections', tuple(search.get('sections', ())))
+        assign('search_sync', float(search.get('sync', 60)))
+
+        crawl = conf.get('crawl', {})
+        assign('crawl_concurrency', int(crawl.get('concurrency', 4)))
+        assign('crawl_lead', float(crawl.get('lead', 0.1)))
+        assign('crawl_jitter', float(crawl.get('jitter', 0.1)))
+
+        fanout = conf.get('fanout', {})
+        assign('fanout_async', bool(fanout.get('async', False)))
+        assign('fanout_concurrency', int(fanout.get('concurrency', 10)))
+        assign('fanout_deadline', float(fanout.get('deadline', 30)))
+
+        # Host indexes
+        host_names = conf['hosts'].keys()
+        host_names.sort()
+        env_hosts = {}
+        for host in host_names:
+            env_hosts.setdefault(conf['hosts'][host], []).append(host)
+        envs = env_hosts.keys()
+        envs.sort()
+        for env in envs:
+            env_hosts[env] = tuple(env_hosts[env])
+        assign('host_names', tuple(host_names))
+        assign('env_hosts', env_hosts)
+        assign('envs', tuple(envs))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Config snapshots can not be modified')
+
+    def changed_keys(self, other):
+        """
+        Returns the set of top level keys which differ from the Config
+        snapshot other.
+        """
+        changed = set()
+        for key in set(self.conf.keys() + other.conf.keys()):
+            if self.conf.get(key) != other.conf.get(key):
+                changed.add(key)
+        return changed
+
+
+_config = None
+_config_lock = threading.Lock()
+
+
+def get_config():
+    """
+    Returns the current Config snapshot of TALOOK_CONFIG_FILE, loading it
+    on first use or when TALOOK_CONFIG_FILE points somewhere new.
+    """
+    config = _config
+    if config is None or config.path != os.environ['TALOOK_CONFIG_FILE']:
+        config = reload_config()
+    return config
+
+
+def reload_config():
+    """
+    Parses TALOOK_CONFIG_FILE into a new Config snapshot, applies its
+    process wide settings and makes it the current snapshot. If parsing
+    fails the current snapshot is left in place.
+    """
+    global _config
+    _config_lock.acquire()
+    try:
+        previous = _config
+        config = Config(os.environ['TALOOK_CONFIG_FILE'])
+        # Only touch what changed so cached data and open connections
+        # survive unrelated edits
+        if previous is None or (
+                (previous.memcache_entries, previous.memcache_bytes) !=
+                (config.memcache_entries, config.memcache_bytes)):
+            memory_cache.configure(
+                config.memcache_entries, config.memcache_bytes)
+        keepalive = (
+            config.keepalive_per_host, config.keepalive_size,
+            config.keepalive_idle)
+        if previous is None or keepalive != (
+                previous.keepalive_per_host, previous.keepalive_size,
+                previous.keepalive_idle):
+            connection_pool.configure(*keepalive)
+        circuit_breaker.configure(
+            config.breaker_failures, config.breaker_backoff,
+            config.breaker_max_backoff)
+        history_dir = None
+        if config.history:
+            history_dir = os.path.sep.join([config.cache_dir, 'history'])
+        history_store.configure(
+            history_dir, config.history_deltas, config.history_segments,
+            config.history_keep_seconds)
+        fact_index.configure(config.search, config.search_sections)
+        socket.setdefaulttimeout(config.timeout)
+        _config = config
+        return config
+    finally:
+        _config_lock.release()
+
+
+#: Files making up a cache entry
+cache_file_suffixes = ('.json', '.json.gz', '.json.etag', '.json.idx')
+
+
+def invalidate_cache(config, keys):
+    """
+    Drops the entries for keys from the memory cache and the cache
+    directory of the Config snapshot config.
+    """
+    for key in keys:
+        memory_cache.delete(key)
+        negative_cache.delete(key)
+        circuit_breaker.reset(key)
+        fact_index.remove(key)
+        if config.cache:
+            for suffix in cache_file_suffixes:
+                try:
+                    os.unlink(os.path.sep.join(
+                        [config.cache_dir, key + suffix]))
+                except OSError:
+                    pass
+
+
+class ConfigWatcher(object):
+    """
+    Waits for changes to a file. inotify is used where available, with
+    polling of the file's mtime as the fallback. Bursts of writes are
+    reported as one change once the file has been quiet for debounce
+    seconds.
+    """
+
+    #: inotify events which may mean the file changed
+    _mask = 0x2 | 0x4 | 0x8 | 0x80 | 0x100
+
+    def __init__(self, path, debounce=0.5, interval=1):
+        """
+        Creates a watcher for path. interval is how often to poll when
+        inotify is not available.
+        """
+        self.path = path
+        self.debounce = debounce
+        self.interval = interval
+        self._name = os.path.basename(path)
+        self._mtime = self._get_mtime()
+        self._fd = None
+        if _libc is not None:
+            fd = _libc.inotify_init()
+            if fd >= 0:
+                directory = os.path.dirname(os.path.abspath(path))
+                if _libc.inotify_add_watch(fd, directory, self._mask) >= 0:
+                    self._fd = fd
+                else:
+                    os.close(fd)
+
+    def _get_mtime(self):
+        """
+        Returns the mtime of the file or None if it is missing.
+        """
+        try:
+            return os.stat(self.path).st_mtime
+        except OSError:
+            return None
+
+    def _read_events(self, timeout):
+        """
+        Returns True if an inotify event for the file arrives within
+        timeout seconds.
+        """
+        if not select.select([self._fd], [], [], timeout)[0]:
+            return False
+        data = os.read(self._fd, 65536)
+        offset = 0
+        found = False
+        while offset + 16 <= len(data):
+            wd, mask, cookie, length = struct.unpack(
+                'iIII', data[offset:offset + 16])
+            name = data[offset + 16:offset + 16 + length].rstrip('\0')
+            if name == self._name:
+                found = True
+            offset += 16 + length
+        return found
+
+    def wait(self, timeout):
+        """
+        Returns True if the file changed within timeout seconds, once it
+        has settled, else False.
+        """
+        if self._fd is not None:
+            if not self._read_events(timeout):
+                return False
+            while self._read_events(self.debounce):
+                pass
+            return True
+
+        time.sleep(min(timeout, self.interval))
+        mtime = self._get_mtime()
+        if mtime == self._mtime:
+            return False
+        while True:
+            time.sleep(self.debounce)
+            settled = self._get_mtime()
+            if settled == mtime:
+                break
+            mtime = settled
+        self._mtime = mtime
+        return True
+
+    def close(self):
+        """
+        Stops watching.
+        """
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class RequestProfiler(object):
+    """
+    Profiles a sampled fraction of requests, and requests whose path
+    matches a pattern, with cProfile. Profiles are aggregated by route and
+    written to the profiles directory every interval seconds, keeping the
+    newest keep files.
+    """
+
+    def __init__(self, directory, rate=0, match=None, interval=300, keep=20):
+        """
+        Creates a RequestProfiler writing to directory.
+        """
+        self.directory = directory
+        self.rate = rate
+        self.match = match and re.compile(match).search or None
+        self.interval = interval
+        self.keep = keep
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._next_dump = time.time() + interval
+
+    def wants(self, path):
+        """
+        Returns True if the request for path should be profiled.
+        """
+        return ((self.rate and random.random() < self.rate) or
+                (self.match is not None and self.match(path) is not None))
+
+    def run(self, route, func, *args, **kwargs):
+        """
+        Returns func(*args, **kwargs), adding its profile to that of route.
+        """
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(func, *args, **kwargs)
+        finally:
+            self._lock.acquire()
+            try:
+                if route in self._stats:
+                    self._stats[route].add(profiler)
+                else:
+                    self._stats[route] = pstats.Stats(profiler)
+                due = time.time() >= self._next_dump
+            finally:
+                self._lock.release()
+            if due:
+                self.dump()
+
+    def dump(self):
+        """
+        Writes the profiles gathered so far, one file per route, and
+        removes the oldest files beyond keep.
+        """
+        self._lock.acquire()
+        try:
+            stats, self._stats = self._stats, {}
+            self._next_dump = time.time() + self.interval
+        finally:
+            self._lock.release()
+        if not stats:
+            return
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        for route, route_stats in stats.items():
+            slug = re.sub(r'\W+', '_', route).strip('_') or 'root'
+            route_stats.dump_stats(os.path.sep.join([
+                self.directory,
+                '%s-%s-%s.prof' % (stamp, os.getpid(), slug)]))
+        for name, size, mtime in self.list()[self.keep:]:
+            try:
+                os.unlink(os.path.sep.join([self.directory, name]))
+            except OSError:
+                pass
+
+    def list(self):
+        """
+        Returns (name, size, mtime) of every profile written, newest first.
+        """
+        profiles = []
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return profiles
+        for name in names:
+            if not name.endswith('.prof'):
+                continue
+            try:
+                info = os.stat(os.path.sep.join([self.directory, name]))
+            except OSError:
+                continue
+            profiles.append((name, info.st_size, info.st_mtime))
+        profiles.sort(key=lambda profile: (profile[2], profile[0]),
+                      reverse=True)
+        return profiles
+
+
+def make_profiler(config):
+    """
+    Returns the RequestProfiler configured by the Config snapshot config,
+    or None if profiling is disabled.
+    """
+    if cProfile is None or not (config.profile_rate or config.profile_match):
+        return None
+    return RequestProfiler(
+        os.path.sep.join([config.logdir, 'profiles']), config.profile_rate,
+        config.profile_match, config.profile_interval, config.profile_keep)
+
+
+class Router(object):
+    """
+    URL Router.
+    """
+
+    #: Characters which end the literal prefix of a rule
+    _special = '.^$*+?{}[]\\|()'
+
+    def __init__(self, rules):
+        """
+        Creates an application URI router.
+
+        rules is a dictionary defining uri: WSGIApplication or a list of
+        (uri, WSGIApplication) pairs. Paths equal to a uri are routed
+        first. Otherwise rules are tried in list order, or from the longest
+        uri to the shortest for a dictionary, and the first match wins.
+        """
+        self.logger = create_logger('talook', 'talook_app.log')
+        self.access_log = AccessLog(create_logger(
+            'talook_access', 'talook_access.log', access_log_format))
+        self._profiler = make_profiler(get_config())
+        if isinstance(rules, dict):
+            rules = rules.items()
+            rules.sort(key=lambda rule: (-len(rule[0]), rule[0]))
+        self._compile(rules)
+
+    def _compile(self, rules):
+        """
+        Builds the routing tables for a list of (uri, app) rules and swaps
+        them in at once.
+        """
+        rules_by_uri = {}
+        exact = {}
+        ordered = []
+        for uri, app in rules:
+            regex = re.compile(uri)
+            rules_by_uri[uri] = {'app': app, 'regex': regex}
+            exact.setdefault(uri, app)
+            # skip '' because it would always match
+            if uri != '':
+                ordered.append(
+                    (self._literal_prefix(uri), regex.match, app, uri))
+        self._list = rules
+        self._rules = rules_by_uri
+        self._routes = (exact, ordered)
+
+    def _literal_prefix(self, uri):
+        """
+        Returns the plain text every path matching uri must start with.
+        """
+        # Alternatives may start with anything
+        if '|' in uri:
+            return ''
+        prefix = []
+        for char in uri.lstrip('^'):
+            if char in self._special:
+                # A quantifier makes the character before it optional
+                if char in '?*{' and prefix:
+                    prefix.pop()
+                break
+            prefix.append(char)
+        return ''.join(prefix)
+
+    def reload(self):
+        """
+        Loads a new config snapshot and swaps in new instances of every
+        mounted handler built from it. Requests already running finish
+        with the handlers they started with.
+        """
+        self.logger.info('Reloading config')
+        previous = _config
+        config = reload_config()
+        if previous is None:
+            previous = config
+            changed = set(config.conf.keys())
+        else:
+            changed = config.changed_keys(previous)
+        if not changed:
+            self.logger.info('Config is unchanged.')
+            return
+        self.logger.info('Config changed: %s' % ', '.join(sorted(changed)))
+
+        if 'templatedir' in changed:
+            template_cache.clear()
+        if 'endpoint' in changed:
+            # Every entry came from the old endpoint
+            invalidate_cache(previous, previous.host_names)
+        else:
+            invalidate_cache(previous, [
+                host for host in previous.host_names
+                if host not in config.conf['hosts']])
+        removed = [
+            host for host in previous.host_names
+            if host not in config.conf['hosts']]
+        host_popularity.forget(removed)
+        for host in removed:
+            history_store.remove(host)
+        if 'cachedir' in changed or 'cachetime' in changed:
+            memory_cache.clear()
+        if 'profile' in changed or 'logdir' in changed:
+            if self._profiler is not None:
+                self._profiler.dump()
+            self._profiler = make_profiler(config)
+
+        rules = []
+        for uri, app in self._list:
+            if isinstance(app, BaseHandler):
+                app = app.__class__(config)
+            rules.append((uri, app))
+        self._compile(rules)
+
+    def __call__(self, environ, start_response):
+        """
+        Callable which handles the actual routing in a WSGI structured way.
+        Every request is written to the access log with its latency and
+        cache outcome and counted in metrics by route.
+        """
+        started = time.time()
+        response = []
+
+        def start(status, headers, exc_info=None):
+            response[:] = [status, headers]
+            if exc_info is None:
+                return start_response(status, headers)
+            return start_response(status, headers, exc_info)
+
+        _request.cache = '-'
+        uri, app, kwargs = self.match(environ['PATH_INFO'])
+        labels = (('route', uri),)
+        metrics.inc('talook_requests_in_flight', labels)
+        try:
+            try:
+                profiler = self._profiler
+                if profiler is not None and app is not None and \
+                        profiler.wants(environ['PATH_INFO']):
+                    result = profiler.run(uri, app, environ, start, **kwargs)
+                elif app is not None:
+                    result = app(environ, start, **kwargs)
+                else:
+                    start("404 File Not Found",
+                          [("Content-Type", "text/html")])
+                    result = "404 File Not Found."
+            except Exception:
+                # The server answers 500, which must not go unrecorded
+                self.record(environ, labels, started, '500', '-')
+                raise
+        finally:
+            metrics.dec('talook_requests_in_flight', labels)
+        # Servers write every item of the result on its own, so a bare
+        # string would go out one character at a time
+        if isinstance(result, str):
+            result = [result]
+        status = response and response[0].split(' ', 1)[0] or '-'
+
+        length = '-'
+        if response:
+            for name, value in response[1]:
+                if name == 'Content-Length':
+                    length = value
+                    break
+            else:
+                if isinstance(result, list):
+                    length = sum([len(chunk) for chunk in result])
+        self.record(environ, labels, started, status, length)
+        return result
+
+    def record(self, environ, labels, started, status, length):
+        """
+        Counts a request answered with status in metrics and writes it to
+        the access log.
+        """
+        elapsed = time.time() - started
+        metrics.inc('talook_requests_total', labels + (('status', status),))
+        metrics.observe('talook_request_duration_seconds', labels, elapsed)
+        path = urllib.quote(environ['PATH_INFO'])
+        if environ.get('QUERY_STRING'):
+            path += '?' + environ['QUERY_STRING']
+        self.access_log.write(
+            'remote=%s method=%s path=%s status=%s bytes=%s latency_ms=%.1f '
+            'cache=%s' % (
+                environ.get('REMOTE_ADDR', '-'),
+                environ.get('REQUEST_METHOD', '-'), path, status, length,
+                elapsed * 1000, _request.cache))
+
+    def match(self, path):
+        """
+        Returns (uri, app, kwargs) of the rule path is routed to, or
+        ('', None, None) if there is none.
+        """
+        exact, ordered = self._routes
+        # If the path exists then pass control to the wsgi application
+        app = exact.get(path)
+        if app is not None:
+            return (path, app, {})
+
+        # If the path matches the regex then pass control to the wsgi app
+        for prefix, match, app, uri in ordered:
+            if path.startswith(prefix):
+                found = match(path)
+                if found:
+                    return (uri, app, found.groupdict())
+
+        # Otherwise 404
+        return ('', None, None)
+
+
+class BaseHandler(object):
+    """
+    Base handler to be used for app endpoints.
+    """
+
+    #: Bytes read at a time when sending files
+    chunk_size = 65536
+
+    #: Fresh cache entries of at least this many bytes are sent straight
+    #: from the cache directory
+    stream_size = 1048576
+
+    def __init__(self, config=None):
+        """
+        Creates a BaseHandler instance from a Config snapshot, by default
+        the current one.
+        """
+        if config is None:
+            config = get_config()
+        self._config = config
+        self._conf = config.conf
+        self.logger = create_logger('talook', 'talook_app.log')
+
+        self._template_path = config.template_path
+        if config.old_template_path:
+            self.logger.warn(
+                'Old style template directory has been deprecated and will be '
+                'rmeoved in a future release. Please define the full path '
+                'including the directory name. Using ' + self._template_path)
+
+        self._cache = config.cache
+        self._cache_seconds = config.cache_seconds
+        self._cache_stale_seconds = config.cache_stale_seconds
+        if self._cache:
+            self._cache_dir = config.cache_dir
+            self._cache_time = config.cache_time
+            self.logger.info(
+                'Caching in %s is enabled' % self.__class__.__name__)
+        else:
+            self.logger.info(
+                'Caching in %s is disabled' % self.__class__.__name__)
+
+        self._extranotes = config.extranotes
+        self._timeout = config.timeout
+        self.logger.info('Timeout set to %s seconds' % self._timeout)
+
+        self._memory_cache = memory_cache
+        self._error_seconds = config.error_seconds
+        self._compress_level = config.compress_level
+        self._compress_min_size = config.compress_min_size
+        self._fanout_async = config.fanout_async
+        self._fanout_concurrency = config.fanout_concurrency
+        self._fanout_deadline = config.fanout_deadline
+
+    def render_template(self, name, **kwargs):
+        """
+        Template renderer.
+        """
+        return template_cache.render(
+            os.path.sep.join([self._template_path, name]), kwargs)
+
+    def get_from_cache(self, key, source=None):
+        """
+        Gets data from a local cache. If it's not there it will run the
+        source callable, save the result and return the results.
+        """
+        return json.loads(self.get_raw_from_cache(key, source))
+
+    def get_raw_from_cache(self, key, source=None):
+        """
+        Same as get_from_cache but returns the serialized JSON.
+        """
+        return self.get_entry_from_cache(key, source).body
+
+    def get_entry_from_cache(self, key, source=None):
+        """
+        Same as get_from_cache but returns a CacheEntry. The memory cache is
+        checked first, then the cache directory. If cachestale is configured
+        an expired entry younger than cachestale is returned flagged as
+        stale while it is refreshed in the background.
+        """
+        entry = self.get_cached_entry(key, source)
+        if entry is not None:
+            set_cache_outcome(entry.stale and 'stale' or 'hit')
+            return entry
+        entry = self.get_failed_entry(key)
+        if entry is not None:
+            set_cache_outcome('failed')
+            return entry
+        set_cache_outcome('miss')
+        return self.fetch_entry(key, source)
+
+    def get_cached_entry(self, key, source=None):
+        """
+        Returns the usable CacheEntry for key without calling source, or
+        None if there isn't one. Stale entries are refreshed from source in
+        the background.
+        """
+        # If we have cache ...
+        if not self._cache:
+            return None
+        entry = self._memory_cache.get(key, self._cache_stale_seconds)
+        if entry is not None:
+            self.logger.info('Found "%s" in memory cache.' % key)
+        else:
+            entry = self._get_entry_from_cache_dir(key)
+
+        if entry is None or not entry.is_expired():
+            return entry
+        self.logger.info('Serving stale "%s" while refreshing it.' % key)
+        self.refresh_in_background(key, source)
+        return entry.as_stale()
+
+    def get_failed_entry(self, key):
+        """
+        Returns what to answer for key without calling upstream when it
+        failed within errortime or its circuit is open, else None. That is
+        the last known good entry flagged as stale if there is one, or the
+        cached error.
+        """
+        error = negative_cache.get(key)
+        if error is None:
+            if circuit_breaker.allow(key):
+                return None
+            self.logger.info('Circuit for "%s" is open.' % key)
+            error = negative_cache.get(key, max_stale=float('inf'))
+            if error is None:
+                now = time.time()
+                error = CacheEntry(json.dumps(connection_error_result(
+                    key, 'Circuit is open')[1]), now, now)
+        else:
+            self.logger.info('Found failure of "%s" in cache.' % key)
+        return self.get_last_good_entry(key) or error
+
+    def get_last_good_entry(self, key):
+        """
+        Returns the most recent successful CacheEntry for key however old,
+        flagged as stale, or None if there isn't one.
+        """
+        if not self._cache:
+            return None
+        entry = self._memory_cache.get(key, max_stale=float('inf'))
+        if entry is None:
+            entry = self._get_entry_from_cache_dir(key, float('inf'))
+        if entry is None:
+            return None
+        return entry.as_stale()
+
+    def _get_entry_from_cache_dir(self, key, max_stale=None):
+        """
+        Returns the CacheEntry for key from the cache directory if it has
+        not been expired for more than max_stale seconds (by default
+        cachestale), else None.
+        """
+        if max_stale is None:
+            max_stale = self._cache_stale_seconds
+        cache_name = os.path.sep.join([self._cache_dir, key + '.json'])
+        if not os.path.exists(cache_name):
+            self.logger.info('Key "%s" was NOT in cache.' % key)
+            return None
+        # And the cache file exists ...
+        mtime = os.stat(cache_name).st_mtime
+        entry = CacheEntry('', mtime, mtime + self._cache_seconds)
+        # If we are still in the cache (or stale) time then use the cache
+        if entry.is_expired(max_stale=max_stale):
+            metrics.inc('talook_cache_expired_total')
+            self.logger.info('Key "%s" is expired in cache.' % key)
+            return None
+        self.logger.info('Found "%s" in cache.' % key)
+        body = open(cache_name, 'r').read()
+        gzipped = None
+        if self._compress_level:
+            gzipped = self._read_companion_file(cache_name + '.gz', mtime)
+        etag = self._read_companion_file(cache_name + '.etag', mtime)
+        index = self._read_companion_file(cache_name + '.idx', mtime)
+        if index is not None:
+            try:
+                index = dict([
+                    (name, tuple(span))
+                    for name, span in json.loads(index).items()])
+            except ValueError:
+                index = None
+        entry = CacheEntry(
+            body, entry.created, entry.expires, gzipped,
+            etag or make_etag(body), index)
+        self._memory_cache.set(key, entry)
+        return entry
+
+    def _read_companion_file(self, name, mtime):
+        """
+        Returns the content of a file written alongside a cache entry
+        modified at mtime, or None if it is missing or older than it.
+        """
+        try:
+            if os.stat(name).st_mtime < mtime:
+                return None
+            return open(name, 'rb').read()
+        except (IOError, OSError):
+            return None
+
+    def get_cache_validators(self, key):
+        """
+        Returns (etag, mtime) of the fresh cache entry for key without
+        reading the entry itself, or None if there is no fresh entry.
+        """
+        if not self._cache:
+            return None
+        entry = self._memory_cache.get(key)
+        if entry is not None:
+            return (entry.etag, entry.created)
+        cache_name = os.path.sep.join([self._cache_dir, key + '.json'])
+        try:
+            mtime = os.stat(cache_name).st_mtime
+        except OSError:
+            return None
+        if time.time() >= mtime + self._cache_seconds:
+            return None
+        etag = self._read_companion_file(cache_name + '.etag', mtime)
+        if etag is None:
+            return None
+        return (etag, mtime)
+
+    def get_cache_file(self, key, gzipped=False):
+        """
+        Returns (cache_name, size, mtime, etag) of the fresh cache file for
+        key if it is at least stream_size bytes, else None. With gzipped the
+        compressed companion is returned instead, if there is one.
+        """
+        if not self._cache:
+            return None
+        cache_name = os.path.sep.join([self._cache_dir, key + '.json'])
+        try:
+            info = os.stat(cache_name)
+        except OSError:
+            return None
+        if (info.st_size < self.stream_size or
+                time.time() >= info.st_mtime + self._cache_seconds):
+            return None
+        etag = self._read_companion_file(cache_name + '.etag', info.st_mtime)
+        if etag is None:
+            return None
+        if gzipped:
+            try:
+                gz_info = os.stat(cache_name + '.gz')
+            except OSError:
+                return None
+            if gz_info.st_mtime < info.st_mtime:
+                return None
+            return (cache_name + '.gz', gz_info.st_size, info.st_mtime, etag)
+        return (cache_name, info.st_size, info.st_mtime, etag)
+
+    def send_file(self, environ, f):
+        """
+        Returns an iterable over the content of the open file f, using
+        wsgi.file_wrapper if the server has one.
+        """
+        if 'wsgi.file_wrapper' in environ:
+            return environ['wsgi.file_wrapper'](f, self.chunk_size)
+        return self._read_chunks(f)
+
+    def _read_chunks(self, f):
+        """
+        Yields the content of f in chunk_size pieces.
+        """
+        try:
+            while True:
+                chunk = f.read(self.chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            f.close()
+
+    def fetch_entry(self, key, source):
+        """
+        Fetches key from source. Concurrent fetches of the same key are
+        coalesced into one, both across threads and, through a lock file in
+        the cache directory, across processes sharing the cache directory.
+        """
+        return single_flight.do(
+            key, lambda: self._fetch_entry_with_lock(key, source))
+
+    def _fetch_entry_with_lock(self, key, source):
+        """
+        Holds the lock file for key while fetching it. If another process
+        held the lock its fresh result is used instead of fetching again.
+        """
+        if not self._cache or fcntl is None:
+            return self._get_entry_from_source(key, source)
+
+        lock_file = open(
+            os.path.sep.join([self._cache_dir, key + '.lock']), 'a')
+        try:
+            waited = False
+            locked = False
+            # Never wait on another process longer than a fetch would take
+            give_up = time.time() + self._timeout
+            while True:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    locked = True
+                    break
+                except IOError:
+                    if time.time() > give_up:
+                        self.logger.warn(
+                            'Gave up waiting on lock for "%s".' % key)
+                        break
+                    waited = True
+                    time.sleep(0.05)
+            try:
+                if waited:
+                    entry = self._get_entry_from_cache_dir(key)
+                    if entry is not None and not entry.is_expired():
+                        return entry
+                return self._get_entry_from_source(key, source)
+            finally:
+                if locked:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+        finally:
+            lock_file.close()
+
+    def _get_entry_from_source(self, key, source):
+        """
+        Runs the source callable, saving the result if it is a success.
+        Failures are remembered for errortime and counted against the
+        circuit of key; the last known good entry is returned in their
+        place if there is one.
+        """
+        now = time.time()
+        index = document = None
+        try:
+            status_code, data = source()
+            if isinstance(data, RawJSON):
+                body = str(data)
+                index, document = data.index, data.document
+            else:
+                body = json.dumps(data)
+        except Exception, ex:
+            print ex
+            status_code, body = None, json.dumps(None)
+        if status_code == 200:
+            circuit_breaker.success(key)
+            if self._cache:
+                return self.save_raw_to_cache(key, body, index, document)
+            return CacheEntry(body, now, now, index=index)
+
+        self.logger.warn('Not saving %s to cache. Non 200 response.' % key)
+        circuit_breaker.failure(key)
+        error = CacheEntry(body, now, now + self._error_seconds)
+        if self._error_seconds:
+            negative_cache.set(key, error)
+        return self.get_last_good_entry(key) or error
+
+    def refresh_in_background(self, key, source):
+        """
+        Queues a refresh of key from source on the background refresher
+        unless a refresh of key is already waiting or running. It is
+        skipped if key failed within errortime or its circuit is open by
+        the time it runs.
+        """
+        def refresh():
+            if negative_cache.get(key) is None and \
+                    circuit_breaker.allow(key):
+                self.fetch_entry(key, source)
+
+        background_refresher.submit(key, refresh)
+
+    def save_to_cache(self, key, json_data):
+        """
+        Holds data in local 'cache'.
+        """
+        self.save_raw_to_cache(key, json.dumps(json_data))
+
+    def save_raw_to_cache(self, key, body, index=None, document=None):
+        """
+        Holds already serialized data in local 'cache'. Returns the new
+        CacheEntry. index and document are the section index and decoded
+        body if known, as parse_raw_json returns them, else they are
+        worked out from body.
+        """
+        cache_name = os.path.sep.join([self._cache_dir, key + '.json'])
+        self._write_cache_file(cache_name, body)
+        # Companion files are written after the entry so they are never
+        # older than the entry they belong to.
+        etag = make_etag(body)
+        self._write_cache_file(cache_name + '.etag', etag)
+        gzipped = None
+        if self._compress_level and len(body) >= self._compress_min_size:
+            gzipped = gzip_compress(body, self._compress_level)
+            self._write_cache_file(cache_name + '.gz', gzipped)
+        if index is None:
+            try:
+                index = build_section_index(body)
+            except ValueError:
+                pass
+        if index is not None:
+            self._write_cache_file(cache_name + '.idx', json.dumps(index))
+        if history_store.directory is not None or fact_index.enabled:
+            if document is None:
+                try:
+                    document = json.loads(body)
+                except ValueError:
+                    pass
+            if document is not None:
+                try:
+                    history_store.record(key, document)
+                except (IOError, OSError), ex:
+                    self.logger.warn(
+                        'Could not record history of "%s": %s' % (key, ex))
+                fact_index.update(
+                    key, document, os.stat(cache_name).st_mtime)
+        now = time.time()
+        entry = CacheEntry(
+            body, now, now + self._cache_seconds, gzipped, etag, index)
+        self._memory_cache.set(key, entry)
+        metrics.inc('talook_cache_writes_total')
+        self.logger.info('Saved "%s" in cache.' % key)
+        return entry
+
+    def _write_cache_file(self, cache_name, data):
+        """
+        Writes data to a temporary file and renames it to cache_name so
+        other readers never see a partially written file.
+        """
+        fd, tmp_name = tempfile.mkstemp(
+            prefix='.' + os.path.basename(cache_name), suffix='.tmp',
+            dir=self._cache_dir)
+        f = os.fdopen(fd, 'wb')
+        f.write(data)
+        f.close()
+        os.rename(tmp_name, cache_name)
+
+    def query_host(self, host):
+        """
+        Returns the CacheEntry of stats for a configured host, using the
+        cache if enabled.
+        """
+        endpoint = self._conf['endpoint'] % host
+        self.logger.info('Requesting data from %s' % endpoint)
+        call_obj = lambda: make_raw_get_request(endpoint)
+
+        return self.get_entry_from_cache(host, call_obj)
+
+    def query_hosts_async(self, hosts):
+        """
+        Returns a dictionary of host: serialized stats for configured hosts
+        using the cache if enabled. Hosts missing from the cache are
+        fetched together by make_get_requests without a thread per host.
+        Hosts which did not finish within the fanout deadline are left out.
+        Results are saved through fetch_entry so they are coalesced with
+        other fetches of the same host like any other fetch.
+        """
+        results = {}
+        endpoints = {}
+        for host in hosts:
+            endpoint = self._conf['endpoint'] % host
+            entry = self.get_cached_entry(
+                host,
+                lambda endpoint=endpoint: make_raw_get_request(endpoint))
+            if entry is None:
+                entry = self.get_failed_entry(host)
+            if entry is not None:
+                results[host] = entry.body
+            else:
+                endpoints[host] = endpoint
+
+        self.logger.info('Requesting data from %s hosts' % len(endpoints))
+        fetched = make_get_requests(
+            endpoints, self._fanout_concurrency, self._timeout,
+            self._fanout_deadline)
+        for host, result in fetched.items():
+            results[host] = self.fetch_entry(
+                host, lambda result=result: result).body
+        return results
+
+    def not_modified(self, environ, etag, mtime):
+        """
+        Returns True if the request's If-None-Match or If-Modified-Since
+        header shows the client already has this version.
+        """
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+        if if_none_match is not None:
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            return etag in tags or '*' in tags
+        if_modified_since = environ.get('HTTP_IF_MODIFIED_SINCE')
+        if if_modified_since is not None:
+            since = parsedate(if_modified_since.split(';')[0])
+            if since is not None:
+                return int(mtime) <= calendar.timegm(since)
+        return False
+
+    def respond(self, environ, start_response, body, headers,
+                gzipped=None, status="200 OK", sized=False):
+        """
+        Starts the response and returns body. If the client accepts gzip
+        and body is at least the compression minsize the gzipped body
+        (compressed now if not given) is returned instead, with an ETag of
+        its own. If sized a Content-Length header is sent and body is
+        returned in a list so it is written in one piece.
+        """
+        if (self._compress_level and
+                len(body) >= self._compress_min_size and
+                accepts_gzip(environ)):
+            if gzipped is None:
+                gzipped = gzip_compress(body, self._compress_level)
+            body = gzipped
+            headers = [
+                (name, name == 'ETag' and variant_etag(value, (), True) or
+                 value) for name, value in headers] + [
+                ("Content-Encoding", "gzip"), ("Vary", "Accept-Encoding")]
+        if sized:
+            start_response(
+                status, headers + [("Content-Length", str(len(body)))])
+            return [body]
+        start_response(status, headers)
+        return body
+
+    def precompress(self, body):
+        """
+        Returns (body, gzipped) where gzipped is body compressed for
+        respond if it is large enough to ever be sent compressed, else
+        None.
+        """
+        if self._compress_level and len(body) >= self._compress_min_size:
+            return (body, gzip_compress(body, self._compress_level))
+        return (body, None)
+
+    def return_400(self, start_response, msg="400 Bad Request"):
+        """
+        Shortcut for returning 400's.
+        """
+        start_response("400 Bad Request", [("Content-Type", "text/html")])
+        return str(msg)
+
+    def return_403(self, start_response, msg="403 Forbidden"):
+        """
+        Shortcut for returning 403's.
+        """
+        start_response("403 Forbidden", [("Content-Type", "text/html")])
+        return str(msg)
+
+    def return_404(self, start_response, msg="404 File Not Found"):
+        """
+        Shortcut for returning 404's.
+        """
+        start_response("404 File Not Found", [("Content-Type", "text/html")])
+        return str(msg)
+
+
+class StaticFileHandler(BaseHandler):
+    """
+    Handles static file serving. Will ONLY serve 1 directory deep!!
+    """
+
+    #: Mimetypes by file extension, anything else is text/plain
+    mime_types = {
+        '.js': 'application/javascript',
+        '.css': 'text/css',
+        '.png': 'image/png',
+        '.gif': 'image/gif',
+        '.html': 'text/html',
+    }
+
+    #: Files up to this many bytes are kept in memory
+    memory_limit = 262144
+
+    def __init__(self, config=None):
+        """
+        Creates a StaticFileHandler instance.
+        """
+        BaseHandler.__init__(self, config)
+        self._max_age = self._config.static_seconds
+        self._files = {}
+
+    def __call__(self, environ, start_response, filename):
+        """
+        Returns the content of a CSS, JS or image file with the right
+        mimetype if it exists. Validator and Cache-Control headers are
+        sent and conditional requests are answered with 304 Not Modified.
+        """
+        real_name = os.path.sep.join(
+            [os.path.realpath(self._conf['staticdir']), filename])
+        try:
+            info = os.stat(real_name)
+        except OSError:
+            return [self.return_404(start_response)]
+        if not stat.S_ISREG(info.st_mode):
+            return [self.return_404(start_response)]
+
+        mime_type = self.mime_types.get(
+            os.path.splitext(real_name)[1], 'text/plain')
+        etag = '"%x-%x"' % (int(info.st_mtime), info.st_size)
+        headers = [
+            ("Content-Type", mime_type),
+            ("Last-Modified", formatdate(info.st_mtime, usegmt=True)),
+            ("ETag", etag),
+            ("Cache-Control", "max-age=%d" % self._max_age),
+        ]
+        if self.not_modified(environ, etag, info.st_mtime):
+            start_response("304 Not Modified", headers)
+            return []
+
+        headers.append(("Content-Length", str(info.st_size)))
+        start_response("200 OK", headers)
+        if info.st_size <= self.memory_limit:
+            return [self._read_small_file(real_name, etag)]
+        return self.send_file(environ, open(real_name, 'rb'))
+
+    def _read_small_file(self, real_name, etag):
+        """
+        Returns the content of a small file, from memory if unchanged.
+        """
+        cached = self._files.get(real_name)
+        if cached is not None and cached[0] == etag:
+            return cached[1]
+        f = open(real_name, 'rb')
+        try:
+            body = f.read()
+        finally:
+            f.close()
+        self._files[real_name] = (etag, body)
+        return body
+
+
+class IndexHandler(BaseHandler):
+    """
+    Index page.
+    """
+
+    _gzipped_page = (None, None)
+
+    def __call__(self, environ, start_response):
+        """
+        Handles the index page.
+        """
+        body = self.render_template(
+            'base.html', title='Talook', extranotes=self._extranotes)
+        # The rendered page is reused until the template changes so its
+        # compressed copy can be as well.
+        if self._gzipped_page[0] is not body:
+            self._gzipped_page = (body, None)
+            if self._compress_level:
+                self._gzipped_page = (
+                    body, gzip_compress(body, self._compress_level))
+        return self.respond(
+            environ, start_response, body, [("Content-Type", "text/html")],
+            self._gzipped_page[1])
+
+
+class ListHostsHandler(BaseHandler):
+    """
+    Hosts page.
+    """
+
+    def __init__(self, config=None):
+        """
+        Creates a ListHostsHandler instance. The unfiltered and per env
+        listings are serialized once per config snapshot.
+        """
+        BaseHandler.__init__(self, config)
+        hosts = self._conf['hosts']
+        self._bodies = {None: self.precompress(
+            json.dumps(hosts, sort_keys=True))}
+        for env, env_hosts in self._config.env_hosts.items():
+            self._bodies[env] = self.precompress(json.dumps(
+                dict([(host, env) for host in env_hosts]), sort_keys=True))
+
+    def __call__(self, environ, start_response):
+        """
+        Handles the REST API endpoint listing known hosts. Hosts may be
+        narrowed down with env=, prefix= and match= (a regular expression)
+        and paged through in name order with limit= and offset=.
+        """
+        query = parse_qs(environ.get('QUERY_STRING', ''))
+        env = query.get('env', [None])[0]
+        headers = [("Content-Type", "application/json")]
+        if not [name for name in query.keys() if name != 'env']:
+            body, gzipped = self._bodies.get(env, ('{}', None))
+            return self.respond(
+                environ, start_response, body, headers, gzipped)
+
+        try:
+            offset = int(query.get('offset', [0])[0])
+            limit = query.get('limit', [None])[0]
+            if limit is not None:
+                limit = int(limit)
+            match = query.get('match', [None])[0]
+            if match is not None:
+                match = re.compile(match)
+        except (ValueError, re.error), ex:
+            return self.return_400(start_response, str(ex))
+        if offset < 0 or (limit is not None and limit < 0):
+            return self.return_400(start_response, 'Negative limit or offset')
+
+        if env is None:
+            names = self._config.host_names
+        else:
+            names = self._config.env_hosts.get(env, ())
+        prefix = query.get('prefix', [None])[0]
+        if prefix is not None:
+            start = bisect.bisect_left(names, prefix)
+            end = start
+            while end < len(names) and names[end].startswith(prefix):
+                end += 1
+            names = names[start:end]
+        if match is not None:
+            names = [name for name in names if match.search(name)]
+        headers.append(("X-Total-Count", str(len(names))))
+        if limit is None:
+            names = names[offset:]
+        else:
+            names = names[offset:offset + limit]
+
+        hosts = self._conf['hosts']
+        return self.respond(
+            environ, start_response, json.dumps(
+                dict([(name, hosts[name]) for name in names]),
+                sort_keys=True), headers)
+
+
+class ListEnvsHandler(BaseHandler):
+    """
+    Envs page.
+    """
+
+    def __init__(self, config=None):
+        """
+        Creates a ListEnvsHandler instance. The listing is serialized once
+        per config snapshot.
+        """
+        BaseHandler.__init__(self, config)
+        self._body, self._gzipped = self.precompress(
+            json.dumps(list(self._config.envs)))
+
+    def __call__(self, environ, start_response):
+        """
+        Handles the REST API endpoint listing known environments, each
+        listed once in name order.
+        """
+        return self.respond(
+            environ, start_response, self._body,
+            [("Content-Type", "application/json")], self._gzipped)
+
+
+class MetricsHandler(BaseHandler):
+    """
+    Metrics page.
+    """
+
+    def __call__(self, environ, start_response):
+        """
+        Handles the endpoint exposing metrics in the Prometheus text format.
+        """
+        return self.respond(
+            environ, start_response, metrics.render(),
+            [("Content-Type", "text/plain; version=0.0.4")])
+
+
+class ProfilesHandler(BaseHandler):
+    """
+    Profiles page.
+    """
+
+    def __init__(self, config=None):
+        """
+        Creates a ProfilesHandler instance.
+        """
+        BaseHandler.__init__(self, config)
+        self._token = self._config.profile_token
+        self._directory = os.path.sep.join([self._config.logdir, 'profiles'])
+
+    def __call__(self, environ, start_response, name=''):
+        """
+        Lists the profiles written by the request profiler, or returns the
+        profile name as a pstats file. Only available when profile.token
+        is configured and only to requests passing it in the X-Talook-Token
+        header, which unlike the query string is never logged.
+        """
+        if not self._token:
+            return self.return_404(start_response)
+        token = environ.get('HTTP_X_TALOOK_TOKEN', '')
+        if not same_token(token, self._token):
+            return self.return_403(start_response)
+
+        profiles = RequestProfiler(self._directory).list()
+        if not name:
+            return self.respond(
+                environ, start_response, json.dumps([
+                    {'name': name, 'size': size, 'mtime': mtime}
+                    for name, size, mtime in profiles]),
+                [("Content-Type", "application/json")])
+        for profile in profiles:
+            if profile[0] == name:
+                break
         else:
-            self._template_path = template_path
+            return self.return_404(start_response)
         try:
-            self._cache_dir = os.path.realpath(self._conf['cachedir'])
-            self._cache_time = datetime.timedelta(**self._conf['cachetime'])
-            self._cache = True
-            self.logger.info(
-                'Caching in %s is enabled' % self.__class__.__name__)
-        except KeyError:
-            self._cache = False
-            self.logger.info(
-                'Caching in %s is disabled' % self.__class__.__name__)
+            f = open(os.path.sep.join([self._directory, name]), 'rb')
+        except IOError:
+            return self.return_404(start_response)
+        start_response("200 OK", [
+            ("Content-Type", "application/octet-stream"),
+            ("Content-Disposition", 'attachment; filename="%s"' % name),
+            ("Content-Length", str(profile[1]))])
+        return self.send_file(environ, f)
 
-        try:
-            self._extranotes = str(self._conf['extranotes'])
-        except KeyError:
-            self._extranotes = str('')
 
-        try:
-            self._timeout = int(self._conf['timeout'])
-        except KeyError:
-            self.logger.debug('No timeout given. Defaulting to 5 seconds.')
-            self._timeout = 5
-        self.logger.info('Timeout set to %s seconds' % self._timeout)
-        socket.setdefaulttimeout(self._timeout)
+class CacheStatsHandler(BaseHandler):
+    """
+    Cache statistics page.
+    """
 
-    def render_template(self, name, **kwargs):
+    def __call__(self, environ, start_response):
         """
-        Template renderer.
+        Handles the REST API endpoint returning memory cache statistics.
         """
-        tpl = open(os.path.sep.join([self._template_path, name]), 'r').read()
-        for key, value in kwargs.items():
-            tpl = tpl.replace("{{- " + key + " -}}", value)
-        return tpl
+        stats = self._memory_cache.stats()
+        stats['open_circuits'] = circuit_breaker.open_keys()
+        start_response("200 OK", [("Content-Type", "application/json")])
+        return json.dumps(stats)
 
-    def get_from_cache(self, key, source=None):
+
+class QueryHostHandler(BaseHandler):
+    """
+    talook page.
+    """
+
+    def __call__(self, environ, start_response, host):
         """
-        Gets data from a local cache. If it's not there it will run the
-        source callable, save the result and return the results.
+        Handles the REST API proxy between restfulstatsjson and the web ui.
+        With sections= (comma separated, may be repeated) only the named
+        top level sections, or dotted paths within them, are returned.
         """
-        # If we have cache ...
-        if self._cache:
-            cache_name = os.path.sep.join([self._cache_dir, key + '.json'])
-            if not os.path.exists(cache_name):
-                self.logger.info('Key "%s" was NOT in cache.' % key)
-            # And the cache file exists ...
-            else:
-                mtime = datetime.datetime.fromtimestamp(
-                    os.stat(cache_name).st_mtime)
-                now = datetime.datetime.now()
-                # If we are still in the cache time then use the cache
-                if now - self._cache_time < mtime:
-                    self.logger.info('Found "%s" in cache.' % key)
-                    data = open(cache_name, 'r').read()
-                    return json.loads(data)
+        query = parse_qs(environ.get('QUERY_STRING', ''))
+        sections = []
+        for value in query.get('sections', []):
+            sections.extend([name for name in value.split(',') if name])
+
+        if host in self._conf['hosts']:
+            host_popularity.hit(host)
+            # Answer revalidations from the cache validators alone. The
+            # client may hold the compressed or the identity representation
+            if 'HTTP_IF_NONE_MATCH' in environ:
+                validators = self.get_cache_validators(host)
+                etags = []
+                if validators is not None:
+                    etags.append(variant_etag(validators[0], sections))
+                    if self._compress_level and accepts_gzip(environ):
+                        etags.append(
+                            variant_etag(validators[0], sections, True))
+                for etag in etags:
+                    if self.not_modified(environ, etag, validators[1]):
+                        start_response("304 Not Modified", [
+                            ("ETag", etag),
+                            ("Last-Modified", formatdate(
+                                validators[1], usegmt=True))])
+                        set_cache_outcome('revalidated')
+                        return []
+
+            # Large entries which are not in memory go from the cache
+            # directory to the client without being read into memory
+            gzipped = bool(self._compress_level and accepts_gzip(environ))
+            cached = None
+            if not sections and not self._memory_cache.has(host):
+                cached = self.get_cache_file(host, gzipped)
+                if cached is None and gzipped:
+                    cached = self.get_cache_file(host)
+                    gzipped = False
+            if cached is not None:
+                cache_name, size, mtime, etag = cached
+                try:
+                    f = open(cache_name, 'rb')
+                except IOError:
+                    pass
                 else:
-                    self.logger.info('Key "%s" is expired in cache.' % key)
+                    headers = [
+                        ("Content-Type", "application/json"),
+                        ("ETag", variant_etag(etag, (), gzipped)),
+                        ("Last-Modified", formatdate(mtime, usegmt=True)),
+                        ("Content-Length", str(size))]
+                    if gzipped:
+                        headers.append(("Content-Encoding", "gzip"))
+                        headers.append(("Vary", "Accept-Encoding"))
+                    start_response("200 OK", headers)
+                    set_cache_outcome('hit')
+                    return self.send_file(environ, f)
 
-        try:
-            status_code, data = source()
-            if self._cache and status_code == 200:
-                self.save_to_cache(key, data)
-            else:
-                self.logger.warn(
-                    'Not saving %s to cache. Non 200 response.' % key)
-            return data
-        except Exception, ex:
-            print ex
+            entry = self.query_host(host)
+            body = entry.body
+            gzipped = entry.gzipped
+            if sections:
+                body, gzipped = self.select_sections(entry, sections), None
 
-    def save_to_cache(self, key, json_data):
-        """
-        Holds data in local 'cache'.
-        """
-        cache_name = os.path.sep.join([self._cache_dir, key + '.json'])
-        f = open(cache_name, 'w')
-        f.write(json.dumps(json_data))
-        f.close()
-        self.logger.info('Saved "%s" in cache.' % key)
+            headers = [("Content-Type", "application/json")]
+            if entry.etag is not None:
+                headers.append(("ETag", variant_etag(entry.etag, sections)))
+                headers.append(("Last-Modified", formatdate(
+                    entry.created, usegmt=True)))
+            if entry.stale:
+                headers.append(
+                    ("Age", str(int(time.time() - entry.created))))
+                headers.append(("Warning", '110 - "Response is Stale"'))
+            return self.respond(
+                environ, start_response, body, headers, gzipped, sized=True)
 
-    def return_404(self, start_response, msg="404 File Not Found"):
+        return self.return_404(start_response)
+
+    def select_sections(self, entry, sections):
         """
-        Shortcut for returning 404's.
+        Returns the parts of the CacheEntry entry named by sections using
+        its section index. Errors are returned whole.
         """
-        start_response("404 File Not Found", [("Content-Type", "text/html")])
-        return str(msg)
+        index = entry.index
+        if index is None:
+            try:
+                index = build_section_index(entry.body)
+            except ValueError:
+                return entry.body
+        if index.keys() == ['error']:
+            return entry.body
+        return select_sections(entry.body, index, sections)
 
 
-class StaticFileHandler(BaseHandler):
+class HostHistoryHandler(BaseHandler):
     """
-    Handles static file serving. Will ONLY serve 1 directory deep!!
+    Host history page.
     """
 
-    def __call__(self, environ, start_response, filename):
+    def __call__(self, environ, start_response, host):
         """
-        Returns the content of a CSS, JS or PNG file with the right mimetype
-        if it exists.
+        Handles the REST API endpoint returning the changes to the stats of
+        host recorded after since= (epoch seconds, default 0), or with at=
+        the stats as they were at that time. Only available when history
+        is configured.
         """
-        real_name = os.path.sep.join(
-            [os.path.realpath(self._conf['staticdir']), filename])
-        if os.path.exists(real_name) and os.path.isfile(real_name):
-            mime_type = 'text/plain'
-            if real_name.endswith('.js'):
-                mime_type = 'application/javascript'
-            elif real_name.endswith('.css'):
-                mime_type = 'text/css'
-            elif real_name.endswith('.png'):
-                mime_type = 'image/png'
-            start_response("200 OK", [(
-                "Content-Type", mime_type)])
-            f = open(real_name, 'r')
-            for line in f.readlines():
-                yield line
-            f.close()
+        if not self._config.history or host not in self._conf['hosts']:
+            return self.return_404(start_response)
+        query = parse_qs(environ.get('QUERY_STRING', ''))
+        try:
+            since = float(query.get('since', [0])[0])
+            at = query.get('at')
+            if at is not None:
+                at = float(at[0])
+        except ValueError:
+            return self.return_400(start_response)
+
+        if at is not None:
+            snapshot = history_store.snapshot(host, at)
+            if snapshot is None:
+                return self.return_404(start_response)
+            body = json.dumps(
+                {'host': host, 'time': snapshot[0], 'stats': snapshot[1]})
         else:
-            yield self.return_404(start_response)
+            body = json.dumps({
+                'host': host, 'since': since,
+                'changes': list(history_store.changes(host, since))})
+        return self.respond(
+            environ, start_response, body,
+            [("Content-Type", "application/json")])
 
 
-class IndexHandler(BaseHandler):
+class SearchHandler(BaseHandler):
     """
-    Index page.
+    Fact search page.
     """
 
     def __call__(self, environ, start_response):
         """
-        Handles the index page.
+        Handles the REST API endpoint returning the hosts whose cached
+        stats have the fact fact= (a dotted path), grouped by its value.
+        value= narrows it down to one value and env= to one environment.
+        complete is false until entries cached by other processes have
+        been indexed once. Only available when search is configured.
         """
-        start_response("200 OK", [("Content-Type", "text/html")])
-        return self.render_template(
-            'base.html', title='Talook', extranotes=self._extranotes)
+        if not self._config.search:
+            return self.return_404(start_response)
+        query = parse_qs(environ.get('QUERY_STRING', ''))
+        fact = query.get('fact', [''])[0]
+        if not fact:
+            return self.return_400(start_response)
+        value = query.get('value', [None])[0]
+        env = query.get('env', [None])[0]
+        hosts = self._conf['hosts']
+        if env is not None:
+            hosts = set(self._config.env_hosts.get(env, ()))
 
+        # Entries cached by other processes are indexed in the background
+        fact_index.start_sync(
+            self._cache_dir, self._config.host_names,
+            self._config.search_sync)
+        body = json.dumps({
+            'fact': fact, 'env': env, 'complete': fact_index.synced(),
+            'values': fact_index.search(fact, value, hosts)}, sort_keys=True)
+        return self.respond(
+            environ, start_response, body,
+            [("Content-Type", "application/json")])
 
-class ListHostsHandler(BaseHandler):
+
+class QueryManyHostsHandler(BaseHandler):
     """
-    Hosts page.
+    Fan out page.
     """
 
     def __call__(self, environ, start_response):
         """
-        Handles the REST API endpoint listing known hosts.
+        Handles the REST API endpoint returning stats for many hosts at once.
+        Hosts are selected with host= and/or env= query parameters. With
+        neither every configured host is queried.
         """
-        start_response("200 OK", [("Content-Type", "application/json")])
-        return json.dumps(self._conf['hosts'])
+        query = parse_qs(environ.get('QUERY_STRING', ''))
+        hosts = query.get('host', [])
+        envs = query.get('env', [])
+        everything = not hosts and not envs
+        for host, env in self._conf['hosts'].items():
+            if everything or env in envs:
+                hosts.append(host)
 
+        results = {}
+        jobs = {}
+        for host in hosts:
+            if host in self._conf['hosts']:
+                jobs[host] = lambda host=host: self.query_host(host).body
+            else:
+                results[host] = {'error': {
+                    'Error': 'Unknown host: %s' % host,
+                    'Suggestion': 'Ensure the host is in the configuration'}}
 
-class ListEnvsHandler(BaseHandler):
+        self.logger.info('Querying %s hosts with %s workers' % (
+            len(jobs), self._fanout_concurrency))
+        if self._fanout_async:
+            finished = self.query_hosts_async(jobs.keys())
+        else:
+            finished = run_concurrently(
+                jobs, self._fanout_concurrency, self._fanout_deadline)
+        for host in jobs.keys():
+            if host not in finished:
+                results[host] = {'error': {
+                    'Error': 'Timed out waiting for %s.' % host,
+                    'Reason': 'Deadline of %s seconds exceeded' % (
+                        self._fanout_deadline),
+                    'Suggestion': (
+                        "Ensure that the host is listening for requests "
+                        "or raise the fanout deadline")}}
+            elif isinstance(finished[host], Exception):
+                results[host] = {'error': {
+                    'Error': 'Unable to query %s.' % host,
+                    'Reason': str(finished[host])}}
+            else:
+                results[host] = finished[host]
+
+        # Host stats are already serialized so the document is assembled
+        # around them rather than decoding and encoding them again.
+        chunks = []
+        for host, value in results.items():
+            if not isinstance(value, basestring):
+                value = json.dumps(value)
+            chunks.append('%s: %s' % (json.dumps(host), value))
+
+        return self.respond(
+            environ, start_response, '{' + ', '.join(chunks) + '}',
+            [("Content-Type", "application/json")])
+
+
+class ThreadPoolMixIn:
     """
-    Envs page.
+    Mix-in for SocketServer servers which handles requests with a fixed
+    pool of worker threads.
     """
 
-    def __call__(self, environ, start_response):
+    #: Number of worker threads
+    pool_size = 10
+    _requests = None
+    _pool = ()
+
+    def start_pool(self):
         """
-        Handles the REST API endpoint listing known environments.
+        Starts the worker threads.
         """
-        start_response("200 OK", [("Content-Type", "application/json")])
-        return json.dumps(self._conf['hosts'].values())
+        self._requests = Queue.Queue()
+        self._pool = []
+        for count in range(self.pool_size):
+            thread = threading.Thread(
+                target=self._process_requests, args=(self._requests,))
+            thread.setDaemon(True)
+            thread.start()
+            self._pool.append(thread)
 
+    def stop_pool(self):
+        """
+        Stops the worker threads once they finish their current request.
+        """
+        if self._requests is not None:
+            for thread in self._pool:
+                self._requests.put(None)
+            for thread in self._pool:
+                thread.join()
+            self._requests = None
+            self._pool = ()
 
-class QueryHostHandler(BaseHandler):
+    def _process_requests(self, requests):
+        """
+        Worker thread loop.
+        """
+        while True:
+            item = requests.get()
+            if item is None:
+                return
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            self.close_request(request)
+
+    def process_request(self, request, client_address):
+        """
+        Hands the request to the worker threads.
+        """
+        if self._requests is None:
+            self.start_pool()
+        self._requests.put((request, client_address))
+
+    def server_close(self):
+        """
+        Stops the worker threads and closes the listening socket.
+        """
+        self.stop_pool()
+        SocketServer.TCPServer.server_close(self)
+
+
+class PreForkMixIn:
     """
-    talook page.
+    Mix-in for SocketServer servers which forks worker processes that all
+    accept requests from the one listening socket.
     """
 
-    def __call__(self, environ, start_response, host):
+    #: Number of worker processes
+    workers = 2
+    #: Number of this worker process counting from 0, None in the parent
+    worker = None
+    _children = ()
+    _stopping = False
+
+    def after_fork(self):
         """
-        Handles the REST API proxy between restfulstatsjson and the web ui.
+        Called in each worker process before it starts serving.
         """
-        if host in self._conf['hosts']:
-            endpoint = self._conf['endpoint'] % host
-            self.logger.info('Requesting data from %s' % endpoint)
-            call_obj = lambda: make_get_request(endpoint)
+        # Pooled connections, the log writer and the refresh threads
+        # belong to the parent
+        connection_pool.close_all()
+        log_writer.after_fork()
+        background_refresher.after_fork()
 
-            json_data = self.get_from_cache(host, call_obj)
+    def serve_forever(self, poll_interval=0.5):
+        """
+        Forks the workers and waits for them to exit.
+        """
+        self._children = []
+        for number in range(self.workers):
+            pid = os.fork()
+            if pid == 0:
+                self.worker = number
+                self._serve_worker(poll_interval)
+            self._children.append(pid)
 
-            start_response("200 OK", [("Content-Type", "application/json")])
-            return json.dumps(json_data)
+        for pid in self._children:
+            while True:
+                try:
+                    os.waitpid(pid, 0)
+                    break
+                except OSError, ex:
+                    if ex.errno != errno.EINTR:
+                        break
 
-        return self.return_404(start_response)
+    def _serve_worker(self, poll_interval):
+        """
+        Worker process loop. Never returns.
+        """
+        status = 1
+        try:
+            signal.signal(signal.SIGTERM, self._stop_worker)
+            # The parent decides when workers stop
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            self.timeout = poll_interval
+            self.after_fork()
+            while not self._stopping:
+                self.handle_request()
+            self.server_close()
+            status = 0
+        finally:
+            # os._exit skips atexit so write out queued records first
+            log_writer.close()
+            os._exit(status)
+
+    def _stop_worker(self, signum, frame):
+        """
+        Signal handler asking a worker to stop after its current request.
+        """
+        self._stopping = True
+
+    def shutdown(self):
+        """
+        Asks every worker to stop.
+        """
+        for pid in self._children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+
+def make_server_class(base, threads=0, workers=0):
+    """
+    Returns a subclass of the SocketServer server class base which
+    handles requests with a pool of threads threads, in workers forked
+    processes or both, listening with a backlog large enough for them.
+    With neither base itself is returned.
+    """
+    bases = (base,)
+    attrs = {}
+    if threads:
+        bases = (ThreadPoolMixIn,) + bases
+        attrs['pool_size'] = threads
+    if workers:
+        bases = (PreForkMixIn,) + bases
+        attrs['workers'] = workers
+    if len(bases) == 1:
+        return base
+    # SocketServer's backlog of 5 drops connections under concurrent load
+    attrs['request_queue_size'] = max(
+        128, max(threads, 1) * max(workers, 1))
+    return type(base)(base.__name__, bases, attrs)
 
 
-def create_server(host, port):
+def create_server(host, port, threads=0, workers=0):
     """
     If the server is called directly then serve via wsgiref.
     """
-    from wsgiref.simple_server import make_server, WSGIRequestHandler
+    from wsgiref.simple_server import (
+        make_server, WSGIServer, WSGIRequestHandler)
 
     logger = create_logger(
-        'talook_access', 'talook_access.log', '%(message)s')
+        'talook_access', 'talook_access.log', access_log_format)
 
     class TalookHandler(WSGIRequestHandler):
 
+        def log_request(self, code='-', size='-'):
+            # Router writes the access log
+            pass
+
         def log_message(self, format, *args):
             logger.info("%s - - [%s] %s" % (
                 self.address_string(),
@@ -368,10 +4203,11 @@ def create_server(host, port):
 
     return (make_server(
         host, int(port), app,
+        server_class=make_server_class(WSGIServer, threads, workers),
         handler_class=TalookHandler), app)
 
 
-def create_old_server(host, port):
+def create_old_server(host, port, threads=0, workers=0):
     """
     Code for running the old server.
     """
@@ -385,7 +4221,7 @@ def create_old_server(host, port):
         """
 
         logger = create_logger(
-            'talook_access', 'talook_access.log', '%(message)s')
+            'talook_access', 'talook_access.log', access_log_format)
 
         class WSGIWrapperHandler(BaseHTTPRequestHandler):
 
@@ -405,6 +4241,10 @@ def create_old_server(host, port):
                     self.send_header(name, value)
                 self.end_headers()
 
+            def log_request(self, code='-', size='-'):
+                # Router writes the access log
+                pass
+
             # FIXME: This is being shared in another handler. Mixin?
             def log_message(self, format, *args):
                 logger.info("%s - - [%s] %s" % (
@@ -430,13 +4270,15 @@ def create_old_server(host, port):
 
                 self.environ['QUERY_STRING'] = query
                 self.environ['PATH_INFO'] = urllib.unquote(path)
+                self.environ['REQUEST_METHOD'] = self.command
+                self.environ['REMOTE_ADDR'] = self.client_address[0]
 
                 for chunk in wsgi_app(self.environ, self.start_response):
                     self.wfile.write(chunk)
 
         return WSGIWrapperHandler
 
-    class WSGILiteServer(HTTPServer):
+    class WSGILiteServer(make_server_class(HTTPServer, threads, workers)):
         """
         Not 100% WSGI compliant but enough for what we need.
         """
@@ -457,6 +4299,298 @@ def create_old_server(host, port):
     return (WSGILiteServer((host, int(port)), create_wsgi_wrapper(app)), app)
 
 
+class LoopWaker(asyncore.dispatcher):
+    """
+    Lets other threads wake an asyncore loop up to run callback in it.
+    """
+
+    def __init__(self, callback, socket_map):
+        """
+        Creates the waker within the loop of socket_map.
+        """
+        reader, self._writer = socket.socketpair()
+        self._writer.setblocking(0)
+        asyncore.dispatcher.__init__(self, reader, map=socket_map)
+        self.callback = callback
+
+    def wake(self):
+        """
+        Wakes the loop up. Safe to call from any thread.
+        """
+        try:
+            self._writer.send('x')
+        except socket.error:
+            # Already woken up and not run yet
+            pass
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.recv(4096)
+        self.callback()
+
+    def close(self):
+        asyncore.dispatcher.close(self)
+        self._writer.close()
+
+
+class AsyncWSGIChannel(asynchat.async_chat):
+    """
+    One client connection of an AsyncWSGIServer. Reads a request, hands
+    it to the server and writes the response, then closes.
+    """
+
+    #: Longest request line and headers accepted, in bytes
+    max_head = 65536
+
+    def __init__(self, server, sock, client_address):
+        """
+        Creates the channel for the accepted connection sock.
+        """
+        asynchat.async_chat.__init__(self, sock, map=server.socket_map)
+        self.server = server
+        self.client_address = client_address
+        self._incoming = []
+        self._received = 0
+        self._environ = None
+        self._busy = False
+        self.set_terminator('\r\n\r\n')
+
+    def readable(self):
+        # Nothing more is read while the application has the request
+        return not self._busy and asynchat.async_chat.readable(self)
+
+    def collect_incoming_data(self, data):
+        self._incoming.append(data)
+        self._received += len(data)
+        if self._environ is None and self._received > self.max_head:
+            self.respond('HTTP/1.0 431 Request Header Fields Too Large\r\n'
+                         'Connection: close\r\n\r\n')
+
+    def found_terminator(self):
+        """
+        Parses the request head, then reads the body if there is one.
+        """
+        if self._busy:
+            return
+        data = ''.join(self._incoming)
+        self._incoming = []
+        if self._environ is None:
+            self._environ = self.server.make_environ(data, self.client_address)
+            if self._environ is None:
+                self.respond(
+                    'HTTP/1.0 400 Bad Request\r\nConnection: close\r\n\r\n')
+                return
+            try:
+                length = int(self._environ.get('CONTENT_LENGTH') or 0)
+            except ValueError:
+                length = 0
+            if length > 0:
+                self.set_terminator(length)
+                return
+            data = ''
+        self._environ['wsgi.input'] = StringIO(data)
+        self._busy = True
+        self.server.submit(self, self._environ)
+
+    def respond(self, response):
+        """
+        Writes response and closes the connection. Only called within the
+        loop.
+        """
+        self._busy = True
+        self.push(response)
+        self.close_when_done()
+
+    def handle_error(self):
+        # Clients going away before their response is written
+        self.close()
+
+
+class AsyncWSGIServer(asyncore.dispatcher):
+    """
+    Serves a WSGI application from one asyncore loop so idle, slow and
+    waiting clients cost a socket rather than a thread. The application
+    runs on a pool of threads threads; with fanout async set
+    /hosts/stats.json fetches the hosts missing from the cache without a
+    thread each. Responses are read from the application in its thread,
+    so cache files are never read within the loop.
+    """
+
+    def __init__(self, server_address, app, threads=10):
+        """
+        Creates the server listening on server_address.
+        """
+        self.socket_map = {}
+        asyncore.dispatcher.__init__(self, map=self.socket_map)
+        self.app = app
+        self.pool_size = max(threads, 1)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(server_address)
+        self.listen(128)
+        self.server_address = self.socket.getsockname()
+        self.server_port = self.server_address[1]
+        self._stopping = False
+        self._requests = Queue.Queue()
+        self._responses = Queue.Queue()
+        self._waker = LoopWaker(self._send_responses, self.socket_map)
+        self._pool = []
+        for count in range(self.pool_size):
+            thread = threading.Thread(target=self._process_requests)
+            thread.setDaemon(True)
+            thread.start()
+            self._pool.append(thread)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            AsyncWSGIChannel(self, pair[0], pair[1])
+
+    def make_environ(self, head, client_address):
+        """
+        Returns the WSGI environ for the request head, without
+        wsgi.input, or None if head is not a valid request.
+        """
+        lines = head.split('\r\n')
+        try:
+            method, uri, protocol = lines[0].split(' ')
+        except ValueError:
+            return None
+        path, query = urllib.splitquery(uri)
+        environ = {
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': urllib.unquote(path),
+            'QUERY_STRING': query or '',
+            'SERVER_NAME': self.server_address[0],
+            'SERVER_PORT': str(self.server_port),
+            'SERVER_PROTOCOL': protocol,
+            'REMOTE_ADDR': client_address[0],
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for line in lines[1:]:
+            if ':' not in line:
+                continue
+            name, value = line.split(':', 1)
+            name = name.strip().upper().replace('-', '_')
+            if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                name = 'HTTP_' + name
+            environ[name] = value.strip()
+        return environ
+
+    def submit(self, channel, environ):
+        """
+        Hands a request to the application threads.
+        """
+        self._requests.put((channel, environ))
+
+    def _process_requests(self):
+        """
+        Application thread loop.
+        """
+        while True:
+            item = self._requests.get()
+            if item is None:
+                return
+            channel, environ = item
+            self._responses.put((channel, self.run_app(environ)))
+            self._waker.wake()
+
+    def run_app(self, environ):
+        """
+        Runs the application for environ. Returns the whole response.
+        """
+        started = []
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info is not None and started:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            started[:] = [status, headers]
+
+        try:
+            result = self.app(environ, start_response)
+            try:
+                if isinstance(result, str):
+                    body = result
+                else:
+                    body = ''.join(result)
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        except Exception:
+            # The Router has logged and counted the failure already
+            started[:] = ['500 Internal Server Error', [
+                ("Content-Type", "text/html")]]
+            body = '500 Internal Server Error'
+        status, headers = started
+        if environ['REQUEST_METHOD'] == 'HEAD':
+            body = ''
+        head = ['HTTP/1.0 %s' % status]
+        for name, value in headers:
+            if name.lower() not in ('content-length', 'connection'):
+                head.append('%s: %s' % (name, value))
+        head.append('Content-Length: %s' % len(body))
+        head.append('Connection: close')
+        return '\r\n'.join(head) + '\r\n\r\n' + body
+
+    def _send_responses(self):
+        """
+        Writes the responses the application threads finished. Only
+        called within the loop.
+        """
+        while True:
+            try:
+                channel, response = self._responses.get_nowait()
+            except Queue.Empty:
+                return
+            if channel.connected:
+                channel.respond(response)
+
+    def serve_forever(self, poll_interval=0.5):
+        """
+        Runs the loop until shutdown is called.
+        """
+        while not self._stopping:
+            asyncore.loop(timeout=poll_interval, use_poll=True,
+                          map=self.socket_map, count=1)
+
+    def shutdown(self):
+        """
+        Asks the loop to stop. Safe to call from any thread.
+        """
+        self._stopping = True
+        self._waker.wake()
+
+    def server_close(self):
+        """
+        Closes every connection and stops the application threads once
+        they finish their current request.
+        """
+        for dispatcher in self.socket_map.values():
+            dispatcher.close()
+        for thread in self._pool:
+            self._requests.put(None)
+        for thread in self._pool:
+            thread.join()
+        self._pool = []
+
+
+def create_async_server(host, port, threads=0):
+    """
+    Serves the application from an AsyncWSGIServer loop with a pool of
+    threads threads (10 if 0).
+    """
+    app = make_app()
+    return (AsyncWSGIServer((host, int(port)), app, threads or 10), app)
+
+
 class ServerThread(threading.Thread):
     """
     Thread for the server to run in.
@@ -489,6 +4623,7 @@ class ServerThread(threading.Thread):
         How to run.
         """
         self.server.serve_forever()
+        self.server.server_close()
         self.logger.info('ServerThread %s is exiting NOW!' % self.getName())
         raise SystemExit(0)
 
@@ -516,18 +4651,216 @@ class ConfigPoller(ServerThread):
         """
         How to run.
         """
-        mtime = os.stat(os.environ['TALOOK_CONFIG_FILE']).st_mtime
+        watcher = ConfigWatcher(os.environ['TALOOK_CONFIG_FILE'])
         while not self._terminate:
-            current_mtime = os.stat(os.environ['TALOOK_CONFIG_FILE']).st_mtime
-            if mtime != current_mtime:
-                mtime = current_mtime
+            if watcher.wait(1):
                 try:
                     self.app.reload()
                     self.logger.info('Config has successfully reloaded.')
                 except ValueError:
                     self.logger.error(
                         'JSON is invalid. Config was not reloaded.')
-            time.sleep(1)
+        watcher.close()
+        raise SystemExit(0)
+
+
+class CacheCrawler(ServerThread):
+    """
+    Thread keeping the cache warm. Every configured host is refreshed a
+    little before its entry expires, at a jittered time so the agents are
+    not all asked at once, with at most crawl concurrency refreshes
+    running. Hosts which are due together are refreshed most requested
+    first.
+    """
+
+    #: Variable to note if the crawler should terminate
+    _terminate = False
+
+    def __init__(self, *args, **kwargs):
+        """
+        Creates the thread object with an empty schedule.
+        """
+        ServerThread.__init__(self, *args, **kwargs)
+        self._condition = threading.Condition()
+        self._config = None
+        self._handler = None
+        # Heap of (due, host); entries no longer matching _scheduled are
+        # skipped when they come up
+        self._heap = []
+        # host: due, or None while it is being refreshed
+        self._scheduled = {}
+        self._ready = []
+        self._in_flight = 0
+
+    def start(self):
+        """
+        How to start the thread.
+        """
+        threading.Thread.start(self)
+
+    def terminate(self):
+        """
+        How to signal the thread to end.
+        """
+        self._condition.acquire()
+        try:
+            self._terminate = True
+            self._condition.notify()
+        finally:
+            self._condition.release()
+
+    def schedule(self, config, now=None):
+        """
+        Brings the schedule in line with the Config snapshot config. New
+        hosts are due when their cache entry is; removed hosts are
+        dropped. Everything is scheduled anew when where or for how long
+        entries are cached changes.
+        """
+        if now is None:
+            now = time.time()
+        previous = self._config
+        self._config = config
+        if not config.cache:
+            self._heap, self._scheduled, self._ready = [], {}, []
+            return
+        self._handler = BaseHandler(config)
+        if previous is not None and config.changed_keys(previous) & set([
+                'cachedir', 'cachetime', 'crawl', 'endpoint']):
+            self._heap, self._scheduled, self._ready = [], {}, []
+
+        hosts = config.conf['hosts']
+        for host in self._scheduled.keys():
+            if host not in hosts:
+                del self._scheduled[host]
+        self._ready = [host for host in self._ready if host in hosts]
+        for host in config.host_names:
+            if host not in self._scheduled:
+                self._push(host, self._next_due(host, now))
+
+    def _push(self, host, due):
+        self._scheduled[host] = due
+        heapq.heappush(self._heap, (due, host))
+
+    def _next_due(self, host, now):
+        """
+        Returns when host should next be refreshed: a jittered time shortly
+        before its cache entry expires, or within the jitter window from
+        now if it has none.
+        """
+        config = self._config
+        jitter = random.uniform(0, config.cache_seconds * config.crawl_jitter)
+        created = self._created(host)
+        if created is None:
+            return now + jitter
+        return created + config.cache_seconds * (1 - config.crawl_lead) - \
+            jitter
+
+    def _created(self, host):
+        """
+        Returns when the cache entry of host was written, or None if there
+        isn't one.
+        """
+        try:
+            return os.stat(os.path.sep.join(
+                [self._config.cache_dir, host + '.json'])).st_mtime
+        except OSError:
+            return None
+
+    def take(self, now, count):
+        """
+        Returns up to count hosts due at now, most requested first, and
+        marks them as being refreshed.
+        """
+        added = False
+        while self._heap and self._heap[0][0] <= now:
+            due, host = heapq.heappop(self._heap)
+            if self._scheduled.get(host) == due:
+                self._scheduled[host] = None
+                self._ready.append(host)
+                added = True
+        if added:
+            self._ready.sort(
+                key=lambda host: host_popularity.score(host, now),
+                reverse=True)
+        taken = self._ready[:max(count, 0)]
+        del self._ready[:len(taken)]
+        return taken
+
+    def finish(self, host, now=None):
+        """
+        Schedules the next refresh of host after one finished. If its entry
+        was not renewed it is tried again after errortime.
+        """
+        if now is None:
+            now = time.time()
+        if self._scheduled.get(host, 0) is not None:
+            # Removed or rescheduled while it was refreshed
+            return
+        due = self._next_due(host, now)
+        if due <= now or self._created(host) is None:
+            config = self._config
+            due = now + max(config.error_seconds, 1) * (
+                1 + random.uniform(0, config.crawl_jitter))
+        self._push(host, due)
+
+    def refresh(self, host):
+        """
+        Refreshes host unless a request refreshed it since it was
+        scheduled, it failed within errortime or its circuit is open.
+        """
+        config = self._config
+        handler = self._handler
+        created = self._created(host)
+        if created is not None and time.time() - created < \
+                config.cache_seconds * (
+                    1 - config.crawl_lead - config.crawl_jitter):
+            return
+        try:
+            if negative_cache.get(host) is None and \
+                    circuit_breaker.allow(host):
+                endpoint = handler._conf['endpoint'] % host
+                handler.fetch_entry(
+                    host, lambda: make_raw_get_request(endpoint))
+                metrics.inc('talook_crawl_refreshes_total')
+        except Exception, ex:
+            self.logger.error('Crawling "%s" failed: %s' % (host, ex))
+
+    def _refresh_and_finish(self, host):
+        try:
+            self.refresh(host)
+        finally:
+            self._condition.acquire()
+            try:
+                self._in_flight -= 1
+                self.finish(host)
+                self._condition.notify()
+            finally:
+                self._condition.release()
+
+    def run(self):
+        """
+        How to run.
+        """
+        self._condition.acquire()
+        try:
+            while not self._terminate:
+                config = get_config()
+                if config is not self._config:
+                    self.schedule(config)
+                now = time.time()
+                for host in self.take(
+                        now, config.crawl_concurrency - self._in_flight):
+                    self._in_flight += 1
+                    thread = threading.Thread(
+                        target=self._refresh_and_finish, args=(host,))
+                    thread.setDaemon(True)
+                    thread.start()
+                timeout = 1
+                if self._heap and not self._ready:
+                    timeout = min(max(self._heap[0][0] - now, 0.01), 1)
+                self._condition.wait(timeout)
+        finally:
+            self._condition.release()
         raise SystemExit(0)
 
 
@@ -535,13 +4868,19 @@ def make_app():
     """
     Creates a WSGI application for use.
     """
-    return Router({
-        '^/$': IndexHandler(),
-        '/hosts.json$': ListHostsHandler(),
-        '/envs.json$': ListEnvsHandler(),
-        '/host/(?P<host>[\w\.\-]*).json?$': QueryHostHandler(),
-        '/static/(?P<filename>[\w\-\.]*$)': StaticFileHandler(),
-    })
+    return Router([
+        ('/static/(?P<filename>[\w\-\.]*$)', StaticFileHandler()),
+        ('/host/(?P<host>[\w\.\-]*).json?$', QueryHostHandler()),
+        ('/host/(?P<host>[\w\.\-]*)/history.json$', HostHistoryHandler()),
+        ('^/$', IndexHandler()),
+        ('/hosts.json$', ListHostsHandler()),
+        ('/envs.json$', ListEnvsHandler()),
+        ('/hosts/stats.json$', QueryManyHostsHandler()),
+        ('/search.json$', SearchHandler()),
+        ('/cache.json$', CacheStatsHandler()),
+        ('/metrics$', MetricsHandler()),
+        ('/profiles/(?P<name>[\w\-\.]*)$', ProfilesHandler()),
+    ])
 
 
 def main():
@@ -560,27 +4899,72 @@ def main():
     parser.add_option(
         '-r', '--reload', dest='reload', default=False, action='store_true',
         help='Enable reloading on config change. (Default: False)')
+    parser.add_option(
+        '-t', '--threads', dest='threads', default=0, type='int',
+        help='Threads handling requests per process. (Default: 0)')
+    parser.add_option(
+        '-w', '--workers', dest='workers', default=0, type='int',
+        help='Worker processes to fork. (Default: 0)')
+    parser.add_option(
+        '-k', '--crawl', dest='crawl', default=False, action='store_true',
+        help='Keep the cache warm in the background. (Default: False)')
+    parser.add_option(
+        '-a', '--async', dest='async', default=False, action='store_true',
+        help=('Serve connections from one event loop, running requests on '
+              '--threads threads. (Default: False)'))
 
     (options, args) = parser.parse_args()
+    if options.async and options.workers:
+        parser.error('--async can not be used with --workers')
 
     os.environ['TALOOK_CONFIG_FILE'] = options.config
     py_version = platform.python_version()
 
     server = None
+    if options.async:
+        server, app = create_async_server(
+            options.listen, options.port, options.threads)
     # Fall back to old school container if on 2.4.x
-    if py_version >= '2.4.0' and py_version < '2.5.0':
-        server, app = create_old_server(options.listen, options.port)
+    elif py_version >= '2.4.0' and py_version < '2.5.0':
+        server, app = create_old_server(
+            options.listen, options.port, options.threads, options.workers)
     # Else use the builtin wsgi container
     elif py_version >= '2.5.0':
-        server, app = create_server(options.listen, options.port)
+        server, app = create_server(
+            options.listen, options.port, options.threads, options.workers)
     else:
         print 'Untested Python version in use: %s' % py_version
         raise SystemExit(1)
 
-    if options.reload:
-        config_poller_thread = ConfigPoller()
-        config_poller_thread.setDaemon(True)
-        config_poller_thread.start(app)
+    config_poller_thread = None
+    crawler_thread = None
+    if options.workers and (options.reload or options.crawl):
+        # Every worker process has its own app to reload. One crawler is
+        # enough as the cache directory is shared, so it runs in the
+        # first worker and learns which hosts are busy from its requests.
+        def after_fork(after_fork=server.after_fork):
+            after_fork()
+            if options.reload:
+                poller = ConfigPoller()
+                poller.setDaemon(True)
+                poller.start(app)
+            if options.crawl and server.worker == 0:
+                crawler = CacheCrawler()
+                crawler.setDaemon(True)
+                crawler.start()
+        server.after_fork = after_fork
+    else:
+        if options.reload:
+            config_poller_thread = ConfigPoller()
+            config_poller_thread.setDaemon(True)
+            config_poller_thread.start(app)
+        if options.crawl:
+            crawler_thread = CacheCrawler()
+            crawler_thread.setDaemon(True)
+            crawler_thread.start()
+
+    # Stop the same way on SIGTERM as on ^C so workers get cleaned up
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
 
     print "server listening on http://%s:%s" % (options.listen, options.port)
     server_thread = ServerThread()
@@ -592,11 +4976,15 @@ def main():
         try:
             time.sleep(10)
         except KeyboardInterrupt:
-            if options.reload:
+            if config_poller_thread is not None:
                 config_poller_thread.terminate()
                 config_poller_thread.join()
+            if crawler_thread is not None:
+                crawler_thread.terminate()
+                crawler_thread.join()
             server_thread.terminate()
             server_thread.join()
+            log_writer.close()
             raise SystemExit(0)
 
     raise SystemExit(0)
@@ -18,28 +18,11 @@ $(document).ready(function(){
 CURRENT_ENV = null;
 //EXTRANOTES = "{{- extranotes -}}";
 EXTRANOTES = "";
-var hosts = {};
-
-// Get the host list from the hosts local endpoint
-$.ajax({
-    url: 'hosts.json',
-    async: false,
-    success: function(data) {
-        $.each(data, function(key, value) {
-            hosts[key] = value;
-        });
-}});
-
-var envs = ['All'];
 add_topnav_env('All');
 // Get the envs list from the envs local endpoint
 $.getJSON('envs.json', function(data) {
     $.each(data, function(index, value) {
-        // only add an env name if it isn't already in the list
-        if (envs.indexOf(value) == -1) {
-            envs.push(value);
-            add_topnav_env(value);
-        }
+        add_topnav_env(value);
     });
 });
 
@@ -52,22 +35,20 @@ function load_hosts(env) {
     CURRENT_ENV = env;
     $("li[id^='env-']").removeClass('active');
     $("#env-" + env).addClass('active');
-    $("#sidenav").empty();
-    var $env_hosts = [];
-    $.each(hosts, function(host, hostenv) {
-        if (hostenv == env || env == 'All') {
-            $env_hosts.push(host);
-        };
-    });
-    $env_hosts.sort();
-    var $host_filter = new RegExp(get_host_filter());
-    $.each($env_hosts, function(i, host) {
-        if ($host_filter.test(host)) {
+    // The server does the filtering so only matching hosts are sent
+    var params = {match: get_host_filter()};
+    if (env != 'All') {
+        params.env = env;
+    }
+    $.getJSON('hosts.json', params, function(data) {
+        $("#sidenav").empty();
+        var $env_hosts = Object.keys(data).sort();
+        $.each($env_hosts, function(i, host) {
             $("#sidenav").append( '<li id="statsloader-' + host.replace(/\./g, '') + '" ><a href="#" onClick="load_stats(\''+host+'\')">'+host+'</a></li>');
-        }
+        });
+        var num_hosts = $('#sidenav li').length;
+        $("#sidenav").prepend( $('<li class="nav-header">Hosts (' + num_hosts + ')</li>'));
     });
-    var num_hosts = $('#sidenav li').length;
-    $("#sidenav").prepend( $('<li class="nav-header">Hosts (' + num_hosts + ')</li>'));
 };
 
 // Read the current filter from the filter input
@@ -131,11 +112,13 @@ function load_stats(host) {
 function load_from_hash() {
     var parts = document.location.hash.split('/');
     if (parts[1] == 'host') {
-        if (hosts.hasOwnProperty(parts[2])) {
-            load_stats(parts[2]);
-        } else {
-            alert('Unknown host.');
-        }
+        $.getJSON('hosts.json', {prefix: parts[2]}, function(data) {
+            if (data.hasOwnProperty(parts[2])) {
+                load_stats(parts[2]);
+            } else {
+                alert('Unknown host.');
+            }
+        });
     }
 };
 
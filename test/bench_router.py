@@ -0,0 +1,97 @@
+"""
+Micro-benchmark of Router dispatch cost. Only finding and calling the
+app is measured; the access log, metrics and profiling Router adds around
+it are measured separately as "full".
+
+Run from the main directory with: python -m test.bench_router
+"""
+
+import re
+import timeit
+
+from server import Router, make_app
+
+
+class LegacyRouter(object):
+    """
+    The dispatch loop Router used before rules were precompiled.
+    """
+
+    def __init__(self, rules):
+        self._rules = {}
+        for uri, app in rules.items():
+            self._rules[uri] = {'app': app, 'regex': re.compile(uri)}
+
+    def __call__(self, environ, start_response):
+        if environ['PATH_INFO'] in self._rules.keys():
+            return self._rules[environ['PATH_INFO']]['app'].__call__(
+                environ, start_response)
+        for uri, data in self._rules.items():
+            if uri == '':
+                continue
+            if data['regex'].match(environ['PATH_INFO']):
+                kwargs = data['regex'].match(environ['PATH_INFO']).groupdict()
+                return data['app'].__call__(environ, start_response, **kwargs)
+        start_response("404 File Not Found", [("Content-Type", "text/html")])
+        return "404 File Not Found."
+
+
+PATHS = [
+    '/',
+    '/static/bootstrap.min.css',
+    '/static/jquery-2.0.3.min.js',
+    '/hosts.json',
+    '/envs.json',
+    '/host/somehost.example.com.json',
+    '/nothing/here',
+]
+
+
+def noop_app(environ, start_response, **kwargs):
+    return ''
+
+
+def noop_start_response(status, headers):
+    pass
+
+
+def compiled_dispatch(router):
+    """
+    Returns a callable routing like router without its bookkeeping.
+    """
+    def dispatch(environ, start_response):
+        uri, app, kwargs = router.match(environ['PATH_INFO'])
+        if app is None:
+            start_response(
+                "404 File Not Found", [("Content-Type", "text/html")])
+            return "404 File Not Found."
+        return app(environ, start_response, **kwargs)
+    return dispatch
+
+
+def main(number=20000):
+    """
+    Prints the per request dispatch cost of both routers over PATHS, and
+    the cost of a full Router call.
+    """
+    rules = {}
+    for uri in make_app()._rules.keys():
+        rules[uri] = noop_app
+    router = Router(rules)
+    routers = [
+        ('legacy', LegacyRouter(rules)),
+        ('compiled', compiled_dispatch(router)),
+        ('full', router)]
+    environs = [{'PATH_INFO': path} for path in PATHS]
+
+    for name, router in routers:
+        def dispatch():
+            for environ in environs:
+                router(environ, noop_start_response)
+        seconds = min(timeit.Timer(dispatch).repeat(3, number))
+        print '%-10s %.2f usec per request' % (
+            name, seconds / (number * len(environs)) * 1000000)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,417 @@
+"""
+End to end benchmark of talook against a local stub jsonstats agent.
+
+Every route is measured with synthetic configurations of 10, 1k and 50k
+hosts, both by calling make_app() directly and over HTTP through
+create_server. Throughput and p50/p99 latency are written to a JSON file
+which can be compared with an earlier run.
+
+Run from the main directory with: python -m test.bench_suite
+"""
+
+import httplib
+import os
+import platform
+import random
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from optparse import OptionParser
+from SocketServer import ThreadingMixIn
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+import server
+
+
+#: Hosts in each synthetic configuration
+SIZES = (10, 1000, 50000)
+
+#: Hosts per environment in synthetic configurations
+HOSTS_PER_ENV = 100
+
+
+class StubAgentHandler(BaseHTTPRequestHandler):
+    """
+    Answers like a jsonstats agent. Hosts named dead-* always fail and
+    hang-* never answer in time; everyone else gets a payload after the
+    configured latency, or an error at the configured error rate.
+    """
+
+    def do_GET(self):
+        stub = self.server
+        host = self.path.strip('/')
+        if host.startswith('hang-'):
+            time.sleep(stub.hang)
+        if stub.latency:
+            time.sleep(stub.latency)
+        if host.startswith('dead-') or random.random() < stub.error_rate:
+            self.send_response(500, 'Stub failure')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(stub.payload)))
+        self.end_headers()
+        self.wfile.write(stub.payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubAgentServer(ThreadingMixIn, HTTPServer):
+    """
+    Local stand in for every jsonstats agent. The endpoint for talook is
+    http://127.0.0.1:<port>/%s.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, payload_size=65536, latency=0, error_rate=0, hang=30):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubAgentHandler)
+        self.payload = make_payload(payload_size)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.hang = hang
+
+    def handle_error(self, request, client_address):
+        # talook giving up on hanging requests is expected
+        pass
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def make_payload(size):
+    """
+    Returns a jsonstats like document of about size bytes.
+    """
+    sections = {}
+    count = 0
+    while len(json.dumps(sections)) < size:
+        section = sections.setdefault('section%d' % (count % 20), {})
+        section['fact%d' % count] = 'value %d %s' % (count, 'x' * 40)
+        count += 1
+    return json.dumps(sections)
+
+
+def write_config(directory, size, endpoint):
+    """
+    Writes a configuration of size hosts to directory and returns its
+    path. Besides the healthy hosts there is one dead host and one
+    hanging host.
+    """
+    hosts = {}
+    for number in range(size):
+        hosts['host%05d' % number] = 'env%d' % (number // HOSTS_PER_ENV)
+    hosts['dead-host'] = 'env0'
+    hosts['hang-host'] = 'env0'
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    directory = os.path.join(directory, str(size))
+    conf = {
+        'hosts': hosts,
+        'endpoint': endpoint,
+        'templatedir': os.path.join(root, 'templates'),
+        'staticdir': os.path.join(root, 'static'),
+        'logdir': os.path.join(directory, 'logs'),
+        'cachedir': os.path.join(directory, 'cache'),
+        'cachetime': {'hours': 1},
+        'timeout': 2,
+    }
+    os.makedirs(conf['cachedir'])
+    path = os.path.join(directory, 'config-%d.json' % size)
+    f = open(path, 'w')
+    try:
+        json.dump(conf, f)
+    finally:
+        f.close()
+    return path
+
+
+def load_config(path):
+    """
+    Makes path the current configuration and forgets all cached state.
+    """
+    os.environ['TALOOK_CONFIG_FILE'] = path
+    config = server.reload_config()
+    server.memory_cache.clear()
+    server.negative_cache.clear()
+    server.invalidate_cache(config, config.host_names)
+    return config
+
+
+def make_cases(config):
+    """
+    Returns (name, path, prepare) for every case. prepare is called with
+    the request number before each request and is not timed.
+    """
+    # Host names come from JSON as unicode, WSGI paths are str
+    names = [str(name) for name in config.host_names
+             if name not in ('dead-host', 'hang-host')]
+    hit = names[0]
+
+    def miss(number):
+        # Always a host whose entry has just been dropped
+        server.invalidate_cache(config, [names[number % len(names)]])
+
+    return [
+        ('index', lambda number: '/', None),
+        ('static', lambda number: '/static/style.css', None),
+        ('hosts.json', lambda number: '/hosts.json', None),
+        ('envs.json', lambda number: '/envs.json', None),
+        ('host cache hit', lambda number: '/host/%s.json' % hit, None),
+        ('host cache miss',
+         lambda number: '/host/%s.json' % names[number % len(names)], miss),
+        ('host dead', lambda number: '/host/dead-host.json', None),
+        ('host hanging', lambda number: '/host/hang-host.json', None),
+    ]
+
+
+def percentile(latencies, fraction):
+    """
+    Returns the fraction percentile of the sorted list latencies.
+    """
+    return latencies[int(round(fraction * (len(latencies) - 1)))]
+
+
+def summarize(latencies, elapsed):
+    """
+    Returns the result dictionary for latencies in seconds measured over
+    elapsed seconds.
+    """
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'throughput': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+    }
+
+
+def run_direct(app, path, prepare, requests):
+    """
+    Calls app requests times for path and returns the result dictionary.
+    """
+    def start_response(status, headers, exc_info=None):
+        pass
+
+    latencies = []
+    elapsed = 0
+    for number in range(requests):
+        if prepare is not None:
+            prepare(number)
+        environ = {
+            'PATH_INFO': path(number), 'QUERY_STRING': '',
+            'REQUEST_METHOD': 'GET', 'REMOTE_ADDR': '127.0.0.1'}
+        started = time.time()
+        result = app(environ, start_response)
+        for chunk in result:
+            pass
+        if hasattr(result, 'close'):
+            result.close()
+        latency = time.time() - started
+        latencies.append(latency)
+        elapsed += latency
+    return summarize(latencies, elapsed)
+
+
+def run_http(port, path, prepare, requests, concurrency):
+    """
+    Requests path from the server on port requests times from concurrency
+    threads and returns the result dictionary.
+    """
+    latencies = []
+    numbers = range(requests)
+    lock = threading.Lock()
+
+    def client():
+        while True:
+            lock.acquire()
+            try:
+                if not numbers:
+                    return
+                number = numbers.pop()
+                if prepare is not None:
+                    prepare(number)
+            finally:
+                lock.release()
+            started = time.time()
+            connection = httplib.HTTPConnection('127.0.0.1', port, timeout=30)
+            try:
+                connection.request('GET', path(number))
+                connection.getresponse().read()
+            finally:
+                connection.close()
+            latencies.append(time.time() - started)
+
+    threads = [threading.Thread(target=client) for count in range(concurrency)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(latencies, time.time() - started)
+
+
+def run_size(size, directory, endpoint, options):
+    """
+    Returns the results of every case for a configuration of size hosts.
+    """
+    config = load_config(write_config(directory, size, endpoint))
+    results = []
+
+    app = server.make_app()
+    for case, path, prepare in make_cases(config):
+        result = run_direct(app, path, prepare, options.requests)
+        result.update({'hosts': size, 'mode': 'wsgi', 'case': case})
+        results.append(result)
+        print_result(result)
+
+    load_config(config.path)
+    httpd, app = server.create_server(
+        '127.0.0.1', 0, threads=options.concurrency)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    try:
+        for case, path, prepare in make_cases(config):
+            result = run_http(
+                httpd.server_port, path, prepare, options.requests,
+                options.concurrency)
+            result.update({'hosts': size, 'mode': 'http', 'case': case})
+            results.append(result)
+            print_result(result)
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+    return results
+
+
+def print_result(result):
+    print '%6s hosts %-5s %-16s %9.1f req/s  p50 %8.3f ms  p99 %8.3f ms' % (
+        result['hosts'], result['mode'], result['case'],
+        result['throughput'], result['p50_ms'], result['p99_ms'])
+
+
+def compare(results, baseline_path, threshold):
+    """
+    Prints every result whose p99 or throughput is more than threshold
+    (a fraction) worse than in the results file at baseline_path. Returns
+    the number of regressions.
+    """
+    f = open(baseline_path)
+    try:
+        baseline = json.load(f)['results']
+    finally:
+        f.close()
+    previous = dict([
+        ((result['hosts'], result['mode'], result['case']), result)
+        for result in baseline])
+    regressions = 0
+    for result in results:
+        old = previous.get((result['hosts'], result['mode'], result['case']))
+        if old is None:
+            continue
+        slower = old['p99_ms'] and result['p99_ms'] / old['p99_ms'] - 1
+        fewer = old['throughput'] and (
+            1 - result['throughput'] / old['throughput'])
+        if slower > threshold or fewer > threshold:
+            regressions += 1
+            print 'REGRESSION %s hosts %s %s: p99 %+.0f%%, ' \
+                'throughput %+.0f%%' % (
+                    result['hosts'], result['mode'], result['case'],
+                    slower * 100, -fewer * 100)
+    return regressions
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option(
+        '-s', '--sizes', dest='sizes', default=','.join(map(str, SIZES)),
+        help='Comma separated host counts (Default: %default)')
+    parser.add_option(
+        '-n', '--requests', dest='requests', default=200, type='int',
+        help='Requests per case (Default: %default)')
+    parser.add_option(
+        '-c', '--concurrency', dest='concurrency', default=8, type='int',
+        help='Concurrent HTTP clients and server threads (Default: %default)')
+    parser.add_option(
+        '--payload', dest='payload', default=65536, type='int',
+        help='Stub agent payload bytes (Default: %default)')
+    parser.add_option(
+        '--latency', dest='latency', default=0.005, type='float',
+        help='Stub agent latency in seconds (Default: %default)')
+    parser.add_option(
+        '--error-rate', dest='error_rate', default=0, type='float',
+        help='Fraction of stub agent requests failing (Default: %default)')
+    parser.add_option(
+        '--hang', dest='hang', default=30, type='float',
+        help='Seconds the stub agent of hang-host takes to answer '
+             '(Default: %default)')
+    parser.add_option(
+        '-o', '--output', dest='output', default='bench_results.json',
+        help='File to write results to (Default: %default)')
+    parser.add_option(
+        '--compare', dest='compare', default=None,
+        help='Earlier results file to compare against')
+    parser.add_option(
+        '--threshold', dest='threshold', default=0.2, type='float',
+        help='Fraction worse than --compare counted as a regression '
+             '(Default: %default)')
+    (options, args) = parser.parse_args()
+
+    stub = StubAgentServer(
+        options.payload, options.latency, options.error_rate, options.hang)
+    stub.start()
+    endpoint = 'http://127.0.0.1:%s/%%s' % stub.server_port
+    directory = tempfile.mkdtemp(prefix='talook-bench-')
+    socket.setdefaulttimeout(30)
+    results = []
+    try:
+        for size in [int(size) for size in options.sizes.split(',')]:
+            results.extend(run_size(size, directory, endpoint, options))
+    finally:
+        stub.stop()
+        server.log_writer.close()
+        shutil.rmtree(directory)
+
+    f = open(options.output, 'w')
+    try:
+        json.dump({
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'options': {
+                'requests': options.requests,
+                'concurrency': options.concurrency,
+                'payload': options.payload,
+                'latency': options.latency,
+                'error_rate': options.error_rate,
+                'hang': options.hang,
+            },
+            'results': results,
+        }, f, indent=1, sort_keys=True)
+    finally:
+        f.close()
+    print 'Results written to %s' % options.output
+
+    if options.compare and compare(
+            results, options.compare, options.threshold):
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,30 @@
+import gzip
+
+from StringIO import StringIO
+
+from . import TestCase
+from server import accepts_gzip, gzip_compress
+
+
+class TestAcceptsGzip(TestCase):
+
+    def test_accepts_gzip(self):
+        """
+        Verify Accept-Encoding negotiation of gzip.
+        """
+        assert accepts_gzip({'HTTP_ACCEPT_ENCODING': 'gzip, deflate'})
+        assert accepts_gzip({'HTTP_ACCEPT_ENCODING': 'deflate, GZIP;q=0.5'})
+        assert accepts_gzip({'HTTP_ACCEPT_ENCODING': '*'})
+        assert not accepts_gzip({})
+        assert not accepts_gzip({'HTTP_ACCEPT_ENCODING': 'deflate'})
+        assert not accepts_gzip({'HTTP_ACCEPT_ENCODING': 'gzip;q=0'})
+        assert not accepts_gzip({'HTTP_ACCEPT_ENCODING': 'gzip;q=x'})
+
+    def test_gzip_compress(self):
+        """
+        Verify gzip_compress output decompresses to the input.
+        """
+        data = '{"test": "data"}' * 100
+        compressed = gzip_compress(data, 9)
+        assert len(compressed) < len(data)
+        assert gzip.GzipFile(fileobj=StringIO(compressed)).read() == data
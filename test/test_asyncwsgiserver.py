@@ -0,0 +1,91 @@
+import socket
+import threading
+import time
+import urllib2
+
+from . import TestCase
+from server import AsyncWSGIServer
+
+
+def app(environ, start_response):
+    """
+    Answers based on the requested path.
+    """
+    path = environ['PATH_INFO']
+    if path == '/fail':
+        raise ValueError('broken')
+    if path == '/slow':
+        time.sleep(0.5)
+    if path == '/post':
+        body = environ['wsgi.input'].read()
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [body]
+    if path == '/missing':
+        start_response('404 File Not Found', [('Content-Type', 'text/html')])
+        return '404 File Not Found'
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return ['%s?' % path, environ['QUERY_STRING'], ' ',
+            environ.get('HTTP_X_TEST', '')]
+
+
+class TestAsyncWSGIServer(TestCase):
+
+    def setUp(self):
+        """
+        Start a server with one application thread each time for testing.
+        """
+        self.server = AsyncWSGIServer(('127.0.0.1', 0), app, 1)
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, args=(0.05,))
+        self.thread.setDaemon(True)
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%s' % self.server.server_port
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+
+    def test_requests(self):
+        """
+        Verify requests reach the application and responses the client.
+        """
+        request = urllib2.Request(
+            self.url + '/a%20b?x=1', headers={'X-Test': 'yes'})
+        response = urllib2.urlopen(request)
+        assert response.read() == '/a b?x=1 yes'
+        assert response.info()['Content-Type'] == 'text/plain'
+        assert response.info()['Content-Length'] == '12'
+        assert urllib2.urlopen(self.url + '/post', 'data').read() == 'data'
+        for path, code in [('/missing', 404), ('/fail', 500)]:
+            try:
+                urllib2.urlopen(self.url + path)
+                raise AssertionError('%s should fail' % path)
+            except urllib2.HTTPError, ex:
+                assert ex.code == code
+
+    def test_idle_clients(self):
+        """
+        Verify clients which send nothing do not hold up others.
+        """
+        idle = []
+        for count in range(20):
+            sock = socket.create_connection(
+                ('127.0.0.1', self.server.server_port))
+            sock.send('GET / HTTP/1.0\r\n')
+            idle.append(sock)
+        start = time.time()
+        assert urllib2.urlopen(self.url + '/slow').read() == '/slow? '
+        assert time.time() - start < 2
+        for sock in idle:
+            sock.close()
+
+    def test_bad_request(self):
+        """
+        Verify unparseable requests get 400 Bad Request.
+        """
+        sock = socket.create_connection(
+            ('127.0.0.1', self.server.server_port))
+        sock.send('nonsense\r\n\r\n')
+        assert sock.recv(100).startswith('HTTP/1.0 400 ')
+        sock.close()
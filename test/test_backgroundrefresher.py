@@ -0,0 +1,73 @@
+import threading
+
+import server
+
+from . import TestCase
+from server import BackgroundRefresher
+
+
+class TestBackgroundRefresher(TestCase):
+
+    def setUp(self):
+        """
+        Create an instance each time for testing.
+        """
+        self.instance = BackgroundRefresher(threads=2, max_queued=2)
+
+    def test_submit_dedupes_and_bounds(self):
+        """
+        Verify a key is refreshed once at a time, refreshes run on the
+        fixed pool and the queue is bounded.
+        """
+        release = threading.Event()
+        started = []
+        done = []
+
+        def refresh(key):
+            def func():
+                started.append(key)
+                release.wait(5)
+                done.append(key)
+            return func
+
+        assert self.instance.submit('a', refresh('a')) is True
+        assert self.instance.submit('a', refresh('a')) is False
+        assert self.instance.submit('b', refresh('b')) is True
+        while len(started) < 2:
+            release.wait(0.01)
+        # Two running and two waiting fill it up
+        for key in ('c', 'd'):
+            assert self.instance.submit(key, refresh(key)) is True
+        assert self.instance.submit('e', refresh('e')) is False
+        assert self.instance.dropped == 1
+        assert threading.activeCount() < 10
+        release.set()
+        while len(done) < 4:
+            release.wait(0.01)
+        assert sorted(done) == ['a', 'b', 'c', 'd']
+        # Finished keys may be refreshed again
+        while self.instance.submit('a', refresh('a')) is False:
+            release.wait(0.01)
+
+    def test_failures_are_logged(self):
+        """
+        Verify failing refreshes are logged and the key is released.
+        """
+        logged = []
+
+        class Logger(object):
+            def error(self, msg):
+                logged.append(msg)
+
+        def fail():
+            raise ValueError('broken')
+
+        original = server.create_logger
+        server.create_logger = lambda *args: Logger()
+        try:
+            self.instance.submit('a', fail)
+            while self.instance.submit('a', lambda: None) is False:
+                threading.Event().wait(0.01)
+        finally:
+            server.create_logger = original
+        assert logged == ['Refreshing "a" failed: broken']
@@ -1,12 +1,23 @@
 
 import datetime
+import fcntl
+import gzip
 import json
 import os
+import shutil
 import socket
 import tempfile
+import threading
+import time
+
+from StringIO import StringIO
+
+import server
 
 from . import TestCase
-from server import BaseHandler
+from server import (
+    BaseHandler, RawJSON, circuit_breaker, fact_index, history_store,
+    negative_cache)
 
 
 class TestBaseHandler(TestCase):
@@ -83,3 +94,294 @@ class TestBaseHandler(TestCase):
         json_data = json.dumps(data)
         assert self.instance.save_to_cache('test', json_data) is None
         assert json_data == self.instance.get_from_cache('test', nodata)
+
+    def test_get_raw_from_cache_uses_memory(self):
+        """
+        Verify BaseHandler.get_raw_from_cache() serves saved entries from
+        memory without going back to the cache directory.
+        """
+        self.instance._cache_dir = tempfile.gettempdir()
+        self.instance._cache = True
+        assert self.instance.save_to_cache('test', {"test": "data"}) is None
+        os.unlink(os.path.join(tempfile.gettempdir(), 'test.json'))
+        assert self.instance.get_raw_from_cache('test') == json.dumps(
+            {"test": "data"})
+        self.instance._memory_cache.delete('test')
+
+    def test_get_entry_from_cache_serves_stale(self):
+        """
+        Verify expired entries within cachestale are returned flagged as
+        stale and refreshed in the background, while entries past
+        cachestale are fetched right away.
+        """
+        self.instance._cache_dir = tempfile.gettempdir()
+        self.instance._cache = True
+        self.instance._cache_seconds = 60
+        self.instance._cache_stale_seconds = 60
+        self.instance.save_to_cache('test', {"test": "old"})
+        cache_name = os.path.join(tempfile.gettempdir(), 'test.json')
+        os.utime(cache_name, (time.time() - 90, time.time() - 90))
+        self.instance._memory_cache.delete('test')
+
+        fetched = threading.Event()
+
+        def source():
+            fetched.set()
+            return (200, {"test": "new"})
+
+        entry = self.instance.get_entry_from_cache('test', source)
+        assert entry.stale is True
+        assert json.loads(entry.body) == {"test": "old"}
+        fetched.wait(5)
+        assert fetched.isSet()
+
+        # Past the stale limit the source is used before returning
+        os.utime(cache_name, (time.time() - 150, time.time() - 150))
+        self.instance._memory_cache.delete('test')
+        entry = self.instance.get_entry_from_cache('test', source)
+        assert entry.stale is False
+        assert json.loads(entry.body) == {"test": "new"}
+        self.instance._memory_cache.delete('test')
+
+    def test_fetch_entry_waits_on_lock_file(self):
+        """
+        Verify BaseHandler.fetch_entry() waits for another process holding
+        the lock file and then uses its result instead of fetching again.
+        """
+        self.instance._cache_dir = tempfile.gettempdir()
+        self.instance._cache = True
+        self.instance._cache_seconds = 60
+        lock_name = os.path.join(tempfile.gettempdir(), 'test.lock')
+        lock_file = open(lock_name, 'a')
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+        calls = []
+        results = []
+
+        def source():
+            calls.append(1)
+            return (200, {"test": "fetched"})
+
+        thread = threading.Thread(target=lambda: results.append(
+            self.instance.fetch_entry('test', source)))
+        thread.start()
+        time.sleep(0.2)
+        # Play the other process filling the cache while holding the lock
+        self.instance.save_to_cache('test', {"test": "other"})
+        self.instance._memory_cache.delete('test')
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        lock_file.close()
+        thread.join()
+        assert calls == []
+        assert json.loads(results[0].body) == {"test": "other"}
+        self.instance._memory_cache.delete('test')
+
+    def test_raw_json_is_stored_as_is(self):
+        """
+        Verify RawJSON from a source is cached without being re-encoded
+        and its section index is kept alongside it.
+        """
+        self.instance._cache_dir = tempfile.gettempdir()
+        self.instance._cache = True
+        raw = '{ "test" :"raw" }'
+        cache_name = os.path.join(tempfile.gettempdir(), 'raw.json')
+        entry = self.instance.fetch_entry('raw', lambda: (200, RawJSON(raw)))
+        assert entry.body == raw
+        assert open(cache_name).read() == raw
+        assert entry.index == {'test': (10, 15)}
+        self.instance._memory_cache.delete('raw')
+        entry = self.instance.get_entry_from_cache('raw')
+        assert entry.index == {'test': (10, 15)}
+        self.instance._memory_cache.delete('raw')
+        os.unlink(cache_name)
+        os.unlink(cache_name + '.idx')
+
+    def test_failures_are_cached(self):
+        """
+        Verify failed fetches are remembered for errortime and the last
+        known good entry is served in their place, flagged as stale.
+        """
+        self.instance._cache_dir = tempfile.gettempdir()
+        self.instance._cache = True
+        self.instance._cache_seconds = 60
+        self.instance._error_seconds = 60
+        calls = []
+
+        def source():
+            calls.append(1)
+            return (-1, {"error": "down"})
+
+        entry = self.instance.get_entry_from_cache('failing', source)
+        assert json.loads(entry.body) == {"error": "down"}
+        entry = self.instance.get_entry_from_cache('failing', source)
+        assert json.loads(entry.body) == {"error": "down"}
+        assert len(calls) == 1
+
+        self.instance.save_to_cache('failing', {"test": "good"})
+        self.instance._memory_cache.delete('failing')
+        cache_name = os.path.join(tempfile.gettempdir(), 'failing.json')
+        os.utime(cache_name, (time.time() - 300, time.time() - 300))
+        entry = self.instance.get_entry_from_cache('failing', source)
+        assert entry.stale is True
+        assert json.loads(entry.body) == {"test": "good"}
+        assert len(calls) == 1
+
+        negative_cache.delete('failing')
+        circuit_breaker.reset('failing')
+        self.instance._memory_cache.delete('failing')
+        os.unlink(cache_name)
+
+    def test_open_circuit_skips_source(self):
+        """
+        Verify nothing is fetched while a circuit is open.
+        """
+        self.instance._cache = False
+        self.instance._error_seconds = 0
+        calls = []
+
+        def source():
+            calls.append(1)
+            return (-1, {"error": "down"})
+
+        for count in range(circuit_breaker.failures):
+            self.instance.get_entry_from_cache('broken', source)
+        entry = self.instance.get_entry_from_cache('broken', source)
+        assert len(calls) == circuit_breaker.failures
+        assert 'error' in json.loads(entry.body)
+        assert 'broken' in circuit_breaker.open_keys()
+        circuit_breaker.reset('broken')
+
+    def test_respond_compresses(self):
+        """
+        Verify BaseHandler.respond() gzips large bodies for clients which
+        accept it.
+        """
+        buffer = {}
+
+        def start_response(code, headers):
+            buffer['code'] = code
+            buffer['headers'] = headers
+
+        self.instance._compress_level = 6
+        self.instance._compress_min_size = 10
+        headers = [("Content-Type", "application/json")]
+        body = '{"test": "data"}'
+
+        result = self.instance.respond({}, start_response, body, headers)
+        assert result == body
+        assert buffer['headers'] == headers
+
+        environ = {'HTTP_ACCEPT_ENCODING': 'gzip'}
+        result = self.instance.respond(environ, start_response, body, headers)
+        assert buffer['code'] == '200 OK'
+        assert dict(buffer['headers'])['Content-Encoding'] == 'gzip'
+        assert gzip.GzipFile(fileobj=StringIO(result)).read() == body
+
+        result = self.instance.respond(
+            environ, start_response, body, headers, gzipped='precompressed')
+        assert result == 'precompressed'
+
+        result = self.instance.respond(environ, start_response, '{}', headers)
+        assert result == '{}'
+        assert buffer['headers'] == headers
+
+    def test_save_raw_to_cache_precompresses(self):
+        """
+        Verify cache entries get a gzipped copy next to them which is used
+        when the entry is read back.
+        """
+        self.instance._cache_dir = tempfile.gettempdir()
+        self.instance._cache = True
+        self.instance._compress_level = 6
+        self.instance._compress_min_size = 10
+        body = json.dumps({"test": "data"})
+        entry = self.instance.save_raw_to_cache('test', body)
+        cache_name = os.path.join(tempfile.gettempdir(), 'test.json')
+        assert open(cache_name + '.gz', 'rb').read() == entry.gzipped
+        assert gzip.GzipFile(fileobj=StringIO(entry.gzipped)).read() == body
+
+        self.instance._memory_cache.delete('test')
+        entry = self.instance.get_entry_from_cache('test')
+        assert gzip.GzipFile(fileobj=StringIO(entry.gzipped)).read() == body
+
+        # An out of date compressed copy is ignored
+        os.utime(cache_name + '.gz', (time.time() - 60, time.time() - 60))
+        self.instance._memory_cache.delete('test')
+        assert self.instance.get_entry_from_cache('test').gzipped is None
+        self.instance._memory_cache.delete('test')
+
+    def test_save_raw_to_cache_records_history(self):
+        """
+        Verify saved entries are added to the history when it is enabled.
+        """
+        directory = tempfile.mkdtemp()
+        self.instance._cache_dir = directory
+        history_store.configure(directory, 100, 10, 0)
+        try:
+            self.instance.save_raw_to_cache('test', '{"a": 1}')
+            self.instance.save_raw_to_cache('test', '{"a": 2}')
+            assert [change['set'] for change in history_store.changes(
+                'test', 0)] == [[[['a'], 1]], [[['a'], 2]]]
+        finally:
+            history_store.configure(None, 100, 10, 0)
+            self.instance._memory_cache.delete('test')
+            shutil.rmtree(directory)
+
+    def test_raw_sources_are_not_decoded_again(self):
+        """
+        Verify the index and document of RawJSON from a source are saved
+        as they are rather than worked out from the body again.
+        """
+        self.instance._cache_dir = tempfile.gettempdir()
+        self.instance._cache = True
+        fact_index.configure(True, ())
+        original = server.build_section_index
+        server.build_section_index = None
+        try:
+            raw = RawJSON('{"os": {"cpus": 2}}')
+            raw.index = {'os': (7, 18)}
+            raw.document = {'os': {'cpus': 2}}
+            entry = self.instance._get_entry_from_source(
+                'test', lambda: (200, raw))
+            assert entry.index == {'os': (7, 18)}
+            assert fact_index.search('os.cpus') == {'2': ['test']}
+        finally:
+            server.build_section_index = original
+            fact_index.configure(False, ())
+            self.instance._memory_cache.delete('test')
+
+    def test_save_raw_to_cache_updates_fact_index(self):
+        """
+        Verify saved entries are indexed when search is enabled.
+        """
+        self.instance._cache_dir = tempfile.gettempdir()
+        fact_index.configure(True, ())
+        try:
+            self.instance.save_raw_to_cache('test', '{"os": {"cpus": 2}}')
+            assert fact_index.search('os.cpus') == {'2': ['test']}
+        finally:
+            fact_index.configure(False, ())
+            self.instance._memory_cache.delete('test')
+
+    def test_get_cache_validators(self):
+        """
+        Verify BaseHandler.get_cache_validators() returns the entity tag
+        saved with an entry from memory or the cache directory.
+        """
+        self.instance._cache_dir = tempfile.gettempdir()
+        self.instance._cache = True
+        self.instance._cache_seconds = 60
+        entry = self.instance.save_raw_to_cache('test', '{"test": "data"}')
+        assert entry.etag
+        assert self.instance.get_cache_validators('test') == (
+            entry.etag, entry.created)
+
+        self.instance._memory_cache.delete('test')
+        etag, mtime = self.instance.get_cache_validators('test')
+        assert etag == entry.etag
+        assert self.instance.get_entry_from_cache('test').etag == entry.etag
+
+        self.instance._memory_cache.delete('test')
+        self.instance._cache_seconds = 0
+        assert self.instance.get_cache_validators('test') is None
+        assert self.instance.get_cache_validators('nothing_here') is None
@@ -0,0 +1,107 @@
+import json
+import os
+import shutil
+import tempfile
+
+from . import TestCase
+from server import CacheCrawler, Config, host_popularity
+
+
+class TestCacheCrawler(TestCase):
+
+    def setUp(self):
+        """
+        Create an instance with a temporary cache directory each time for
+        testing.
+        """
+        self.directory = tempfile.mkdtemp()
+        self.conf = json.load(open('test/config.json'))
+        self.conf['cachedir'] = self.directory
+        self.conf['hosts'] = {'a': 'prod', 'b': 'prod', 'c': 'qa'}
+        self.conf['crawl'] = {'lead': 0.1, 'jitter': 0.1}
+        self.instance = CacheCrawler()
+
+    def tearDown(self):
+        host_popularity.forget(['a', 'b', 'c'])
+        shutil.rmtree(self.directory)
+
+    def make_config(self):
+        path = os.path.join(self.directory, 'config.json')
+        json.dump(self.conf, open(path, 'w'))
+        return Config(path)
+
+    def cache(self, host, created):
+        path = os.path.join(self.directory, host + '.json')
+        open(path, 'w').write('{}')
+        os.utime(path, (created, created))
+
+    def test_schedule(self):
+        """
+        Verify uncached hosts are due within the jitter window and cached
+        ones shortly before they expire.
+        """
+        self.cache('a', 10000)
+        self.instance.schedule(self.make_config(), now=20000)
+        due = self.instance._scheduled
+        # cachetime is an hour, refreshed 10% to 20% before it ends
+        assert 10000 + 2880 <= due['a'] <= 10000 + 3240
+        assert 20000 <= due['b'] <= 20000 + 360
+        assert 20000 <= due['c'] <= 20000 + 360
+
+    def test_take_orders_by_popularity(self):
+        """
+        Verify due hosts are taken most requested first and no more than
+        asked for.
+        """
+        self.instance.schedule(self.make_config(), now=0)
+        host_popularity.hit('c', now=400)
+        host_popularity.hit('c', now=400)
+        host_popularity.hit('b', now=400)
+        assert self.instance.take(0, 3) == []
+        assert self.instance.take(400, 2) == ['c', 'b']
+        assert self.instance.take(400, 2) == ['a']
+        assert self.instance.take(400, 2) == []
+
+    def test_finish(self):
+        """
+        Verify hosts are scheduled again from their new entry, or after
+        errortime if it was not renewed.
+        """
+        self.instance.schedule(self.make_config(), now=0)
+        assert self.instance.take(400, 3) != []
+        self.cache('a', 1000)
+        self.instance.finish('a', now=1000)
+        self.instance.finish('b', now=1000)
+        due = self.instance._scheduled
+        assert 1000 + 2880 <= due['a'] <= 1000 + 3240
+        assert 1010 <= due['b'] <= 1011
+        assert due['c'] is None
+
+    def test_schedule_drops_removed_hosts(self):
+        """
+        Verify removed hosts are no longer crawled, even if they were
+        being refreshed.
+        """
+        self.instance.schedule(self.make_config(), now=0)
+        host_popularity.hit('a', now=400)
+        assert self.instance.take(400, 1) == ['a']
+        del self.conf['hosts']['a']
+        del self.conf['hosts']['b']
+        self.instance.schedule(self.make_config(), now=0)
+        for host in ('a', 'b'):
+            self.instance.finish(host, now=1000)
+        assert self.instance._scheduled.keys() == ['c']
+        assert self.instance.take(400, 3) == ['c']
+
+    def test_refresh_skips_fresh_entries(self):
+        """
+        Verify a host refreshed since it was scheduled is not fetched.
+        """
+        self.instance.schedule(self.make_config(), now=0)
+        self.cache('a', os.stat(self.directory).st_mtime)
+        fetched = []
+        self.instance._handler.fetch_entry = lambda key, source: \
+            fetched.append(key)
+        self.instance.refresh('a')
+        self.instance.refresh('b')
+        assert fetched == ['b']
@@ -0,0 +1,34 @@
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from . import TestCase
+from server import CacheStatsHandler
+
+
+class TestCacheStatsHandler(TestCase):
+
+    def setUp(self):
+        """
+        Create an instance each time for testing.
+        """
+        self.instance = CacheStatsHandler()
+
+    def test_call(self):
+        """
+        Verify running CacheStatsHandler returns cache statistics.
+        """
+        environ = {}
+        buffer = {}
+
+        def start_response(code, headers):
+            buffer['code'] = code
+            buffer['headers'] = headers
+
+        result = self.instance.__call__(environ, start_response)
+        assert buffer['code'] == '200 OK'
+        assert buffer['headers'] == [("Content-Type", "application/json")]
+        data = json.loads(result)
+        for key in ['entries', 'bytes', 'hits', 'misses', 'evictions']:
+            assert key in data.keys()
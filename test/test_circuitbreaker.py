@@ -0,0 +1,53 @@
+from . import TestCase
+from server import CircuitBreaker
+
+
+class TestCircuitBreaker(TestCase):
+
+    def setUp(self):
+        """
+        Create an instance each time for testing.
+        """
+        self.instance = CircuitBreaker(failures=2, backoff=10, max_backoff=30)
+
+    def test_opens_after_failures(self):
+        """
+        Verify a circuit opens after consecutive failures only.
+        """
+        self.instance.failure('host', now=0)
+        assert self.instance.allow('host', now=0) is True
+        self.instance.success('host')
+        self.instance.failure('host', now=0)
+        assert self.instance.allow('host', now=0) is True
+        self.instance.failure('host', now=0)
+        assert self.instance.allow('host', now=5) is False
+        assert self.instance.open_keys() == ['host']
+        assert self.instance.allow('other', now=5) is True
+
+    def test_half_open_probe(self):
+        """
+        Verify one probe is let through after the backoff, failed probes
+        double the backoff up to its maximum and a success closes it.
+        """
+        self.instance.failure('host', now=0)
+        self.instance.failure('host', now=0)
+        assert self.instance.allow('host', now=10) is True
+        assert self.instance.allow('host', now=10) is False
+        self.instance.failure('host', now=10)
+        assert self.instance.allow('host', now=29) is False
+        assert self.instance.allow('host', now=30) is True
+        self.instance.failure('host', now=30)
+        # Capped at max_backoff rather than 40
+        assert self.instance.allow('host', now=60) is True
+        self.instance.success('host')
+        assert self.instance.open_keys() == []
+        assert self.instance.allow('host', now=60) is True
+
+    def test_disabled(self):
+        """
+        Verify failures of 0 never opens a circuit.
+        """
+        self.instance.configure(0, 10, 30)
+        for count in range(10):
+            self.instance.failure('host', now=0)
+        assert self.instance.allow('host', now=0) is True
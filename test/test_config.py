@@ -0,0 +1,85 @@
+import datetime
+import os
+
+from . import TestCase
+from server import (
+    CacheEntry, Config, get_config, invalidate_cache, memory_cache,
+    reload_config)
+
+
+class TestConfig(TestCase):
+
+    def setUp(self):
+        """
+        Point at the test configuration each time for testing.
+        """
+        os.environ['TALOOK_CONFIG_FILE'] = 'test/config.json'
+        self.instance = Config('test/config.json')
+
+    def tearDown(self):
+        os.environ['TALOOK_CONFIG_FILE'] = './config.json'
+
+    def test_creation(self):
+        """
+        Verify derived values are computed from the configuration.
+        """
+        assert self.instance.conf['hosts'] == {
+            'localhost': 'prod', '127.0.0.1': 'qa'}
+        assert self.instance.cache is True
+        assert self.instance.cache_time == datetime.timedelta(hours=1)
+        assert self.instance.cache_seconds == 3600
+        assert self.instance.timeout == 3
+        assert self.instance.host_names == ('127.0.0.1', 'localhost')
+        assert self.instance.envs == ('prod', 'qa')
+        assert self.instance.env_hosts == {
+            'prod': ('localhost',), 'qa': ('127.0.0.1',)}
+
+    def test_immutable(self):
+        """
+        Verify snapshots can not be changed.
+        """
+        self.assertRaises(
+            AttributeError, setattr, self.instance, 'timeout', 1)
+
+    def test_invalid_json(self):
+        """
+        Verify invalid configuration raises ValueError.
+        """
+        self.assertRaises(ValueError, Config, 'README.md')
+
+    def test_get_config_is_shared(self):
+        """
+        Verify get_config returns one snapshot until reloaded or pointed
+        at another file.
+        """
+        config = get_config()
+        assert config.path == 'test/config.json'
+        assert get_config() is config
+        reloaded = reload_config()
+        assert reloaded is not config
+        assert get_config() is reloaded
+        os.environ['TALOOK_CONFIG_FILE'] = './config.json'
+        assert get_config().path == './config.json'
+
+    def test_changed_keys(self):
+        """
+        Verify changed top level keys are found.
+        """
+        other = Config('./config.json')
+        assert self.instance.changed_keys(self.instance) == set()
+        assert self.instance.changed_keys(other) == set([
+            'cachedir', 'cachetime', 'timeout'])
+
+    def test_invalidate_cache(self):
+        """
+        Verify invalidation removes entries from memory and disk.
+        """
+        cache_dir = self.instance.cache_dir
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        path = os.path.join(cache_dir, 'invalidated.json')
+        open(path, 'w').write('{}')
+        memory_cache.set('invalidated', CacheEntry('{}', 0, None))
+        invalidate_cache(self.instance, ['invalidated'])
+        assert not os.path.exists(path)
+        assert memory_cache.get('invalidated') is None
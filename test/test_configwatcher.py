@@ -0,0 +1,66 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from . import TestCase
+from server import ConfigWatcher
+
+
+class TestConfigWatcher(TestCase):
+
+    def setUp(self):
+        """
+        Create a watched file each time for testing.
+        """
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'config.json')
+        open(self.path, 'w').write('{}')
+        self.instance = ConfigWatcher(self.path, debounce=0.2, interval=0.1)
+
+    def tearDown(self):
+        self.instance.close()
+        shutil.rmtree(self.directory)
+
+    def write(self, data, mtime):
+        open(self.path, 'w').write(data)
+        # Polling can only see whole second mtime changes on some systems
+        os.utime(self.path, (mtime, mtime))
+
+    def test_no_change(self):
+        """
+        Verify wait times out when nothing changed.
+        """
+        assert self.instance.wait(0.2) is False
+
+    def test_other_files_ignored(self):
+        """
+        Verify changes to other files in the directory are ignored.
+        """
+        open(os.path.join(self.directory, 'other.json'), 'w').write('{}')
+        assert self.instance.wait(0.2) is False
+
+    def test_burst_is_one_change(self):
+        """
+        Verify several quick writes are reported as one change.
+        """
+        def writer():
+            for count in range(3):
+                self.write('{"count": %d}' % count, 1000 + count)
+                time.sleep(0.05)
+
+        thread = threading.Thread(target=writer)
+        thread.start()
+        assert self.instance.wait(2) is True
+        thread.join()
+        assert self.instance.wait(0.3) is False
+
+    def test_polling_fallback(self):
+        """
+        Verify changes are seen when inotify is not available.
+        """
+        self.instance.close()
+        self.write('{"count": 1}', 1000)
+        assert self.instance.wait(1) is True
+        assert self.instance.wait(0.2) is False
@@ -0,0 +1,88 @@
+import threading
+
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+from . import TestCase
+from server import ConnectionPool, PooledHTTPHandler, urllib2
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    """
+    Answers every GET with a small json document over HTTP/1.1.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_GET(self):
+        body = '{"test": "response"}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestConnectionPool(TestCase):
+
+    def setUp(self):
+        """
+        Start a local keep-alive server and create a pool for it.
+        """
+        self.server = HTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+        self.server.connections = 0
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%s/' % self.server.server_port
+        self.instance = ConnectionPool(max_per_host=1, max_size=1)
+        self.opener = urllib2.build_opener(PooledHTTPHandler(self.instance))
+
+    def tearDown(self):
+        self.instance.close_all()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_connections_are_reused(self):
+        """
+        Verify sequential requests share one connection.
+        """
+        for count in range(3):
+            result = self.opener.open(self.url)
+            assert result.code == 200
+            assert result.read() == '{"test": "response"}'
+        assert self.server.connections == 1
+
+    def test_stale_connections_are_retried(self):
+        """
+        Verify a pooled connection closed underneath us is replaced.
+        """
+        self.opener.open(self.url).read()
+        conn, reused = self.instance.get('127.0.0.1', self.server.server_port)
+        assert reused
+        conn.sock.close()
+        self.instance.put('127.0.0.1', self.server.server_port, conn)
+        result = self.opener.open(self.url)
+        assert result.read() == '{"test": "response"}'
+
+    def test_idle_limits(self):
+        """
+        Verify the pool keeps no more than its limits and drops expired
+        connections.
+        """
+        conn_a, reused = self.instance.get('127.0.0.1', 1)
+        assert not reused
+        conn_b, reused = self.instance.get('127.0.0.1', 1)
+        self.instance.put('127.0.0.1', 1, conn_a)
+        self.instance.put('127.0.0.1', 1, conn_b)
+        assert self.instance.get('127.0.0.1', 1) == (conn_a, True)
+        assert self.instance.get('127.0.0.1', 1)[1] is False
+
+        self.instance.idle_time = 0
+        self.instance.put('127.0.0.1', 1, conn_a)
+        assert self.instance.get('127.0.0.1', 1)[1] is False
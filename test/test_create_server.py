@@ -9,9 +9,11 @@ import server
 
 
 # Mockings
-def create_server_mock(host, port):
+def create_server_mock(host, port, threads=0, workers=0):
     assert type(host) == str
     assert type(port) == int
+    assert type(threads) == int
+    assert type(workers) == int
     raise SystemExit(0)
 
 server.create_old_server = create_server_mock
@@ -42,3 +44,19 @@ class TestCreateServerInput(TestCase):
             assert ex.message == 2
             out_buff.seek(0)
             assert 'invalid integer' in out_buff.read()
+
+    def test_async_without_workers(self):
+        """
+        Verify --async is refused together with --workers.
+        """
+        sys.argv = ['server.py', '--async', '--workers', '2']
+        sys.stderr = StringIO()
+        try:
+            server.main()
+            raise AssertionError('main should exit')
+        except SystemExit, ex:
+            assert ex.message == 2
+            sys.stderr.seek(0)
+            assert '--workers' in sys.stderr.read()
+        finally:
+            sys.stderr = sys.__stderr__
@@ -0,0 +1,118 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+import server
+
+from . import TestCase
+from server import FactIndex
+
+
+class TestFactIndex(TestCase):
+
+    def setUp(self):
+        """
+        Create an instance each time for testing.
+        """
+        self.instance = FactIndex(enabled=True)
+        self.instance.update('a', {
+            'os': {'kernel': '2.6.32', 'cpus': 4, 'virtual': True},
+            'packages': {'bash': '4.1'}, 'ips': ['10.0.0.1', '10.0.0.2']})
+        self.instance.update('b', {
+            'os': {'kernel': '2.6.18', 'cpus': 4, 'virtual': False},
+            'packages': {'bash': '3.2'}})
+
+    def test_search(self):
+        """
+        Verify hosts are found by fact path and value, in list items too.
+        """
+        assert self.instance.search('os.kernel') == {
+            '2.6.32': ['a'], '2.6.18': ['b']}
+        assert self.instance.search('os.cpus', '4') == {'4': ['a', 'b']}
+        assert self.instance.search('os.virtual', 'true') == {'true': ['a']}
+        assert self.instance.search('packages.bash', '4.1') == {'4.1': ['a']}
+        assert self.instance.search('ips', '10.0.0.2') == {'10.0.0.2': ['a']}
+        assert self.instance.search('os.cpus', '4', keys=set(['b'])) == {
+            '4': ['b']}
+        assert self.instance.search('os.kernel', '3.10') == {}
+        assert self.instance.search('missing') == {}
+
+    def test_update_replaces(self):
+        """
+        Verify a new version of a document replaces the old one's facts
+        and removed keys are no longer found.
+        """
+        self.instance.update('a', {'os': {'kernel': '3.10'}})
+        assert self.instance.search('os.kernel') == {
+            '3.10': ['a'], '2.6.18': ['b']}
+        assert self.instance.search('packages.bash') == {'3.2': ['b']}
+        self.instance.remove('b')
+        self.instance.remove('missing')
+        assert self.instance.search('os.kernel') == {'3.10': ['a']}
+        assert self.instance._postings.keys() == ['os.kernel']
+
+    def test_sections(self):
+        """
+        Verify only the configured sections are indexed and configuring
+        other sections empties the index.
+        """
+        self.instance.configure(True, ['packages'])
+        assert self.instance.search('packages.bash') == {}
+        self.instance.update('a', {
+            'os': {'kernel': '2.6.32'}, 'packages': {'bash': '4.1'}})
+        assert self.instance.search('os.kernel') == {}
+        assert self.instance.search('packages.bash') == {'4.1': ['a']}
+
+    def test_sync(self):
+        """
+        Verify entries written by others are indexed, unchanged ones are
+        not read again and missing or removed ones are dropped.
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            json.dump({'os': {'kernel': '3.10'}},
+                      open(os.path.join(directory, 'c.json'), 'w'))
+            self.instance.sync(directory, ['a', 'c'])
+            assert self.instance.search('os.kernel') == {'3.10': ['c']}
+            mtime = self.instance._mtimes['c']
+            self.instance.update('c', {'os': {'kernel': '4.0'}}, mtime)
+            self.instance.sync(directory, ['c'])
+            assert self.instance.search('os.kernel') == {'4.0': ['c']}
+        finally:
+            shutil.rmtree(directory)
+
+    def test_sync_failures_are_logged(self):
+        """
+        Verify the background sync logs failures and keeps running.
+        """
+        logged = []
+
+        class Logger(object):
+            def error(self, msg):
+                logged.append(msg)
+
+        def fail(directory, keys):
+            raise OSError(13, 'Permission denied')
+
+        self.instance.sync = fail
+        original = server.create_logger
+        server.create_logger = lambda *args: Logger()
+        try:
+            self.instance.start_sync('/nonexistent', [], 60)
+            while not logged:
+                threading.Event().wait(0.01)
+        finally:
+            self.instance.sync = lambda directory, keys: None
+            server.create_logger = original
+        assert logged[0] == (
+            'Syncing the fact index failed: [Errno 13] Permission denied')
+
+    def test_disabled(self):
+        """
+        Verify nothing is indexed when disabled.
+        """
+        self.instance.configure(False, ())
+        self.instance.update('a', {'os': {'kernel': '2.6.32'}})
+        assert self.instance.search('os.kernel') == {}
@@ -0,0 +1,145 @@
+import json
+import os
+import shutil
+import tempfile
+
+from . import TestCase
+from server import HistoryStore, apply_changes, diff_documents
+
+
+class TestHistoryStore(TestCase):
+
+    def setUp(self):
+        """
+        Create an instance with a temporary directory each time for
+        testing.
+        """
+        self.directory = tempfile.mkdtemp()
+        self.instance = HistoryStore(self.directory, deltas=2, segments=3)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def record(self, version, now):
+        self.instance.record('host', {
+            'os': {'kernel': '2.6.%d' % version, 'arch': 'x86_64'},
+            'version': version}, now=now)
+
+    def test_diff_and_apply(self):
+        """
+        Verify changes between documents are found member by member and
+        applying them turns one into the other.
+        """
+        old = {'a': {'b': 1, 'c': [1]}, 'd': True, 'e': 'gone'}
+        new = {'a': {'b': 1, 'c': [1, 2]}, 'd': 1, 'f': {'g': None}}
+        changed, deleted = diff_documents(old, new)
+        assert changed == [
+            [['a', 'c'], [1, 2]], [['d'], 1], [['f'], {'g': None}]]
+        assert deleted == [['e']]
+        assert apply_changes(json.loads(json.dumps(old)),
+                             changed, deleted) == new
+        assert diff_documents(new, new) == ([], [])
+        assert diff_documents({'a': 1}, [1]) == ([[[], [1]]], [])
+        assert apply_changes({'a': 1}, [[[], [1]]], []) == [1]
+
+    def test_record_keyframes_and_deltas(self):
+        """
+        Verify versions are written as keyframes followed by deltas, a
+        new segment is started after deltas changes and unchanged
+        versions are skipped.
+        """
+        for version in range(4):
+            self.record(version, 1000 + version)
+        self.record(3, 1010)
+        assert self.instance.list_segments('host') == [1000000, 1003000]
+        lines = open(os.path.join(
+            self.directory, 'host', '0000001000000.jsonl')).readlines()
+        assert len(lines) == 3
+        assert 'doc' in json.loads(lines[0])
+        assert json.loads(lines[1]) == {
+            't': 1001.0, 'set': [[['os', 'kernel'], '2.6.1'],
+                                 [['version'], 1]], 'del': []}
+
+    def test_last_version_is_remembered(self):
+        """
+        Verify writes diff against the version remembered in memory, and
+        the segment is read again only after another process appended.
+        """
+        self.record(0, 1000)
+        replayed = []
+        replay = self.instance._replay
+        self.instance._replay = lambda *args: (
+            replayed.append(args) or replay(*args))
+        self.record(1, 1001)
+        assert replayed == []
+        segment = os.path.join(self.directory, 'host', '0000001000000.jsonl')
+        open(segment, 'ab').write(json.dumps({
+            't': 1001.5, 'set': [[['version'], 7]], 'del': []}) + '\n')
+        self.record(1, 1002)
+        assert len(replayed) == 1
+        assert self.instance.snapshot('host', 1002)[1]['version'] == 1
+
+    def test_processes_sharing_the_directory(self):
+        """
+        Verify a segment started by another process is appended to rather
+        than the one remembered from the last write.
+        """
+        other = HistoryStore(self.directory, deltas=2, segments=3)
+        for version in range(1, 4):
+            self.record(version, 1000 + version)
+        other.record('host', {'version': 4}, now=1004)
+        self.record(5, 1005)
+        other.record('host', {'version': 6}, now=1006)
+        assert self.instance.snapshot('host', 1006)[1] == {'version': 6}
+        assert [change['time'] for change in self.instance.changes(
+            'host', 1004.5)] == [1005.0, 1006.0]
+
+    def test_snapshot(self):
+        """
+        Verify any version can be rebuilt from its segment.
+        """
+        for version in range(5):
+            self.record(version, 1000 + version)
+        assert self.instance.snapshot('host', 999) is None
+        for version in range(5):
+            found, document = self.instance.snapshot(
+                'host', 1000.5 + version)
+            assert found == 1000 + version
+            assert document['version'] == version
+            assert document['os']['kernel'] == '2.6.%d' % version
+
+    def test_changes(self):
+        """
+        Verify the change list holds every version newer than since.
+        """
+        for version in range(5):
+            self.record(version, 1000 + version)
+        changes = list(self.instance.changes('host', 1002))
+        assert [change['time'] for change in changes] == [1003, 1004]
+        assert changes[0]['set'] == [
+            [['os', 'kernel'], '2.6.3'], [['version'], 3]]
+        assert changes[0]['delete'] == []
+        assert len(list(self.instance.changes('host', 0))) == 5
+
+    def test_retention(self):
+        """
+        Verify only the newest segments are kept, and none that ended
+        longer than keep ago.
+        """
+        for version in range(12):
+            self.record(version, 1000 + version)
+        assert self.instance.list_segments('host') == [
+            1003000, 1006000, 1009000]
+        self.instance.keep = 3
+        self.record(12, 1012)
+        assert self.instance.list_segments('host') == [1009000, 1012000]
+        self.instance.remove('host')
+        assert self.instance.list_segments('host') == []
+
+    def test_disabled(self):
+        """
+        Verify nothing is recorded without a directory.
+        """
+        self.instance.configure(None, 2, 3, 0)
+        self.record(1, 1000)
+        assert os.listdir(self.directory) == []
@@ -0,0 +1,72 @@
+import json
+import os
+import shutil
+import tempfile
+
+from . import TestCase
+from server import Config, HostHistoryHandler, history_store
+
+
+class TestHostHistoryHandler(TestCase):
+
+    def setUp(self):
+        """
+        Create an instance with history enabled each time for testing.
+        """
+        self.directory = tempfile.mkdtemp()
+        conf = json.load(open('test/config.json'))
+        conf['cachedir'] = self.directory
+        conf['history'] = {}
+        path = os.path.join(self.directory, 'config.json')
+        json.dump(conf, open(path, 'w'))
+        self.instance = HostHistoryHandler(Config(path))
+        history_store.configure(
+            os.path.join(self.directory, 'history'), 100, 10, 0)
+        self.buffer = {}
+
+    def tearDown(self):
+        history_store.configure(None, 100, 10, 0)
+        shutil.rmtree(self.directory)
+
+    def start_response(self, code, headers):
+        self.buffer['code'] = code
+        self.buffer['headers'] = headers
+
+    def call(self, host, query=''):
+        return self.instance(
+            {'QUERY_STRING': query}, self.start_response, host)
+
+    def test_call(self):
+        """
+        Verify the change list and snapshots of a host are returned.
+        """
+        history_store.record('localhost', {'a': 1, 'b': 2}, now=1000)
+        history_store.record('localhost', {'a': 1, 'b': 3}, now=1001)
+        data = json.loads(self.call('localhost'))
+        assert self.buffer['code'] == '200 OK'
+        assert [change['time'] for change in data['changes']] == [1000, 1001]
+        data = json.loads(self.call('localhost', 'since=1000'))
+        assert data['changes'] == [
+            {'time': 1001, 'set': [[['b'], 3]], 'delete': []}]
+        data = json.loads(self.call('localhost', 'at=1000.5'))
+        assert data == {'host': 'localhost', 'time': 1000,
+                        'stats': {'a': 1, 'b': 2}}
+
+    def test_call_with_invalid_input(self):
+        """
+        Verify unknown hosts, missing snapshots and bad times are refused.
+        """
+        self.call('idonotexist.example.com')
+        assert self.buffer['code'] == '404 File Not Found'
+        self.call('localhost', 'at=10')
+        assert self.buffer['code'] == '404 File Not Found'
+        self.call('localhost', 'since=yesterday')
+        assert self.buffer['code'] == '400 Bad Request'
+
+    def test_disabled(self):
+        """
+        Verify history is not available unless configured.
+        """
+        self.instance = HostHistoryHandler()
+        self.call('localhost')
+        assert self.buffer['code'] == '404 File Not Found'
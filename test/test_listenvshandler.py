@@ -33,4 +33,6 @@ class TestListEnvsHandler(TestCase):
         assert type(result) == str
 
         results = json.loads(result)
-        assert results == self.instance._conf['hosts'].values()
+        envs = list(set(self.instance._conf['hosts'].values()))
+        envs.sort()
+        assert results == envs
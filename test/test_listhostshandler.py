@@ -34,3 +34,31 @@ class TestListHostsHandler(TestCase):
 
         results = json.loads(result)
         assert results == self.instance._conf['hosts']
+
+    def test_call_filtered(self):
+        """
+        Verify hosts can be filtered and paged through.
+        """
+        buffer = {}
+
+        def start_response(code, headers):
+            buffer['code'] = code
+            buffer['headers'] = headers
+
+        def call(query):
+            return json.loads(self.instance.__call__(
+                {'QUERY_STRING': query}, start_response))
+
+        assert call('env=qa') == {'127.0.0.1': 'qa'}
+        assert call('env=missing') == {}
+        assert call('prefix=local') == {'localhost': 'prod'}
+        assert call('prefix=local&env=qa') == {}
+        assert call('match=^[0-9.]%2B$') == {'127.0.0.1': 'qa'}
+        assert call('limit=1') == {'127.0.0.1': 'qa'}
+        assert dict(buffer['headers'])['X-Total-Count'] == '2'
+        assert call('limit=1&offset=1') == {'localhost': 'prod'}
+        assert call('offset=2') == {}
+
+        for query in ['limit=x', 'offset=-1', 'match=(']:
+            self.instance.__call__({'QUERY_STRING': query}, start_response)
+            assert buffer['code'] == '400 Bad Request'
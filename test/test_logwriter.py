@@ -0,0 +1,157 @@
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+
+import server
+
+from . import TestCase
+from server import AccessLog, BatchedFileHandler, LogWriter, QueueLogHandler
+
+
+class TestLogWriter(TestCase):
+
+    def setUp(self):
+        """
+        Create an instance writing to a temporary file each time.
+        """
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'test.log')
+        self.instance = LogWriter(flush_interval=0.05)
+        self.handler = BatchedFileHandler(self.path, 'd')
+        self.handler.setFormatter(logging.Formatter('%(message)s'))
+
+    def tearDown(self):
+        self.instance.close()
+        self.handler.close()
+        shutil.rmtree(self.directory)
+
+    def record(self, msg, *args):
+        return logging.LogRecord(
+            'test', logging.INFO, __file__, 1, msg, args, None)
+
+    def test_close_drains_queue(self):
+        """
+        Verify every queued record is written by close.
+        """
+        for count in range(1000):
+            self.instance.put(self.handler, self.record('line %d', count))
+        self.instance.close()
+        lines = open(self.path).read().splitlines()
+        assert lines == ['line %d' % count for count in range(1000)]
+
+    def test_batches_flush_once(self):
+        """
+        Verify a batch of records is flushed once.
+        """
+        flushes = []
+        flush = self.handler.flush
+
+        def counting_flush():
+            if not self.handler._batching:
+                flushes.append(1)
+            flush()
+
+        self.handler.flush = counting_flush
+        for count in range(100):
+            self.instance.put(self.handler, self.record('line'))
+        self.instance.close()
+        assert len(open(self.path).read().splitlines()) == 100
+        assert 1 <= len(flushes) < 10
+
+    def test_full_queue_drops(self):
+        """
+        Verify records are dropped rather than waited on when the queue is
+        full.
+        """
+        self.instance.max_queued = 1
+        blocked = threading.Event()
+        release = threading.Event()
+        write = self.handler.write
+
+        def slow_write(record):
+            blocked.set()
+            release.wait(5)
+            write(record)
+
+        self.handler.write = slow_write
+        self.instance.put(self.handler, self.record('first'))
+        blocked.wait(5)
+        self.instance.put(self.handler, self.record('second'))
+        self.instance.put(self.handler, self.record('third'))
+        release.set()
+        self.instance.close()
+        assert self.instance.dropped >= 1
+
+    def test_failed_writes(self):
+        """
+        Verify records which fail to be written are counted and skipped
+        and unicode lines are written encoded.
+        """
+        write = self.handler.write
+
+        def failing_write(record):
+            if record == 'bad':
+                raise IOError(28, 'No space left on device')
+            write(record)
+
+        self.handler.write = failing_write
+        self.instance.put(self.handler, 'bad')
+        self.instance.put(self.handler, u'caf\xe9')
+        self.instance.put(self.handler, self.record('after'))
+        self.instance.close()
+        assert self.instance.failed == 1
+        assert open(self.path).read() == 'caf\xc3\xa9\nafter\n'
+
+    def test_queue_log_handler(self):
+        """
+        Verify the message is rendered before its arguments change.
+        """
+        records = []
+
+        class Writer(object):
+            def put(self, handler, record):
+                records.append(record)
+
+        original = server.log_writer
+        server.log_writer = Writer()
+        try:
+            handler = QueueLogHandler(self.handler)
+            handler.setFormatter(logging.Formatter())
+            data = ['before']
+            handler.emit(self.record('%s', data))
+            data[0] = 'after'
+        finally:
+            server.log_writer = original
+        assert records[0].getMessage() == "['before']"
+
+    def test_formatted_lines(self):
+        """
+        Verify formatted lines are written as they are next to records and
+        AccessLog stamps lines with the time like access_log_format.
+        """
+        self.instance.put(self.handler, 'plain line')
+        self.instance.put(self.handler, self.record('record'))
+        self.instance.close()
+        assert open(self.path).read() == 'plain line\nrecord\n'
+
+        lines = []
+
+        class Writer(object):
+            def put(self, handler, line):
+                lines.append((handler, line))
+
+        logger = logging.getLogger('test_formatted_lines')
+        logger.addHandler(QueueLogHandler(self.handler))
+        original = server.log_writer
+        server.log_writer = Writer()
+        try:
+            AccessLog(logger).write('remote=-')
+        finally:
+            server.log_writer = original
+            logger.handlers = []
+        assert lines[0][0] is self.handler
+        assert re.match(
+            r'^\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d{3} remote=-$', lines[0][1])
@@ -3,10 +3,12 @@ from . import TestCase
 
 from cStringIO import StringIO
 
-from server import make_get_request, urllib2
+from server import (
+    RawJSON, make_get_request, make_raw_get_request, metrics, opener,
+    urllib2)
 
 
-# Sub for urllib2.urlopen
+# Sub for opener.open
 def stub_urlopen(endpoint):
     if endpoint == 'http://127.0.0.1/test.json':
         return StringIO('{"test": "response"}')
@@ -17,7 +19,7 @@ def stub_urlopen(endpoint):
     raise urllib2.HTTPError(endpoint, 500, 'test', {}, StringIO())
 
 
-urllib2.urlopen = stub_urlopen
+opener.open = stub_urlopen
 
 
 class TestMakeGetRequest(TestCase):
@@ -31,6 +33,16 @@ class TestMakeGetRequest(TestCase):
         assert type(result[0]) == int
         assert type(result[1]) == dict
 
+    def test_make_raw_get_request_keeps_bytes(self):
+        """
+        Verify make_raw_get_request returns the response as received.
+        """
+        result = make_raw_get_request('http://127.0.0.1/test.json')
+        assert result == (200, '{"test": "response"}')
+        assert type(result[1]) == RawJSON
+        result = make_raw_get_request('http://127.0.0.1/nonjson.txt')
+        assert result[0] == -1
+
     def test_make_get_request_erros_on_non_json_response(self):
         """
         Verify make_get_request returns json if data is returned.
@@ -70,3 +82,17 @@ class TestMakeGetRequest(TestCase):
         assert 'error' in result[1].keys()
         for key in ['Error', 'Reason', 'Suggestion']:
             assert key in result[1]['error'].keys()
+
+    def test_make_raw_get_request_records_metrics(self):
+        """
+        Verify upstream latency and errors are recorded by host.
+        """
+        labels = (('host', '127.0.0.1'),)
+        key = ('talook_upstream_errors_total', labels)
+        before = metrics.collect()[0].get(key, 0)
+        make_raw_get_request('http://127.0.0.1/test.json')
+        make_raw_get_request('http://127.0.0.1/error.json')
+        values, histograms = metrics.collect()
+        assert values[key] == before + 1
+        durations = histograms[('talook_upstream_duration_seconds', labels)]
+        assert durations[-1] >= 2
@@ -0,0 +1,146 @@
+import socket
+import threading
+import time
+
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+from . import TestCase
+from server import NameResolver, RawJSON, make_get_requests
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Answers based on the requested path.
+    """
+
+    def do_GET(self):
+        if self.path == '/hang.json':
+            time.sleep(3)
+        if self.path == '/error.json':
+            self.send_response(500, 'Broken')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.end_headers()
+        if self.path == '/nonjson.txt':
+            self.wfile.write('not json data')
+        else:
+            self.wfile.write('{"test": "%s"}' % self.path)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients giving up on hanging requests are expected
+        pass
+
+
+class TestMakeGetRequests(TestCase):
+
+    def setUp(self):
+        """
+        Start a local server to make requests against.
+        """
+        self.server = StubServer(('127.0.0.1', 0), StubHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        self.url = 'http://127.0.0.1:%s' % self.server.server_port
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def free_port(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        return port
+
+    def test_make_get_requests(self):
+        """
+        Verify make_get_requests returns make_get_request style results.
+        """
+        endpoints = {}
+        for count in range(20):
+            endpoints[count] = '%s/%s.json' % (self.url, count)
+        endpoints['nonjson'] = self.url + '/nonjson.txt'
+        endpoints['error'] = self.url + '/error.json'
+        endpoints['refused'] = 'http://127.0.0.1:%s/' % self.free_port()
+        endpoints['unknown'] = 'http://unknown.invalid:8008/'
+        result = make_get_requests(endpoints, 5, 5, 10)
+        assert len(result) == 24
+        for count in range(20):
+            assert result[count] == (200, '{"test": "/%s.json"}' % count)
+            assert type(result[count][1]) == RawJSON
+        assert result['nonjson'][0] == -1
+        assert 'Error' in result['nonjson'][1]['error'].keys()
+        assert result['error'][0] == 500
+        assert result['error'][1]['error']['Reason'] == 'Broken'
+        assert result['refused'][0] == -1
+        for key in ['Error', 'Reason', 'Suggestion']:
+            assert key in result['refused'][1]['error'].keys()
+        assert result['unknown'][0] == -1
+
+    def test_make_get_requests_timeout_and_deadline(self):
+        """
+        Verify hanging requests time out and the deadline is honored.
+        """
+        endpoints = {
+            'ok': self.url + '/ok.json',
+            'hang': self.url + '/hang.json',
+        }
+        start = time.time()
+        result = make_get_requests(endpoints, 5, 0.5, 10)
+        assert time.time() - start < 2
+        assert result['ok'][0] == 200
+        assert result['hang'][0] == -1
+
+        start = time.time()
+        result = make_get_requests(endpoints, 5, 10, 0.5)
+        assert time.time() - start < 2
+        assert result.keys() == ['ok']
+
+    def test_slow_lookups(self):
+        """
+        Verify names are looked up concurrently, failed lookups are
+        reported and lookups never outlast the deadline.
+        """
+        def gethostbyname_stub(name):
+            time.sleep(name.startswith('slow') and 3 or 0.5)
+            raise socket.gaierror(-2, 'Name or service not known')
+
+        endpoints = {}
+        for count in range(8):
+            endpoints[count] = 'http://host%s.example.com/' % count
+        endpoints['ok'] = self.url + '/ok.json'
+        endpoints['slow'] = 'http://slow.example.com/'
+        original = socket.gethostbyname
+        socket.gethostbyname = gethostbyname_stub
+        try:
+            start = time.time()
+            result = make_get_requests(endpoints, 5, 5, 1.0)
+            assert time.time() - start < 1.5
+        finally:
+            socket.gethostbyname = original
+        assert sorted(result.keys()) == range(8) + ['ok']
+        for count in range(8):
+            assert result[count][0] == -1
+            assert 'Name or service' in result[count][1]['error']['Reason']
+        assert result['ok'][0] == 200
+
+    def test_name_resolver(self):
+        """
+        Verify addresses are passed through and names are looked up.
+        """
+        resolver = NameResolver(['127.0.0.1', 'localhost'], 4)
+        resolved = dict([resolver.get(1), resolver.get(1)])
+        assert resolved['127.0.0.1'] == '127.0.0.1'
+        assert resolved['localhost'].startswith('127.')
+        assert resolver.get() is None
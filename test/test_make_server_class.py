@@ -0,0 +1,97 @@
+import os
+import threading
+import time
+import urllib2
+
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+from . import TestCase
+from server import PreForkMixIn, ThreadPoolMixIn, make_server_class
+
+
+class SlowHandler(BaseHTTPRequestHandler):
+    """
+    Answers every GET with the pid of the process after a short wait.
+    """
+
+    def do_GET(self):
+        time.sleep(0.5)
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(str(os.getpid()))
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestMakeServerClass(TestCase):
+
+    def serve(self, server_class):
+        """
+        Starts server_class on a free port in a thread.
+        """
+        server = server_class(('127.0.0.1', 0), SlowHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        return (server, thread, 'http://127.0.0.1:%s/' % server.server_port)
+
+    def fetch_concurrently(self, url, count):
+        """
+        Fetches url count times at once returning the bodies and the time
+        it took.
+        """
+        results = []
+
+        def fetch():
+            results.append(urllib2.urlopen(url).read())
+
+        threads = [threading.Thread(target=fetch) for x in range(count)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return (results, time.time() - start)
+
+    def test_make_server_class_without_options(self):
+        """
+        Verify the base class is returned when nothing is requested.
+        """
+        assert make_server_class(HTTPServer) is HTTPServer
+
+    def test_thread_pool(self):
+        """
+        Verify a thread pooled server handles requests concurrently and
+        stops its threads on close.
+        """
+        server_class = make_server_class(HTTPServer, threads=4)
+        assert issubclass(server_class, ThreadPoolMixIn)
+        assert issubclass(server_class, HTTPServer)
+        assert server_class.request_queue_size == 128
+        assert make_server_class(
+            HTTPServer, threads=64, workers=4).request_queue_size == 256
+        server, thread, url = self.serve(server_class)
+        results, elapsed = self.fetch_concurrently(url, 4)
+        assert len(results) == 4
+        assert elapsed < 1.5
+        server.shutdown()
+        thread.join()
+        server.server_close()
+        assert server._pool == ()
+
+    def test_pre_fork(self):
+        """
+        Verify a pre-fork server serves from worker processes and reaps
+        them on shutdown.
+        """
+        server_class = make_server_class(HTTPServer, threads=2, workers=2)
+        assert issubclass(server_class, PreForkMixIn)
+        server, thread, url = self.serve(server_class)
+        results, elapsed = self.fetch_concurrently(url, 4)
+        assert len(results) == 4
+        assert str(os.getpid()) not in results
+        server.shutdown()
+        thread.join(10)
+        assert not thread.isAlive()
+        server.server_close()
@@ -0,0 +1,93 @@
+import time
+
+from . import TestCase
+from server import CacheEntry, MemoryCache
+
+
+class TestMemoryCache(TestCase):
+
+    def setUp(self):
+        """
+        Create an instance each time for testing.
+        """
+        self.instance = MemoryCache(max_entries=3, max_bytes=100)
+
+    def entry(self, body, ttl=60):
+        now = time.time()
+        return CacheEntry(body, now, now + ttl)
+
+    def test_get_and_set(self):
+        """
+        Verify entries can be stored and retrieved.
+        """
+        assert self.instance.get('a') is None
+        self.instance.set('a', self.entry('{"a": 1}'))
+        assert self.instance.get('a').body == '{"a": 1}'
+        stats = self.instance.stats()
+        assert stats['hits'] == 1
+        assert stats['misses'] == 1
+        assert stats['entries'] == 1
+        assert stats['bytes'] == 8
+
+    def test_expired_entries_miss(self):
+        """
+        Verify expired entries are not returned.
+        """
+        self.instance.set('a', self.entry('{}', ttl=-1))
+        assert self.instance.get('a') is None
+        assert self.instance.stats()['misses'] == 1
+
+    def test_has(self):
+        """
+        Verify has() only sees unexpired entries and is not counted.
+        """
+        self.instance.set('a', self.entry('{}'))
+        self.instance.set('b', self.entry('{}', ttl=-1))
+        assert self.instance.has('a') is True
+        assert self.instance.has('b') is False
+        assert self.instance.has('c') is False
+        stats = self.instance.stats()
+        assert (stats['hits'], stats['misses']) == (0, 0)
+
+    def test_evicts_least_recently_used_by_count(self):
+        """
+        Verify the least recently used entry is evicted past max_entries.
+        """
+        for key in ['a', 'b', 'c']:
+            self.instance.set(key, self.entry('1'))
+        # Touch a so b becomes the least recently used
+        self.instance.get('a')
+        self.instance.set('d', self.entry('1'))
+        assert self.instance.get('b') is None
+        for key in ['a', 'c', 'd']:
+            assert self.instance.get(key) is not None
+        assert self.instance.stats()['evictions'] == 1
+
+    def test_evicts_by_bytes(self):
+        """
+        Verify entries are evicted to stay within max_bytes.
+        """
+        self.instance.set('a', self.entry('x' * 60))
+        self.instance.set('b', self.entry('x' * 60))
+        assert self.instance.get('a') is None
+        assert self.instance.get('b') is not None
+        assert self.instance.stats()['bytes'] == 60
+        # Entries larger than the whole cache are never stored
+        self.instance.set('c', self.entry('x' * 101))
+        assert self.instance.get('c') is None
+
+    def test_configure_delete_and_clear(self):
+        """
+        Verify limits can be changed and entries removed.
+        """
+        for key in ['a', 'b', 'c']:
+            self.instance.set(key, self.entry('1'))
+        self.instance.configure(1, 100)
+        assert self.instance.stats()['entries'] == 1
+        assert self.instance.get('c') is not None
+        self.instance.delete('c')
+        assert self.instance.get('c') is None
+        self.instance.set('a', self.entry('1'))
+        self.instance.clear()
+        assert self.instance.stats()['entries'] == 0
+        assert self.instance.stats()['bytes'] == 0
@@ -0,0 +1,71 @@
+import threading
+
+from . import TestCase
+from server import Metrics, MetricsHandler, metrics
+
+
+class TestMetrics(TestCase):
+
+    def setUp(self):
+        """
+        Create an instance each time for testing.
+        """
+        self.instance = Metrics()
+        self.instance.describe('test_total', 'counter', 'Test counter.')
+        self.instance.describe('test_seconds', 'histogram', 'Test timing.')
+
+    def test_counters_from_many_threads(self):
+        """
+        Verify counts recorded by many threads, including exited ones, are
+        summed.
+        """
+        def work():
+            for count in range(1000):
+                self.instance.inc('test_total', (('kind', 'a'),))
+
+        threads = [threading.Thread(target=work) for count in range(100)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.instance.inc('test_total', (('kind', 'b'),), 5)
+        values = self.instance.collect()[0]
+        assert values[('test_total', (('kind', 'a'),))] == 100000
+        assert values[('test_total', (('kind', 'b'),))] == 5
+        # Shards of exited threads are folded together
+        assert len(self.instance._shards) == 1
+
+    def test_render(self):
+        """
+        Verify the Prometheus text format.
+        """
+        self.instance.inc('test_total', (('path', 'a"b\\c'),))
+        self.instance.observe('test_seconds', (('route', '/'),), 0.02)
+        self.instance.observe('test_seconds', (('route', '/'),), 20)
+        lines = self.instance.render().splitlines()
+        assert '# TYPE test_total counter' in lines
+        assert 'test_total{path="a\\"b\\\\c"} 1' in lines
+        assert 'test_seconds_bucket{route="/",le="0.01"} 0' in lines
+        assert 'test_seconds_bucket{route="/",le="0.025"} 1' in lines
+        assert 'test_seconds_bucket{route="/",le="10"} 1' in lines
+        assert 'test_seconds_bucket{route="/",le="+Inf"} 2' in lines
+        assert 'test_seconds_sum{route="/"} 20.02' in lines
+        assert 'test_seconds_count{route="/"} 2' in lines
+
+    def test_handler(self):
+        """
+        Verify MetricsHandler serves the process metrics.
+        """
+        buffer = {}
+
+        def start_response(code, headers):
+            buffer['code'] = code
+            buffer['headers'] = headers
+
+        metrics.inc('talook_cache_writes_total')
+        result = MetricsHandler()({}, start_response)
+        assert buffer['code'] == '200 OK'
+        assert buffer['headers'] == [
+            ("Content-Type", "text/plain; version=0.0.4")]
+        assert '# TYPE talook_request_duration_seconds histogram' in result
+        assert 'talook_cache_writes_total ' in result
@@ -0,0 +1,34 @@
+from . import TestCase
+from server import Popularity
+
+
+class TestPopularity(TestCase):
+
+    def setUp(self):
+        """
+        Create an instance each time for testing.
+        """
+        self.instance = Popularity(half_life=10)
+
+    def test_hit_and_decay(self):
+        """
+        Verify requests are counted and weigh half as much after the half
+        life.
+        """
+        assert self.instance.score('host', now=0) == 0
+        self.instance.hit('host', now=0)
+        self.instance.hit('host', now=0)
+        assert self.instance.score('host', now=0) == 2
+        assert self.instance.score('host', now=10) == 1
+        self.instance.hit('host', now=10)
+        assert self.instance.score('host', now=20) == 1
+
+    def test_forget(self):
+        """
+        Verify forgotten keys count as never requested.
+        """
+        self.instance.hit('host', now=0)
+        self.instance.hit('other', now=0)
+        self.instance.forget(['host', 'missing'])
+        assert self.instance.score('host', now=0) == 0
+        assert self.instance.score('other', now=0) == 1
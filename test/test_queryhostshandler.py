@@ -1,11 +1,19 @@
 
+import gzip
+import os
+import shutil
+import tempfile
+import time
+
+from StringIO import StringIO
+
 try:
     import json
 except ImportError:
     import simplejson as json
 
 from . import TestCase
-from server import QueryHostHandler
+from server import CacheEntry, QueryHostHandler
 
 
 class TestQueryHostHandler(TestCase):
@@ -43,14 +51,222 @@ class TestQueryHostHandler(TestCase):
             buffer['code'] = code
             buffer['headers'] = headers
 
-        def get_from_cache_stub(key, source):
-            return {"ok": {"result": "returned"}}
+        def get_entry_from_cache_stub(key, source):
+            return CacheEntry(
+                json.dumps({"ok": {"result": "returned"}}), 0, 0)
 
-        self.instance.get_from_cache = get_from_cache_stub
+        self.instance.get_entry_from_cache = get_entry_from_cache_stub
 
         result = self.instance.__call__(
             environ, start_response, '127.0.0.1')
         assert buffer['code'] == '200 OK'
-        assert buffer['headers'] == [("Content-Type", "application/json")]
-        data = json.loads(result)
+        body = json.dumps({"ok": {"result": "returned"}})
+        assert buffer['headers'] == [
+            ("Content-Type", "application/json"),
+            ("Content-Length", str(len(body)))]
+        data = json.loads(''.join(result))
         assert data == {"ok": {"result": "returned"}}
+
+    def test_call_with_stale_entry(self):
+        """
+        Verify stale entries are returned with Age and Warning headers.
+        """
+        environ = {}
+        buffer = {}
+
+        def start_response(code, headers):
+            buffer['code'] = code
+            buffer['headers'] = headers
+
+        def get_entry_from_cache_stub(key, source):
+            return CacheEntry('{}', time.time() - 120, 0).as_stale()
+
+        self.instance.get_entry_from_cache = get_entry_from_cache_stub
+
+        result = self.instance.__call__(
+            environ, start_response, '127.0.0.1')
+        assert buffer['code'] == '200 OK'
+        headers = dict(buffer['headers'])
+        assert headers['Content-Type'] == 'application/json'
+        assert int(headers['Age']) >= 120
+        assert headers['Warning'] == '110 - "Response is Stale"'
+        assert result == ['{}']
+
+    def test_call_with_etag(self):
+        """
+        Verify cached entries send validators and matching revalidations
+        get 304 Not Modified without the entry being read.
+        """
+        buffer = {}
+
+        def start_response(code, headers):
+            buffer['code'] = code
+            buffer['headers'] = headers
+
+        def get_entry_from_cache_stub(key, source):
+            return CacheEntry('{}', 1000000000, 0, etag='"abc"')
+
+        self.instance.get_entry_from_cache = get_entry_from_cache_stub
+
+        result = self.instance.__call__({}, start_response, '127.0.0.1')
+        headers = dict(buffer['headers'])
+        assert headers['ETag'] == '"abc"'
+        assert headers['Last-Modified'] == 'Sun, 09 Sep 2001 01:46:40 GMT'
+        assert result == ['{}']
+
+        def get_cache_validators_stub(key):
+            return ('"abc"', 1000000000)
+
+        def get_entry_from_cache_fail(key, source):
+            raise AssertionError('entry should not be read')
+
+        self.instance.get_cache_validators = get_cache_validators_stub
+        self.instance.get_entry_from_cache = get_entry_from_cache_fail
+        environ = {'HTTP_IF_NONE_MATCH': '"abc"'}
+        result = self.instance.__call__(environ, start_response, '127.0.0.1')
+        assert buffer['code'] == '304 Not Modified'
+        assert dict(buffer['headers'])['ETag'] == '"abc"'
+        assert result == []
+
+        self.instance.get_entry_from_cache = get_entry_from_cache_stub
+        environ = {'HTTP_IF_NONE_MATCH': '"old"'}
+        result = self.instance.__call__(environ, start_response, '127.0.0.1')
+        assert buffer['code'] == '200 OK'
+        assert result == ['{}']
+
+    def test_call_with_etag_per_representation(self):
+        """
+        Verify selected sections and compressed bodies get entity tags of
+        their own which are revalidated as such.
+        """
+        buffer = {}
+
+        def start_response(code, headers):
+            buffer['code'] = code
+            buffer['headers'] = headers
+
+        def get_entry_from_cache_stub(key, source):
+            return CacheEntry(
+                '{"cpu": {"count": 4}, "memory": {"total": 8}}',
+                1000000000, 0, etag='"abc"')
+
+        self.instance.get_entry_from_cache = get_entry_from_cache_stub
+        self.instance.get_cache_validators = lambda key: (
+            '"abc"', 1000000000)
+        self.instance._compress_level = 6
+        self.instance._compress_min_size = 0
+        etags = set()
+        for environ in [
+                {}, {'QUERY_STRING': 'sections=cpu'},
+                {'HTTP_ACCEPT_ENCODING': 'gzip'},
+                {'HTTP_ACCEPT_ENCODING': 'gzip',
+                 'QUERY_STRING': 'sections=cpu'}]:
+            self.instance.__call__(environ, start_response, '127.0.0.1')
+            etag = dict(buffer['headers'])['ETag']
+            etags.add(etag)
+            environ = dict(environ, HTTP_IF_NONE_MATCH=etag)
+            self.instance.__call__(environ, start_response, '127.0.0.1')
+            assert buffer['code'] == '304 Not Modified'
+            assert dict(buffer['headers'])['ETag'] == etag
+        assert len(etags) == 4
+        assert '"abc"' in etags
+
+        environ = {
+            'QUERY_STRING': 'sections=cpu', 'HTTP_IF_NONE_MATCH': '"abc"'}
+        self.instance.__call__(environ, start_response, '127.0.0.1')
+        assert buffer['code'] == '200 OK'
+        environ = {'HTTP_IF_NONE_MATCH': '"abc-gzip"'}
+        self.instance.__call__(environ, start_response, '127.0.0.1')
+        assert buffer['code'] == '200 OK'
+
+    def test_call_streams_large_entries(self):
+        """
+        Verify large fresh entries are sent from the cache directory with
+        their Content-Length, compressed if the client accepts it.
+        """
+        self.instance._cache = True
+        self.instance._cache_dir = tempfile.mkdtemp()
+        self.instance._cache_seconds = 60
+        self.instance._compress_min_size = 0
+        self.instance.stream_size = 10
+        body = json.dumps({"data": "x" * 100})
+        entry = self.instance.save_raw_to_cache('127.0.0.1', body)
+        self.instance._memory_cache.delete('127.0.0.1')
+        buffer = {}
+
+        def start_response(code, headers):
+            buffer['code'] = code
+            buffer['headers'] = headers
+
+        def get_entry_from_cache_fail(key, source):
+            raise AssertionError('entry should not be read')
+
+        self.instance.get_entry_from_cache = get_entry_from_cache_fail
+        try:
+            result = self.instance.__call__(
+                {}, start_response, '127.0.0.1')
+            assert ''.join(result) == body
+            headers = dict(buffer['headers'])
+            assert headers['Content-Length'] == str(len(body))
+            assert headers['ETag'] == entry.etag
+
+            result = self.instance.__call__(
+                {'HTTP_ACCEPT_ENCODING': 'gzip'}, start_response,
+                '127.0.0.1')
+            headers = dict(buffer['headers'])
+            assert headers['Content-Encoding'] == 'gzip'
+            assert headers['ETag'] == entry.etag[:-1] + '-gzip"'
+            data = ''.join(result)
+            assert headers['Content-Length'] == str(len(data))
+            assert gzip.GzipFile(fileobj=StringIO(data)).read() == body
+        finally:
+            shutil.rmtree(self.instance._cache_dir)
+
+    def test_call_serves_memory_without_cache_files(self):
+        """
+        Verify entries held in memory are served without looking at the
+        cache directory, however large.
+        """
+        self.instance._cache = True
+        self.instance._cache_dir = tempfile.mkdtemp()
+        self.instance._cache_seconds = 60
+        self.instance.stream_size = 10
+        body = json.dumps({"data": "x" * 100})
+        self.instance.save_raw_to_cache('127.0.0.1', body)
+
+        def get_cache_file_fail(key, gzipped=False):
+            raise AssertionError('cache file should not be used')
+
+        self.instance.get_cache_file = get_cache_file_fail
+        try:
+            result = self.instance.__call__(
+                {'HTTP_ACCEPT_ENCODING': 'gzip'}, lambda *args: None,
+                '127.0.0.1')
+            assert result
+        finally:
+            self.instance._memory_cache.delete('127.0.0.1')
+            shutil.rmtree(self.instance._cache_dir)
+
+    def test_call_with_sections(self):
+        """
+        Verify sections= returns only the selected sections.
+        """
+        buffer = {}
+
+        def start_response(code, headers):
+            buffer['code'] = code
+            buffer['headers'] = headers
+
+        def get_entry_from_cache_stub(key, source):
+            return CacheEntry(
+                '{"cpu": {"count": 4}, "memory": {"total": 8, "free": 2}}',
+                0, 0)
+
+        self.instance.get_entry_from_cache = get_entry_from_cache_stub
+        environ = {'QUERY_STRING': 'sections=cpu,memory.free'}
+        result = self.instance.__call__(environ, start_response, '127.0.0.1')
+        assert buffer['code'] == '200 OK'
+        assert json.loads(''.join(result)) == {
+            'cpu': {'count': 4}, 'memory': {'free': 2}}
+        headers = dict(buffer['headers'])
+        assert headers['Content-Length'] == str(len(''.join(result)))
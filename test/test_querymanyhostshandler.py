@@ -0,0 +1,107 @@
+import time
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from . import TestCase
+
+import server
+from server import CacheEntry, QueryManyHostsHandler
+
+
+class TestQueryManyHostsHandler(TestCase):
+
+    def setUp(self):
+        """
+        Create an instance each time for testing.
+        """
+        self.instance = QueryManyHostsHandler()
+
+        def query_host_stub(host):
+            return CacheEntry(json.dumps({"host": host}), 0, 0)
+
+        self.instance.query_host = query_host_stub
+        self.buffer = {}
+
+    def start_response(self, code, headers):
+        self.buffer['code'] = code
+        self.buffer['headers'] = headers
+
+    def test_call_by_host(self):
+        """
+        Verify hosts can be selected with host= parameters.
+        """
+        environ = {'QUERY_STRING': 'host=127.0.0.1&host=localhost'}
+        result = self.instance.__call__(environ, self.start_response)
+        assert self.buffer['code'] == '200 OK'
+        assert self.buffer['headers'] == [
+            ("Content-Type", "application/json")]
+        data = json.loads(result)
+        assert data == {
+            "127.0.0.1": {"host": "127.0.0.1"},
+            "localhost": {"host": "localhost"}}
+
+    def test_call_by_env(self):
+        """
+        Verify hosts can be selected with env= parameters.
+        """
+        environ = {'QUERY_STRING': 'env=qa'}
+        result = self.instance.__call__(environ, self.start_response)
+        assert json.loads(result) == {"127.0.0.1": {"host": "127.0.0.1"}}
+
+    def test_call_with_unknown_host(self):
+        """
+        Verify unknown hosts get an error next to the other results.
+        """
+        environ = {'QUERY_STRING': 'host=idonotexist.example.com&env=qa'}
+        result = self.instance.__call__(environ, self.start_response)
+        data = json.loads(result)
+        assert data['127.0.0.1'] == {"host": "127.0.0.1"}
+        assert 'error' in data['idonotexist.example.com'].keys()
+
+    def test_call_past_deadline(self):
+        """
+        Verify hosts which do not answer before the deadline get an error.
+        """
+        def query_host_stub(host):
+            if host == 'localhost':
+                time.sleep(2)
+            return CacheEntry(json.dumps({"host": host}), 0, 0)
+
+        self.instance.query_host = query_host_stub
+        self.instance._fanout_deadline = 0.5
+        environ = {'QUERY_STRING': ''}
+        result = self.instance.__call__(environ, self.start_response)
+        data = json.loads(result)
+        assert data['127.0.0.1'] == {"host": "127.0.0.1"}
+        for key in ['Error', 'Reason', 'Suggestion']:
+            assert key in data['localhost']['error'].keys()
+
+    def test_call_async(self):
+        """
+        Verify the async mode fetches hosts through make_get_requests.
+        """
+        calls = []
+
+        def make_get_requests_stub(endpoints, concurrency, timeout, deadline):
+            calls.append(endpoints)
+            return {'127.0.0.1': (200, {"async": True})}
+
+        self.instance._fanout_async = True
+        self.instance._cache = False
+        fetched = []
+        fetch_entry = self.instance.fetch_entry
+        self.instance.fetch_entry = lambda key, source: (
+            fetched.append(key) or fetch_entry(key, source))
+        original = server.make_get_requests
+        server.make_get_requests = make_get_requests_stub
+        try:
+            environ = {'QUERY_STRING': 'env=qa'}
+            result = self.instance.__call__(environ, self.start_response)
+        finally:
+            server.make_get_requests = original
+        assert calls == [{'127.0.0.1': 'http://127.0.0.1:8008/'}]
+        assert json.loads(result) == {"127.0.0.1": {"async": True}}
+        assert fetched == ['127.0.0.1']
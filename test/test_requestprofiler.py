@@ -0,0 +1,125 @@
+import os
+import pstats
+import shutil
+import tempfile
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from . import TestCase
+from server import ProfilesHandler, RequestProfiler, same_token
+
+
+class TestRequestProfiler(TestCase):
+
+    def setUp(self):
+        """
+        Create an instance writing to a temporary directory each time.
+        """
+        self.directory = tempfile.mkdtemp()
+        self.instance = RequestProfiler(
+            self.directory, match='^/slow', interval=3600, keep=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_wants(self):
+        """
+        Verify requests are picked by pattern or sampling rate.
+        """
+        assert self.instance.wants('/slow/thing')
+        assert not self.instance.wants('/fast')
+        self.instance.rate = 1
+        assert self.instance.wants('/fast')
+
+    def test_run_and_dump(self):
+        """
+        Verify profiles are aggregated by route and old dumps removed.
+        """
+        def work(count):
+            return sum(range(count))
+
+        assert self.instance.run('/slow$', work, 10) == 45
+        self.instance.run('/slow$', work, 20)
+        self.instance.run('^/$', work, 5)
+        self.instance.dump()
+        profiles = self.instance.list()
+        assert len(profiles) == 2
+        names = [profile[0] for profile in profiles]
+        assert [name for name in names if name.endswith('-slow.prof')]
+        assert [name for name in names if name.endswith('-root.prof')]
+        for name in names:
+            if name.endswith('-slow.prof'):
+                stats = pstats.Stats(os.path.join(self.directory, name))
+                calls = [value[1] for key, value in stats.stats.items()
+                         if key[2] == 'work']
+                assert calls == [2]
+
+        self.instance.run('/other$', work, 5)
+        self.instance.dump()
+        assert len(self.instance.list()) == 2
+
+    def test_same_token(self):
+        """
+        Verify tokens are compared as expected.
+        """
+        assert same_token('secret', u'secret')
+        assert not same_token('secreT', 'secret')
+        assert not same_token('', 'secret')
+
+
+class TestProfilesHandler(TestCase):
+
+    def setUp(self):
+        """
+        Create an instance with a token each time for testing.
+        """
+        self.instance = ProfilesHandler()
+        self.instance._token = 'secret'
+        self.instance._directory = tempfile.mkdtemp()
+        open(os.path.join(
+            self.instance._directory, 'one.prof'), 'wb').write('data')
+        self.buffer = {}
+
+    def tearDown(self):
+        shutil.rmtree(self.instance._directory)
+
+    def start_response(self, code, headers):
+        self.buffer['code'] = code
+        self.buffer['headers'] = headers
+
+    def test_guarded(self):
+        """
+        Verify the token is required in the header and no token disables
+        the endpoint.
+        """
+        self.instance({'HTTP_X_TALOOK_TOKEN': 'wrong'}, self.start_response)
+        assert self.buffer['code'] == '403 Forbidden'
+        self.instance({'QUERY_STRING': 'token=secret'}, self.start_response)
+        assert self.buffer['code'] == '403 Forbidden'
+        self.instance._token = None
+        self.instance(
+            {'HTTP_X_TALOOK_TOKEN': 'secret'}, self.start_response)
+        assert self.buffer['code'] == '404 File Not Found'
+
+    def test_list_and_download(self):
+        """
+        Verify profiles are listed and downloaded.
+        """
+        result = self.instance(
+            {'HTTP_X_TALOOK_TOKEN': 'secret'}, self.start_response)
+        assert self.buffer['code'] == '200 OK'
+        assert [profile['name'] for profile in json.loads(result)] == [
+            'one.prof']
+        result = self.instance(
+            {'HTTP_X_TALOOK_TOKEN': 'secret'}, self.start_response,
+            'one.prof')
+        assert self.buffer['code'] == '200 OK'
+        assert ''.join(result) == 'data'
+        assert dict(self.buffer['headers'])['Content-Length'] == '4'
+        self.instance(
+            {'HTTP_X_TALOOK_TOKEN': 'secret'}, self.start_response,
+            'missing.prof')
+        assert self.buffer['code'] == '404 File Not Found'
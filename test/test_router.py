@@ -1,8 +1,13 @@
 
+import json
+import os
 import re
+import tempfile
 
 from . import TestCase
-from server import Router, IndexHandler
+from server import (
+    Router, IndexHandler, RequestProfiler, get_config, metrics,
+    set_cache_outcome)
 
 
 class TestRouter(TestCase):
@@ -41,7 +46,7 @@ class TestRouter(TestCase):
             buffer['headers'] = headers
 
         result = self.instance.__call__(environ, start_response)
-        assert type(result) == str
+        assert type(result) == list
         assert buffer['code'] == '200 OK'
         assert buffer['headers'] == [("Content-Type", "text/html")]
 
@@ -49,18 +54,195 @@ class TestRouter(TestCase):
         result_404 = self.instance.__call__(environ, start_response)
         assert buffer['code'] == '404 File Not Found'
         assert buffer['headers'] == [("Content-Type", "text/html")]
-        assert type(result_404) == str
+        assert type(result_404) == list
 
         # RegEx matching
         environ = {'PATH_INFO': '/test/location'}
         result_regex = self.instance.__call__(environ, start_response)
-        assert type(result_regex) == str
+        assert type(result_regex) == list
         assert buffer['code'] == '200 OK'
         assert buffer['headers'] == [("Content-Type", "text/html")]
 
         # Verify we skip regex checks on ''
         environ = {'PATH_INFO': ''}
         result_empty_str = self.instance.__call__(environ, start_response)
-        assert type(result_empty_str) == str
+        assert type(result_empty_str) == list
         assert buffer['code'] == '200 OK'
         assert buffer['headers'] == [("Content-Type", "text/html")]
+
+    def test_precedence(self):
+        """
+        Verify exact paths win, then rules in list order, and dictionaries
+        are tried from the longest uri to the shortest.
+        """
+        calls = []
+
+        def make_app(name):
+            def app(environ, start_response, **kwargs):
+                calls.append((name, kwargs))
+                return name
+            return app
+
+        router = Router([
+            ('/item/special', make_app('exact')),
+            ('/item/(?P<name>\\w+)$', make_app('first')),
+            ('/item/(?P<other>\\w+)$', make_app('second')),
+        ])
+        assert router({'PATH_INFO': '/item/special'}, None) == ['exact']
+        assert router({'PATH_INFO': '/item/thing'}, None) == ['first']
+        assert calls[-1] == ('first', {'name': 'thing'})
+
+        router = Router({
+            '/item/': make_app('short'),
+            '/item/(?P<name>\\w+)$': make_app('long'),
+        })
+        assert router({'PATH_INFO': '/item/thing'}, None) == ['long']
+        assert router({'PATH_INFO': '/item/'}, None) == ['short']
+
+    def test_optional_prefix(self):
+        """
+        Verify rules whose leading characters are optional or alternatives
+        still match every path the regular expression matches.
+        """
+        def make_app(name):
+            def app(environ, start_response, **kwargs):
+                return name
+            return app
+
+        router = Router([
+            ('/colou?r$', make_app('colour')),
+            ('/a|/b', make_app('either')),
+            ('/x*y', make_app('many')),
+            ('/n{0,1}m', make_app('counted')),
+        ])
+        assert router({'PATH_INFO': '/color'}, None) == ['colour']
+        assert router({'PATH_INFO': '/colour'}, None) == ['colour']
+        assert router({'PATH_INFO': '/b'}, None) == ['either']
+        assert router({'PATH_INFO': '/y'}, None) == ['many']
+        assert router({'PATH_INFO': '/xxy'}, None) == ['many']
+        assert router({'PATH_INFO': '/m'}, None) == ['counted']
+
+    def test_reload(self):
+        """
+        Verify reload swaps in new handler instances and leaves the old
+        ones untouched.
+        """
+        get_config()
+        config = json.load(open('./config.json'))
+        config['timeout'] = 7
+        fd, path = tempfile.mkstemp(suffix='.json')
+        os.write(fd, json.dumps(config))
+        os.close(fd)
+        os.environ['TALOOK_CONFIG_FILE'] = path
+        try:
+            old_app = self.instance._rules['/']['app']
+            self.instance.reload()
+        finally:
+            os.environ['TALOOK_CONFIG_FILE'] = './config.json'
+            os.unlink(path)
+        new_app = self.instance._rules['/']['app']
+        assert new_app is not old_app
+        assert type(new_app) == IndexHandler
+        assert self.instance._routes[0]['/'] is new_app
+        assert old_app._conf is not None
+        assert new_app._timeout == 7
+
+    def test_reload_unchanged(self):
+        """
+        Verify reloading an unchanged config keeps the handlers.
+        """
+        get_config()
+        old_app = self.instance._rules['/']['app']
+        self.instance.reload()
+        assert self.instance._rules['/']['app'] is old_app
+
+    def test_access_log(self):
+        """
+        Verify requests are written to the access log with their status,
+        latency and cache outcome.
+        """
+        messages = []
+
+        class Capture(object):
+            def write(self, line):
+                messages.append(line)
+
+        def app(environ, start_response, **kwargs):
+            set_cache_outcome('hit')
+            start_response('200 OK', [('Content-Length', '2')])
+            return ['{}']
+
+        router = Router([('/item$', app)])
+        router.access_log = Capture()
+        router({'PATH_INFO': '/item', 'QUERY_STRING': 'a=1',
+                'REQUEST_METHOD': 'GET', 'REMOTE_ADDR': '127.0.0.1'},
+               lambda status, headers: None)
+        router({'PATH_INFO': '/missing'}, lambda status, headers: None)
+        assert messages[0].startswith(
+            'remote=127.0.0.1 method=GET path=/item?a=1 status=200 bytes=2 '
+            'latency_ms=')
+        assert messages[0].endswith(' cache=hit')
+        assert 'status=404' in messages[1]
+        assert messages[1].endswith(' cache=-')
+
+    def test_metrics(self):
+        """
+        Verify requests are counted and timed by route.
+        """
+        def app(environ, start_response, **kwargs):
+            start_response('200 OK', [])
+            return ''
+
+        router = Router([('/counted$', app)])
+        labels = (('route', '/counted$'), ('status', '200'))
+        before = metrics.collect()[0].get(('talook_requests_total', labels), 0)
+        router({'PATH_INFO': '/counted'}, lambda status, headers: None)
+        values, histograms = metrics.collect()
+        assert values[('talook_requests_total', labels)] == before + 1
+        assert values[('talook_requests_in_flight', labels[:1])] == 0
+        assert histograms[
+            ('talook_request_duration_seconds', labels[:1])][-1] >= 1
+
+    def test_errors_are_recorded(self):
+        """
+        Verify a handler raising is counted, timed and logged as a 500
+        before the exception reaches the server.
+        """
+        lines = []
+
+        class Capture(object):
+            def write(self, line):
+                lines.append(line)
+
+        def app(environ, start_response, **kwargs):
+            raise ValueError('broken')
+
+        router = Router([('/broken$', app)])
+        router.access_log = Capture()
+        labels = (('route', '/broken$'), ('status', '500'))
+        before = metrics.collect()[0].get(('talook_requests_total', labels), 0)
+        self.assertRaises(
+            ValueError, router, {'PATH_INFO': '/broken'},
+            lambda status, headers: None)
+        values, histograms = metrics.collect()
+        assert values[('talook_requests_total', labels)] == before + 1
+        assert values[('talook_requests_in_flight', labels[:1])] == 0
+        assert ('talook_request_duration_seconds', labels[:1]) in histograms
+        assert 'path=/broken status=500 bytes=-' in lines[0]
+
+    def test_profiling(self):
+        """
+        Verify matching requests are profiled by route and profiling is
+        off by default.
+        """
+        def app(environ, start_response, **kwargs):
+            start_response('200 OK', [])
+            return 'profiled'
+
+        router = Router([('/item$', app)])
+        assert router._profiler is None
+        router._profiler = RequestProfiler(
+            tempfile.gettempdir(), match='^/item', interval=3600)
+        result = router({'PATH_INFO': '/item'}, lambda status, headers: None)
+        assert result == ['profiled']
+        assert router._profiler._stats.keys() == ['/item$']
@@ -0,0 +1,43 @@
+import time
+
+from . import TestCase
+from server import run_concurrently
+
+
+class TestRunConcurrently(TestCase):
+
+    def test_run_concurrently_returns_results(self):
+        """
+        Verify run_concurrently returns the result of every job.
+        """
+        jobs = {}
+        for count in range(20):
+            jobs[count] = lambda count=count: count * 2
+        result = run_concurrently(jobs, 4, 5)
+        assert type(result) == dict
+        assert len(result) == 20
+        for count in range(20):
+            assert result[count] == count * 2
+
+    def test_run_concurrently_honors_deadline(self):
+        """
+        Verify jobs which do not finish before the deadline are left out.
+        """
+        jobs = {
+            'fast': lambda: 'fast',
+            'slow': lambda: time.sleep(2),
+        }
+        start = time.time()
+        result = run_concurrently(jobs, 2, 0.5)
+        assert time.time() - start < 1.5
+        assert result == {'fast': 'fast'}
+
+    def test_run_concurrently_captures_exceptions(self):
+        """
+        Verify a job raising an exception has the exception as the result.
+        """
+        def broken():
+            raise ValueError('broken')
+
+        result = run_concurrently({'broken': broken}, 1, 5)
+        assert isinstance(result['broken'], ValueError)
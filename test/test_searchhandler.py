@@ -0,0 +1,78 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import server
+
+from . import TestCase
+from server import Config, FactIndex, SearchHandler
+
+
+class TestSearchHandler(TestCase):
+
+    def setUp(self):
+        """
+        Create an instance with search enabled and an index of its own
+        each time for testing.
+        """
+        self.directory = tempfile.mkdtemp()
+        conf = json.load(open('test/config.json'))
+        conf['cachedir'] = self.directory
+        conf['search'] = {}
+        path = os.path.join(self.directory, 'config.json')
+        json.dump(conf, open(path, 'w'))
+        self.instance = SearchHandler(Config(path))
+        self.original = server.fact_index
+        server.fact_index = FactIndex(True, ())
+        self.buffer = {}
+
+    def tearDown(self):
+        server.fact_index.configure(False, ())
+        server.fact_index = self.original
+        shutil.rmtree(self.directory)
+
+    def start_response(self, code, headers):
+        self.buffer['code'] = code
+        self.buffer['headers'] = headers
+
+    def call(self, query=''):
+        return self.instance({'QUERY_STRING': query}, self.start_response)
+
+    def test_call(self):
+        """
+        Verify hosts are found by their cached stats once the cache
+        directory has been indexed in the background.
+        """
+        for host, kernel in [('localhost', '2.6.32'), ('127.0.0.1', '2.6.18')]:
+            json.dump({'os': {'kernel': kernel}}, open(
+                os.path.join(self.directory, host + '.json'), 'w'))
+        give_up = time.time() + 5
+        data = json.loads(self.call('fact=os.kernel'))
+        while not data['complete'] and time.time() < give_up:
+            time.sleep(0.01)
+            data = json.loads(self.call('fact=os.kernel'))
+        assert self.buffer['code'] == '200 OK'
+        assert data == {
+            'fact': 'os.kernel', 'env': None, 'complete': True, 'values': {
+                '2.6.32': ['localhost'], '2.6.18': ['127.0.0.1']}}
+        data = json.loads(self.call('fact=os.kernel&env=qa'))
+        assert data['values'] == {'2.6.18': ['127.0.0.1']}
+        data = json.loads(self.call('fact=os.kernel&value=2.6.32'))
+        assert data['values'] == {'2.6.32': ['localhost']}
+
+    def test_call_with_invalid_input(self):
+        """
+        Verify searches without a fact are refused.
+        """
+        self.call('value=1')
+        assert self.buffer['code'] == '400 Bad Request'
+
+    def test_disabled(self):
+        """
+        Verify search is not available unless configured.
+        """
+        self.instance = SearchHandler()
+        self.call('fact=os.kernel')
+        assert self.buffer['code'] == '404 File Not Found'
@@ -0,0 +1,62 @@
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from . import TestCase
+from server import build_section_index, parse_raw_json, select_sections
+
+
+class TestSelectSections(TestCase):
+
+    body = (
+        '{"cpu": {"count": 4, "load": [1, 2]},\n'
+        ' "memory" : {"total": 8, "swap": {"total": 2, "free": 1}},'
+        ' "name": "h\\u00e9"}')
+
+    def test_build_section_index(self):
+        """
+        Verify the index locates each top level member.
+        """
+        index = build_section_index(self.body)
+        assert sorted(index.keys()) == ['cpu', 'memory', 'name']
+        for name, (start, end) in index.items():
+            assert json.loads(self.body[start:end]) == json.loads(
+                self.body)[name]
+        assert build_section_index('[1, 2]') == {}
+        assert build_section_index(' { } ') == {}
+        self.assertRaises(ValueError, build_section_index, '{"a": 1')
+        self.assertRaises(ValueError, build_section_index, '{"a" 1}')
+        self.assertRaises(ValueError, build_section_index, '{"a": 1} x')
+        self.assertRaises(ValueError, build_section_index, '{} {}')
+
+    def test_parse_raw_json(self):
+        """
+        Verify documents are checked, indexed and decoded in one pass.
+        """
+        raw = parse_raw_json(self.body)
+        assert raw == self.body
+        assert raw.index == build_section_index(self.body)
+        assert raw.document == json.loads(self.body)
+        raw = parse_raw_json(' [1, 2] ')
+        assert (raw.index, raw.document) == ({}, [1, 2])
+        for body in ['{"a": 1', '{"a": 1}}', '[1', '']:
+            self.assertRaises(ValueError, parse_raw_json, body)
+
+    def test_select_sections(self):
+        """
+        Verify whole sections and dotted paths are selected.
+        """
+        index = build_section_index(self.body)
+        result = select_sections(self.body, index, ['cpu', 'missing'])
+        assert result == '{"cpu": {"count": 4, "load": [1, 2]}}'
+        result = json.loads(select_sections(
+            self.body, index,
+            ['memory.swap.free', 'memory.total', 'cpu.nothing', 'name']))
+        assert result == {
+            'memory': {'swap': {'free': 1}, 'total': 8},
+            'cpu': {}, 'name': u'h\xe9'}
+        # A whole section wins over paths within it
+        result = json.loads(select_sections(
+            self.body, index, ['memory.total', 'memory']))
+        assert result == {'memory': json.loads(self.body)['memory']}
@@ -0,0 +1,55 @@
+import threading
+import time
+
+from . import TestCase
+from server import SingleFlight
+
+
+class TestSingleFlight(TestCase):
+
+    def setUp(self):
+        """
+        Create an instance each time for testing.
+        """
+        self.instance = SingleFlight()
+
+    def test_do_coalesces_concurrent_calls(self):
+        """
+        Verify concurrent calls for the same key run the function once.
+        """
+        calls = []
+        results = []
+
+        def func():
+            calls.append(1)
+            time.sleep(0.3)
+            return 'result'
+
+        def caller():
+            results.append(self.instance.do('key', func))
+
+        threads = [threading.Thread(target=caller) for x in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(calls) == 1
+        assert results == ['result'] * 5
+
+    def test_do_runs_again_after_completion(self):
+        """
+        Verify a call made after the previous one finished runs again.
+        """
+        calls = []
+        self.instance.do('key', lambda: calls.append(1))
+        self.instance.do('key', lambda: calls.append(1))
+        assert len(calls) == 2
+
+    def test_do_raises_for_everyone(self):
+        """
+        Verify an exception in the running call is raised to its caller.
+        """
+        def broken():
+            raise ValueError('broken')
+
+        self.assertRaises(ValueError, self.instance.do, 'key', broken)
@@ -10,36 +10,44 @@ class TestStaticFileHandler(TestCase):
         Create an instance each time for testing.
         """
         self.instance = StaticFileHandler()
+        self.buffer = {}
+
+    def start_response(self, code, headers):
+        self.buffer['code'] = code
+        self.buffer['headers'] = headers
+
+    def combine_result(self, iter):
+        result = []
+        for line in iter:
+            result.append(line)
+        return "".join(result)
 
     def test_call(self):
         """
         Verify running StaticHandler returns propert information.
         """
         environ = {'PATH_INFO': '/static/style.css'}
-        buffer = {}
-
-        def start_response(code, headers):
-            buffer['code'] = code
-            buffer['headers'] = headers
-
-        def combine_result(iter):
-            result = []
-            for line in iter:
-                result.append(line)
-            return "\n".join(result)
+        start_response = self.start_response
+        buffer = self.buffer
+        combine_result = self.combine_result
 
         result = combine_result(
             self.instance.__call__(environ, start_response, 'style.css'))
         assert buffer['code'] == '200 OK'
-        assert buffer['headers'] == [("Content-Type", "text/css")]
+        headers = dict(buffer['headers'])
+        assert headers['Content-Type'] == 'text/css'
+        assert headers['Content-Length'] == str(len(result))
+        for key in ['ETag', 'Last-Modified', 'Cache-Control']:
+            assert key in headers.keys()
         assert type(result) == str
+        assert result == open('static/style.css', 'rb').read()
 
         result2 = combine_result(
             self.instance.__call__(
                 environ, start_response, 'bootstrap.min.js'))
         assert buffer['code'] == '200 OK'
-        assert buffer['headers'] == [(
-            "Content-Type", "application/javascript")]
+        assert dict(buffer['headers'])['Content-Type'] == (
+            'application/javascript')
         assert type(result2) == str
 
         result_404 = combine_result(
@@ -49,3 +57,68 @@ class TestStaticFileHandler(TestCase):
         assert buffer['headers'] == [(
             "Content-Type", "text/html")]
         assert type(result_404) == str
+
+    def test_call_binary(self):
+        """
+        Verify binary files are returned unchanged.
+        """
+        result = self.combine_result(self.instance.__call__(
+            {}, self.start_response, 'glyphicons-halflings.png'))
+        assert dict(self.buffer['headers'])['Content-Type'] == 'image/png'
+        assert result == open(
+            'static/glyphicons-halflings.png', 'rb').read()
+
+    def test_call_not_modified(self):
+        """
+        Verify conditional requests get 304 Not Modified.
+        """
+        self.combine_result(self.instance.__call__(
+            {}, self.start_response, 'style.css'))
+        headers = dict(self.buffer['headers'])
+
+        environ = {'HTTP_IF_NONE_MATCH': headers['ETag']}
+        result = self.combine_result(
+            self.instance.__call__(environ, self.start_response, 'style.css'))
+        assert self.buffer['code'] == '304 Not Modified'
+        assert result == ''
+
+        environ = {'HTTP_IF_NONE_MATCH': '"other"'}
+        self.combine_result(
+            self.instance.__call__(environ, self.start_response, 'style.css'))
+        assert self.buffer['code'] == '200 OK'
+
+        environ = {'HTTP_IF_MODIFIED_SINCE': headers['Last-Modified']}
+        self.combine_result(
+            self.instance.__call__(environ, self.start_response, 'style.css'))
+        assert self.buffer['code'] == '304 Not Modified'
+
+        environ = {'HTTP_IF_MODIFIED_SINCE': 'Thu, 01 Jan 1970 00:00:00 GMT'}
+        self.combine_result(
+            self.instance.__call__(environ, self.start_response, 'style.css'))
+        assert self.buffer['code'] == '200 OK'
+
+    def test_call_large_files(self):
+        """
+        Verify large files use wsgi.file_wrapper or chunked reads.
+        """
+        self.instance.memory_limit = 0
+        self.instance.chunk_size = 1024
+        expected = open('static/bootstrap.min.css', 'rb').read()
+
+        chunks = list(self.instance.__call__(
+            {}, self.start_response, 'bootstrap.min.css'))
+        assert len(chunks) > 1
+        assert max([len(chunk) for chunk in chunks]) == 1024
+        assert ''.join(chunks) == expected
+
+        wrapped = []
+
+        def file_wrapper(f, block_size):
+            wrapped.append(block_size)
+            return iter(lambda: f.read(block_size), '')
+
+        environ = {'wsgi.file_wrapper': file_wrapper}
+        result = self.combine_result(self.instance.__call__(
+            environ, self.start_response, 'bootstrap.min.css'))
+        assert wrapped == [1024]
+        assert result == expected
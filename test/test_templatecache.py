@@ -0,0 +1,52 @@
+import os
+import tempfile
+import time
+
+from . import TestCase
+from server import TemplateCache
+
+
+class TestTemplateCache(TestCase):
+
+    def setUp(self):
+        """
+        Create an instance and a template each time for testing.
+        """
+        self.instance = TemplateCache()
+        fd, self.path = tempfile.mkstemp()
+        os.write(fd, '<b>{{- title -}}</b>{{- title -}} {{- missing -}}')
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def test_render(self):
+        """
+        Verify placeholders are replaced and unknown ones left alone.
+        """
+        result = self.instance.render(self.path, {'title': 'test'})
+        assert result == '<b>test</b>test {{- missing -}}'
+
+    def test_render_memoizes(self):
+        """
+        Verify rendered output is reused until the template changes.
+        """
+        first = self.instance.render(self.path, {'title': 'test'})
+        assert self.instance.render(self.path, {'title': 'test'}) is first
+        assert self.instance.render(self.path, {'title': 'x'}) != first
+
+        f = open(self.path, 'w')
+        f.write('{{- title -}}!')
+        f.close()
+        os.utime(self.path, (time.time() + 10, time.time() + 10))
+        assert self.instance.render(self.path, {'title': 'test'}) == 'test!'
+
+    def test_clear(self):
+        """
+        Verify clear forgets rendered output.
+        """
+        first = self.instance.render(self.path, {'title': 'test'})
+        self.instance.clear()
+        second = self.instance.render(self.path, {'title': 'test'})
+        assert second == first
+        assert second is not first